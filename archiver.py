@@ -0,0 +1,77 @@
+import datetime
+import threading
+import time
+
+from common.config import settings
+from databases import ServerStorage
+from log.server_log import logger
+
+"""Фоновая архивация. Раз в {interval} секунд доставленные сообщения старше {max_age_days} дней переносятся из
+таблицы messages в архив (database/archive.py) пачками по ARCHIVE.batch, каждая пачка - своя транзакция, чтобы не
+держать базу заблокированной надолго. Первый запуск - сразу при старте сервера"""
+
+
+class Archiver:
+
+    def __init__(self, database: ServerStorage, max_age_days: float = None, interval: float = None):
+        """
+        Args:
+            database (ServerStorage): database to archive messages of
+            max_age_days (float): delivered messages older than this are archived
+            interval (float): seconds between runs
+        """
+        config = settings.ARCHIVE
+        self.db = database
+        self.max_age = datetime.timedelta(days=config['max_age_days'] if max_age_days is None else max_age_days)
+        self.interval = config['interval'] if interval is None else interval
+        self.stopped = threading.Event()
+
+        self.runs = 0
+        self.archived = 0
+        self.run_last = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='message-archiver', daemon=True)
+        self._thread.start()
+
+    def run(self) -> int:
+        """Archive everything older than max age
+
+        Returns:
+            int: number of archived messages
+        """
+        start = time.monotonic()
+        before = datetime.datetime.now() - self.max_age
+        total = 0
+        while not self.stopped.is_set():
+            count = self.db.archive_messages(before)
+            if not count:
+                break
+            total += count
+
+        self.runs += 1
+        self.archived += total
+        self.run_last = time.monotonic() - start
+        return total
+
+    def _run(self):
+        while True:
+            try:
+                count = self.run()
+                if count:
+                    logger.info(f'<archiver> {count} messages archived in {self.run_last:.3f} s')
+            except Exception as e:
+                logger.error(f'<archiver> {e}')
+            if self.stopped.wait(self.interval):
+                return
+
+    def close(self):
+        self.stopped.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def stats(self) -> dict:
+        return {
+            'runs': self.runs,
+            'archived': self.archived,
+            'run_last_ms': round(self.run_last * 1000, 3),
+        }
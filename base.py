@@ -1,15 +1,33 @@
+import asyncio
 import datetime
 import json
-from select import select
-from socket import socket, AddressFamily, SocketKind, AF_INET, SOL_SOCKET, SO_REUSEADDR, SOCK_STREAM, SHUT_RDWR
-from typing import List, Tuple
+import os
+import selectors
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from socket import socket, socketpair, AddressFamily, SocketKind, AF_INET, AF_UNIX, SOL_SOCKET, SO_REUSEADDR, \
+    SOCK_STREAM, SHUT_RDWR, SO_REUSEPORT
+from typing import Tuple, Callable, Any, Optional, Set, Iterable, List
 
 import rsa
 
+from archiver import Archiver
+from common import crypto
+from common.compression import Capture
 from common.config import settings
-from databases import ServerDatabase
+from common.framing import pack_frame
+from common.keystore import KeyStore
+from common.utils import unix_address
+from databases import get_database
 from decorators import log
+from pipeline import Pipeline
+from registry import ConnectionRegistry, Connection
+from rooms import RoomIndex
 from templates.templates import Request
+from writer import MessageWriter
 
 """Решил что вот так будет совсем красиво. Сервер и клиент изначально представляют собой одно и то же - сокет, поэтому
 часть параметров у них общая и часть методов класса соответственно тоже (создание объекта сокета, установка некоторых
@@ -45,7 +63,8 @@ class BaseTCPSocket:
         
     def _connect(self):
         self.connection = socket(self.address_family, self.socket_type)
-        self.connection.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if self.address_family == AF_INET:
+            self.connection.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     
     def shutdown(self):
         self.connection.close()
@@ -57,12 +76,35 @@ class BaseTCPSocket:
         self.shutdown()
 
 
+def listen_unix(path: str, backlog: int) -> socket:
+    """Listening unix socket. Socket file, left by previous run, is removed"""
+    if not path.startswith('@') and os.path.exists(path):
+        os.unlink(path)
+
+    listener = socket(AF_UNIX, SOCK_STREAM)
+    listener.bind(unix_address(path))
+    listener.listen(backlog)
+    listener.setblocking(False)
+    return listener
+
+
+def remove_unix(path: str):
+    """Remove socket file of unix socket. Abstract socket has no file"""
+    if not path.startswith('@'):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            ...
+
+
 class TCPSocketServer(BaseTCPSocket):
     pool_size: int = 5
+    max_outbox_size: int = settings.MAX_OUTBOX_SIZE
     request_handler = None
-    connected = []
-    connected_users = {}
-    public_keys = {}
+    router = None
+    unix_connection: socket = None
+    # файл unix сокета удаляет только создавший его процесс, воркеры получают общий сокет от родителя
+    unix_owner: bool = False
 
     @log
     def __init__(
@@ -73,6 +115,8 @@ class TCPSocketServer(BaseTCPSocket):
             buffer: int = None,
             pool_size: int = None,
             bind_and_listen: bool = True,
+            reuse_port: bool = False,
+            unix_path: str = None,
     ):
         """Initialize server class
 
@@ -81,24 +125,51 @@ class TCPSocketServer(BaseTCPSocket):
             port (int): port to listen
             buffer (int): size of receiving buffer, bytes
             pool_size (int): listening queue size
+            reuse_port (bool): set SO_REUSEPORT, so several worker processes can accept on the same port
+            unix_path (str): also listen on unix socket with this path ('@name' - abstract namespace),
+                empty string disables it. Clients on the same host connect bypassing TCP stack
         """
         super(TCPSocketServer, self).__init__(host, port, buffer)
+        self.unix_path = settings.UNIX_PATH if unix_path is None else unix_path
 
         self._public, self._private = self.__generate_keys()
         self.gui = None
         self.request_handler = handler
-        self.database = ServerDatabase()
+        self.database = get_database()
+        self.registry = ConnectionRegistry()
+        self.rooms = RoomIndex(self.database)
+        self.writer = MessageWriter(self.database)
+        self.archiver: Optional[Archiver] = Archiver(self.database) if settings.ARCHIVE['enabled'] else None
+        capture = settings.COMPRESSION['capture']
+        self.capture: Optional[Capture] = Capture(capture) if capture else None
+
+        # исходящие данные копятся в буфере соединения и отправляются, когда сокет готов к записи,
+        # поэтому медленный получатель не блокирует весь сервер
+        self.selector = selectors.DefaultSelector()
+
+        # обработчики могут работать в пуле потоков, а сокетами и селектором владеет только поток цикла:
+        # вызовы из других потоков ставятся в очередь, и цикл будится через socketpair
+        self.pipeline = Pipeline()
+        self._loop_thread: Optional[int] = None
+        self._calls = deque()
+        self._wakeup, self._waker = socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self.selector.register(self._wakeup, selectors.EVENT_READ, self._run_calls)
 
         if pool_size:
             assert isinstance(pool_size, int), "Variable 'pool_size' must be int"
             self.pool_size = pool_size
+
+        if reuse_port:
+            self.connection.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         
         if bind_and_listen:
             self.bind_and_listen()
 
     @staticmethod
     def __generate_keys() -> Tuple[rsa.PublicKey, rsa.PrivateKey]:
-        return rsa.newkeys(512, poolsize=16)
+        return KeyStore().load()
     
     @log
     def bind_and_listen(self) -> None:
@@ -109,49 +180,582 @@ class TCPSocketServer(BaseTCPSocket):
         
         self.connection.bind((self.host, self.port))
         self.connection.listen(self.pool_size)
-        self.connected.append(self.connection)
-    
-    def accept_connection(self):
+        self.selector.register(self.connection, selectors.EVENT_READ, self.accept_connection)
+
+        if self.unix_path:
+            self.attach_listener(listen_unix(self.unix_path, self.pool_size))
+            self.unix_owner = True
+
+    def attach_listener(self, listener: socket):
+        """Accept local clients on unix socket in the same loop, as TCP clients"""
+        self.unix_connection = listener
+        self.selector.register(listener, selectors.EVENT_READ, partial(self.accept_connection, listener))
+
+    def peer_address(self, address: Any, fd: int) -> Tuple[str, int]:
+        """Unix socket clients have no address, they are named by server socket path and descriptor"""
+        return address or (self.unix_path, fd)
 
-        client, address = self.connection.accept()
-        self.connected.append(client)
-        client.send(json.dumps([self._public.n, self._public.e]).encode(settings.DEFAULT_ENCODING))
+    def accept_connection(self, listener: socket = None):
+
+        try:
+            client, address = (listener or self.connection).accept()
+        except BlockingIOError:
+            # unix сокет воркеров общий, клиента уже принял другой процесс
+            return
+        client.setblocking(False)
+        address = self.peer_address(address, client.fileno())
+        conn = self.registry.add(client, address)
+        conn.session = self.request_handler(client, self, self.database, self._private, address)
+        self.selector.register(client, selectors.EVENT_READ, None)
+        self._queue(conn, self._key_frame())
         self.gui.console_log.emit(f"{address[0]} connected")
 
+    def send(self, client: socket, data: bytes):
+        """Queue message for sending. Never blocks: what can not be sent now, is sent when socket becomes writable
+
+        Args:
+            client (socket): recipient connection
+            data (bytes): encrypted message, frame header is added here
+        """
+        conn = self.registry.get(client)
+        if conn:
+            self.call_soon(self._queue, conn, pack_frame(data))
+
+    def call_soon(self, func: Callable, *args):
+        """Run func in I/O loop thread. Called from loop thread itself runs immediately"""
+        if self._loop_thread in (None, threading.get_ident()):
+            func(*args)
+            return
+
+        self._calls.append((func, args))
+        try:
+            self._waker.send(b'\0')
+        except BlockingIOError:
+            # буфер socketpair заполнен - цикл и так будет разбужен
+            ...
+
+    def _run_calls(self):
+        try:
+            while self._wakeup.recv(4096):
+                ...
+        except BlockingIOError:
+            ...
+
+        while self._calls:
+            func, args = self._calls.popleft()
+            func(*args)
+
+    def dispatch(self, client: socket, func: Callable, *args):
+        """Handle request of client in pipeline, after requests of this client, received earlier"""
+        self.pipeline.submit(client, func, *args)
+
+    def stop_reading(self, client: socket):
+        """Peer closed connection, but its requests are still handled - stop polling socket for reading"""
+        conn = self.registry.get(client)
+        if conn:
+            self.call_soon(self._stop_reading, conn)
+
+    def _stop_reading(self, conn: Connection):
+        conn.eof = True
+        self._update_events(conn)
+
+    def _read(self, conn: Connection):
+        try:
+            data = conn.sock.recv(self.buffer_size)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            data = b''
+
+        if data:
+            conn.touch()
+        conn.bytes_in += len(data)
+        conn.frames_in += conn.session.handle_data(data)
+
+    def _queue(self, conn: Connection, frame: bytes):
+        if conn.closing or self.registry.by_fd.get(conn.fd) is not conn:
+            return
+
+        buffer = conn.outbox
+        pending = bool(buffer)
+        buffer += frame
+        conn.bytes_out += len(frame)
+        conn.frames_out += 1
+
+        if len(buffer) > self.max_outbox_size:
+            # получатель не успевает читать - отключаем его
+            self._abort(conn)
+            return
+
+        if not pending:
+            self.flush(conn)
+
+    def _abort(self, conn: Connection):
+        """Drop connection without waiting for pending data. Read returns b'' and handler closes connection"""
+        conn.outbox.clear()
+        self._update_events(conn)
+        try:
+            conn.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            ...
+
+    def _probe(self, conn: Connection):
+        self.dispatch(conn.sock, conn.session.probe)
+
+    def _reap_idle(self):
+        """Probe silent connections and drop the ones, that did not answer. Only expired timers are touched"""
+        to_probe, to_reap = self.registry.check_idle()
+        for conn in to_probe:
+            self._probe(conn)
+        for conn in to_reap:
+            self.gui.console_log.emit(f"{conn.address[0]} timed out")
+            if conn.closing:
+                # сокет закрывающегося соединения уже не читается, поэтому закрываем его сразу
+                self._close(conn)
+            else:
+                self._abort(conn)
+
+    def flush(self, conn: Connection):
+        """Send as much of pending data as socket accepts. Write interest is kept only while data is pending"""
+        buffer = conn.outbox
+        try:
+            sent = conn.sock.send(buffer)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            # соединение разорвано, закрытие обработает сторона чтения
+            buffer.clear()
+            sent = 0
+
+        del buffer[:sent]
+
+        if not buffer and conn.closing:
+            self._close(conn)
+        else:
+            self._update_events(conn)
+
+    def encode(self, session: Any, request: Request) -> bytes:
+        """Serialize request with codec of session and compress it, if compression is agreed"""
+        data = session.codec.encode(request)
+        if self.capture and request.action in Capture.ACTIONS:
+            self.capture.write(data)
+        if session.compressor:
+            return session.compressor.compress(data)
+        return data
+
+    def encrypt(self, session: Any, request: Request) -> bytes:
+        """Encrypt request with session key of client, or with his public key, if session key is not agreed.
+        Session is passed by caller: connection can be removed by I/O loop meanwhile, it is not looked up again"""
+        data = self.encode(session, request)
+        if session.cipher:
+            return session.cipher.encrypt(data)
+        return crypto.encrypt(data, session.public_key)
+
+    def add_user(self, client: socket, login: str) -> bool:
+        """Register authenticated user session. Other worker processes are notified, so they can route to it
+
+        Returns:
+            bool: False if user is already connected from another connection
+        """
+        conn = self.registry.get(client)
+        if not conn or not self.registry.bind(conn, login):
+            return False
+        if self.router:
+            self.router.bind(login)
+        return True
+
+    def remove_user(self, client: socket):
+        """Forget user session of connection"""
+        conn = self.registry.get(client)
+        if not conn:
+            return
+
+        login = conn.login
+        if self.registry.unbind(conn) and self.router:
+            self.router.unbind(login)
+
+    def deliver(self, login: str, request: Request) -> bool:
+        """Send request to user, connected to this process or to another worker
+
+        Returns:
+            bool: False if user is offline
+        """
+        if self.deliver_local(login, request):
+            return True
+        if self.router:
+            return self.router.forward(login, request)
+        return False
+
+    def deliver_local(self, login: str, request: Request) -> bool:
+        conn = self.registry.user(login)
+        if not conn:
+            return False
+        self.send(conn.sock, self.encrypt(conn.session, request))
+        return True
+
+    def deliver_many(self, logins: Iterable[str], request: Request) -> List[str]:
+        """Send one request to several users (room members)
+
+        Returns:
+            List[str]: users, request was delivered to
+        """
+        delivered = self.deliver_local_many(logins, request)
+        if self.router:
+            offline = set(logins).difference(delivered)
+            delivered += self.router.forward_many(offline, request)
+        return delivered
+
+    def deliver_local_many(self, logins: Iterable[str], request: Request) -> List[str]:
+        """Request is serialized and encrypted once, for every recipient only symmetric key is encrypted"""
+        recipients = []
+        for login in logins:
+            conn = self.registry.user(login)
+            if conn and conn.session.public_key:
+                recipients.append((login, conn))
+        if not recipients:
+            return []
+
+        # запрос сериализуется (и сжимается) один раз для каждого формата, а не для каждого получателя.
+        # С сессионным ключом шифрование симметричное, rsa нужен только клиентам без него
+        encoded = {}
+        legacy = {}
+        for _, conn in recipients:
+            session = conn.session
+            kind = (session.codec, session.compressor)
+            if kind not in encoded:
+                encoded[kind] = self.encode(session, request)
+
+            if session.cipher:
+                self.send(conn.sock, session.cipher.encrypt(encoded[kind]))
+            else:
+                legacy.setdefault(kind, []).append(conn)
+
+        for kind, connections in legacy.items():
+            keys = [conn.session.public_key for conn in connections]
+            for conn, payload in zip(connections, crypto.encrypt_many(encoded[kind], keys)):
+                self.send(conn.sock, payload)
+        return [login for login, _ in recipients]
+
+    def stats(self) -> dict:
+        """Connections, traffic and persistence of messages"""
+        result = {**self.registry.stats(), 'writer': self.writer.stats(), 'database': self.database.stats()}
+        if self.archiver:
+            result['archiver'] = self.archiver.stats()
+        return result
+
+    def update_room(self, name: str):
+        """Room membership changed: drop cached members in this process and in other workers"""
+        self.rooms.forget(name)
+        if self.router:
+            self.router.broadcast({'op': 'room', 'name': name})
+
+    def _update_events(self, conn: Connection):
+        """Poll socket for reading while it is open, and for writing only while outbound data is pending"""
+        events = 0
+        if not conn.closing and not conn.eof:
+            events |= selectors.EVENT_READ
+        if conn.outbox:
+            events |= selectors.EVENT_WRITE
+
+        try:
+            key = self.selector.get_key(conn.sock)
+        except KeyError:
+            key = None
+
+        if not events:
+            if key:
+                self.selector.unregister(conn.sock)
+        elif not key:
+            self.selector.register(conn.sock, events, None)
+        elif key.events != events:
+            self.selector.modify(conn.sock, events, None)
+
+    def close_connection(self, client: socket):
+        """Forget connection. Socket is closed after pending data is sent"""
+        conn = self.registry.get(client)
+        if conn:
+            self.call_soon(self._close_connection, conn)
+
+    def _close_connection(self, conn: Connection):
+        if conn.closing:
+            return
+
+        if conn.outbox:
+            self.remove_user(conn.sock)
+            self.registry.close_later(conn)
+            self._update_events(conn)
+        else:
+            self._close(conn)
+
+    def _close(self, conn: Connection):
+        self.remove_user(conn.sock)
+        self.registry.remove(conn)
+        try:
+            self.selector.unregister(conn.sock)
+        except KeyError:
+            ...
+        conn.sock.close()
+
+    def shutdown(self):
+        super(TCPSocketServer, self).shutdown()
+        self.writer.close()
+        if self.archiver:
+            self.archiver.close()
+        if self.capture:
+            self.capture.close()
+        if self.unix_connection:
+            self.unix_connection.close()
+            if self.unix_owner:
+                remove_unix(self.unix_path)
+
+    def _key_frame(self) -> bytes:
+        """First frame of every connection - server public key, not encrypted"""
+        return pack_frame(json.dumps([self._public.n, self._public.e]).encode(settings.DEFAULT_ENCODING))
+
+    @staticmethod
+    def _shutdown_frame() -> bytes:
+        request = Request(
+            action=settings.Action.server_shutdown,
+            time=datetime.datetime.now().strftime(settings.DATE_FORMAT)
+        )
+        return pack_frame(request.json(exclude_none=True).encode(settings.DEFAULT_ENCODING))
+
     def serve(self):
+        # в режиме commit обработчик ждет записи пачки: в цикле ввода-вывода это остановило бы весь сервер
+        assert not (self.writer.durability == 'commit' and self.pipeline.kind == 'inline'), \
+            "Durability 'commit' needs handler pool 'thread' or 'process', or engine 'asyncio'"
         self.gui.console_log.emit(f'Serving at {self.host}:{self.port}')
+        if self.unix_connection:
+            self.gui.console_log.emit(f'Serving at unix:{self.unix_path}')
+        self.gui.console_log.emit(f'Storage: {self.database.storage()}')
+        self._loop_thread = threading.get_ident()
+        by_fd = self.registry.by_fd
 
-        write = []
-        while True:
-            try:
-                write: List[socket]
-                read, write, _ = select(self.connected, self.connected, [])
-                
-                for sock in read:
-                    if sock is self.connection:
-                        self.accept_connection()
-                    else:
-                        self.handle_request(sock, write)
-                        
-            # KeyboardInterrupt возбуждается по CTRL + C, добавил обработку для корректного завершения и отправки
-            # клиентам сигнала о том, что сервер недоступен
-            except KeyboardInterrupt:
-                for sock in write:
-                    if sock is self.connection:
+        try:
+            while True:
+                # цикл просыпается к ближайшему сроку проверки простоя, без соединений - спит до события
+                deadline = self.registry.next_deadline()
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+
+                for key, events in self.selector.select(timeout):
+
+                    # служебные сокеты (прием соединений, маршрутизация между процессами) регистрируются
+                    # вместе с обработчиком
+                    if key.data:
+                        key.data()
                         continue
-                    request = Request(
-                        action=settings.Action.server_shutdown,
-                        time=datetime.datetime.now().strftime(settings.DATE_FORMAT)
-                    )
-                    try:
-                        sock.send(request.json(exclude_none=True).encode(settings.DEFAULT_ENCODING))
-                        sock.close()
-                    except OSError:
+
+                    # сокет мог быть закрыт при обработке предыдущего события в этом же проходе
+                    conn = by_fd.get(key.fd)
+                    if conn is None or conn.sock is not key.fileobj:
                         continue
-                self.connection.shutdown(SHUT_RDWR)
-                self.shutdown()
-                break
 
-    def handle_request(self, client, writable):
-        handler = self.request_handler(client, self, writable, self.database, self._public, self._private)
-        handler.handle_request()
+                    if events & selectors.EVENT_WRITE:
+                        self.flush(conn)
+
+                    if events & selectors.EVENT_READ and not conn.closing:
+                        self._read(conn)
+
+                self._reap_idle()
+
+        # KeyboardInterrupt возбуждается по CTRL + C, добавил обработку для корректного завершения и отправки
+        # клиентам сигнала о том, что сервер недоступен
+        except KeyboardInterrupt:
+            for conn in self.registry:
+                try:
+                    conn.sock.send(self._shutdown_frame())
+                    conn.sock.close()
+                except OSError:
+                    continue
+            self.pipeline.shutdown()
+            self.selector.close()
+            self.connection.shutdown(SHUT_RDWR)
+            self.shutdown()
+
+
+class StreamConnection:
+    """Adapter, that gives asyncio stream the part of socket interface, used by request handler.
+    Handler works in executor thread, so writes are passed to event loop thread-safely"""
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self.writer = writer
+        self.loop = loop
+        self.peername = writer.get_extra_info('peername')
+        # дескриптор запоминаем сразу: после разрыва транспорта сокет уже закрыт, а соединение надо найти в реестре
+        self.fd = writer.get_extra_info('socket').fileno()
+
+    def sendall(self, data: bytes, limit: int = None):
+        """Write data in event loop thread
+
+        Args:
+            data (bytes): frame
+            limit (int): maximum size of write buffer, connection is aborted when it is exceeded
+        """
+        self.loop.call_soon_threadsafe(self._write, data, limit)
+
+    def _write(self, data: bytes, limit: Optional[int]):
+        transport = self.writer.transport
+        if transport.is_closing():
+            return
+        self.writer.write(data)
+        if limit and transport.get_write_buffer_size() > limit:
+            # получатель не успевает читать - отключаем его, как и движок на selectors
+            transport.abort()
+
+    def getpeername(self) -> Tuple[str, int]:
+        return self.peername
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    def abort(self):
+        self.writer.transport.abort()
+
+
+class AsyncTCPSocketServer(TCPSocketServer):
+    """Server engine on asyncio streams. Every connection is served by its own task, so there is no
+    select() over all sockets on each pass. Request handling (rsa decryption, SQLAlchemy commits) is blocking,
+    so it runs in executor - thread pool of HANDLER_POOL, or single thread if handler pool is "inline".
+    Requests of one connection are handled in order, because connection task waits for each of them"""
+
+    def __init__(self, handler, *args, **kwargs):
+        self.tasks: Set[asyncio.Task] = set()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self._stop: Optional[asyncio.Event] = None
+        super(AsyncTCPSocketServer, self).__init__(handler, *args, **kwargs)
+
+    async def run_blocking(self, func: Callable, *args) -> Any:
+        """Run blocking function (database or crypto work) in executor without blocking event loop"""
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def serve(self):
+        asyncio.run(self._serve())
+
+    def stop(self):
+        """Stop serving. Can be called from any thread"""
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._stop.set)
+
+    def send(self, client: StreamConnection, data: bytes):
+        conn = self.registry.get(client)
+        if conn:
+            frame = pack_frame(data)
+            conn.bytes_out += len(frame)
+            conn.frames_out += 1
+            client.sendall(frame, self.max_outbox_size)
+
+    def dispatch(self, client: StreamConnection, func: Callable, *args):
+        # обработчик уже выполняется в executor
+        func(*args)
+
+    def stop_reading(self, client: StreamConnection):
+        ...
+
+    def close_connection(self, client: StreamConnection):
+        conn = self.registry.get(client)
+        if conn:
+            self.remove_user(client)
+            self.registry.remove(conn)
+        client.close()
+
+    def _abort(self, conn: Connection):
+        # чтение в задаче соединения вернет b'', и обработчик закроет соединение
+        conn.sock.abort()
+
+    def _probe(self, conn: Connection):
+        self.loop.run_in_executor(self.executor, conn.session.probe)
+
+    async def _watch_idle(self):
+        while True:
+            deadline = self.registry.next_deadline()
+            delay = self.registry.probe_interval if deadline is None else max(0.0, deadline - time.monotonic())
+            await asyncio.sleep(delay)
+            self._reap_idle()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = self.pipeline.executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='handler')
+        self._stop = asyncio.Event()
+
+        self.selector.close()
+        if self.router:
+            self.loop.add_reader(self.router.connection, self.router.receive)
+        servers = [await asyncio.start_server(self.handle_connection, sock=self.connection)]
+        if self.unix_connection:
+            servers.append(await asyncio.start_unix_server(self.handle_connection, sock=self.unix_connection))
+        watcher = asyncio.create_task(self._watch_idle()) if self.registry.probe_interval else None
+        self.gui.console_log.emit(f'Serving at {self.host}:{self.port} (asyncio)')
+        if self.unix_connection:
+            self.gui.console_log.emit(f'Serving at unix:{self.unix_path} (asyncio)')
+        self.gui.console_log.emit(f'Storage: {self.database.storage()}')
+
+        try:
+            await self._stop.wait()
+        finally:
+            if watcher:
+                watcher.cancel()
+            for server in servers:
+                server.close()
+            for conn in self.registry:
+                conn.sock.writer.write(self._shutdown_frame())
+                conn.sock.writer.close()
+
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            for server in servers:
+                await server.wait_closed()
+            if self.router:
+                self.loop.remove_reader(self.router.connection)
+            self.executor.shutdown(wait=True)
+            self.pipeline.shutdown()
+            self.shutdown()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+
+        client = StreamConnection(writer, self.loop)
+        client.peername = self.peer_address(client.peername, client.fd)
+        conn = self.registry.add(client, client.peername)
+        handler = conn.session = self.request_handler(client, self, self.database, self._private, client.peername)
+        writer.write(self._key_frame())
+        self.gui.console_log.emit(f"{client.peername[0]} connected")
+
+        try:
+            while not handler.closed:
+                try:
+                    data = await reader.read(self.buffer_size)
+                except ConnectionError:
+                    data = b''
+
+                if data:
+                    conn.touch()
+                conn.bytes_in += len(data)
+                conn.frames_in += await self.run_blocking(handler.handle_data, data)
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    ...
+        except asyncio.CancelledError:
+            # задачи отменяются только при остановке сервера, клиенты уже получили server_shutdown
+            ...
+        finally:
+            self.tasks.discard(task)
+            if not handler.closed and not self._stop.is_set():
+                await self.run_blocking(handler.handle_data, b'')
+
+
+engines = {
+    'select': TCPSocketServer,
+    'asyncio': AsyncTCPSocketServer,
+}
+
+
+def get_server_class() -> type:
+    """Server engine, selected in config (SERVER_ENGINE)"""
+    return engines[settings.SERVER_ENGINE]
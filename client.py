@@ -2,18 +2,23 @@ import json
 from collections import deque
 from datetime import datetime
 from queue import Queue
+from socket import AF_UNIX
 from time import sleep
-from typing import Optional, Callable, Dict, Tuple
+from typing import Optional, Callable, Dict, Tuple, Union
 
 import rsa
-from cryptography.fernet import Fernet
+from cryptography.fernet import InvalidToken
 
 from base import BaseTCPSocket
+from common import crypto, compression
 from common.config import settings
+from common.framing import FrameBuffer, pack_frame
+from common.keystore import client_keys
+from common.utils import unix_address
 from databases import ClientDatabase
 from decorators import log
 from exceptions import AlreadyExist
-from templates.templates import Request, User, Message
+from templates.templates import Request, User, Message, Page, JsonCodec, BinaryCodec, JSON, JSON_UTF8, codecs, decode
 
 
 class TCPSocketClient(BaseTCPSocket):
@@ -33,22 +38,38 @@ class TCPSocketClient(BaseTCPSocket):
             host: str = None,
             port: int = None,
             buffer: int = None,
-            connect: bool = False
+            connect: bool = False,
+            unix_path: str = None,
+            profile: str = None
     ):
+        """
+        Args:
+            unix_path (str): connect to server on the same host through unix socket ('@name' - abstract namespace)
+                instead of host and port
+            profile (str): keep client keypair in profile with this name and reuse it on next start.
+                Without profile keypair is taken from pool of pre-generated keys
+        """
+        self.unix_path = unix_path
+        if unix_path:
+            self.address_family = AF_UNIX
 
         super(TCPSocketClient, self).__init__(host, port, buffer)
-        self.__pubkey, self.__privkey = self.__generate_keys()
+        self.__pubkey, self.__privkey = self.__generate_keys(profile)
         self.db: Optional[ClientDatabase] = None
         self.contacts_fetch = False
         self.messages_fetch = False
         self.auth_error = False
         self.server_key: Optional[rsa.PublicKey] = None
+        self.session: Optional[Union[crypto.SessionCipher, crypto.AEADCipher]] = None
+        self.codec: Union[JsonCodec, BinaryCodec] = JSON
+        self.compressor: Optional[compression.Compressor] = None
+        self.frames = FrameBuffer()
         if connect:
             self.connect()
 
     @staticmethod
-    def __generate_keys() -> Tuple[rsa.PublicKey, rsa.PrivateKey]:
-        return rsa.newkeys(512, poolsize=16)
+    def __generate_keys(profile: str = None) -> Tuple[rsa.PublicKey, rsa.PrivateKey]:
+        return client_keys(profile)
 
     def get_handler(self, action) -> Callable:
         methods = {
@@ -59,7 +80,11 @@ class TCPSocketClient(BaseTCPSocket):
             settings.Action.messages: self._get_history,
             settings.Action.msg: self._message,
             settings.Action.search: self._find_contact,
-            settings.Action.add_chat: self._add_contact
+            settings.Action.add_chat: self._add_contact,
+            settings.Action.probe: self._probe,
+            settings.Action.join: self._join,
+            settings.Action.leave: self._leave,
+            settings.Action.rekey: self._rekey
         }
         return methods.get(action, None)
 
@@ -71,22 +96,36 @@ class TCPSocketClient(BaseTCPSocket):
             if not data:
                 continue
 
-            try:
-                received = self._decrypt(data)
-            except rsa.pkcs1.DecryptionError:
-                continue
+            for frame in self.frames.feed(data):
+                self._handle_frame(frame)
 
-            request: Request = Request.parse_raw(received)
+    def _handle_frame(self, data: bytes):
+        try:
+            received = self._decrypt(data)
+        except rsa.pkcs1.DecryptionError:
+            return
 
-            if request.status == settings.Status.unauthorized:
-                self.is_connected = False
-                self._connect()
-                self._authorization_error()
-            else:
-                handler = self.get_handler(request.action)
-                assert handler, 'Action not allowed'
+        request: Request = decode(received)
+
+        if request.status == settings.Status.unauthorized:
+            self.is_connected = False
+            self._connect()
+            self._authorization_error()
+        else:
+            handler = self.get_handler(request.action)
+            assert handler, 'Action not allowed'
+
+            handler(request)
 
-                handler(request)
+    def _read_frame(self) -> bytes:
+        """Blocking read of exactly one frame. Used only before receiving thread is started"""
+        while True:
+            data = self.connection.recv(self.buffer_size)
+            if not data:
+                raise ConnectionError('Connection closed by server')
+            frames = self.frames.feed(data)
+            if frames:
+                return frames[0]
 
     def _authorization_error(self):
         self.auth_error = True
@@ -103,57 +142,95 @@ class TCPSocketClient(BaseTCPSocket):
 
     def connect(self):
         try:
-            self.connection.connect((self.host, self.port))
+            self.connection.connect(unix_address(self.unix_path) if self.unix_path else (self.host, self.port))
         except Exception as e:
             raise e
         else:
-            key = json.loads(self.connection.recv(self.buffer_size).decode(settings.DEFAULT_ENCODING))
+            self.frames = FrameBuffer()
+            self.session = None
+            self.codec = JSON
+            self.compressor = None
+            key = json.loads(self._read_frame().decode(settings.DEFAULT_ENCODING))
             self.server_key = rsa.PublicKey(*key)
             self.is_connected = True
             self.presence()
 
     def _decrypt(self, request: bytes) -> bytes:
-        length = 64  # length of fernet key, encoded with rsa
-        decoded_key, payload = request[:length], request[length:]
-
-        cipher = rsa.decrypt(decoded_key, self.__privkey)
-
-        cipher_key = Fernet(cipher)
-        data = cipher_key.decrypt(payload)
-        return data
+        if self.session:
+            try:
+                data = self.session.decrypt(request)
+            except InvalidToken:
+                ...
+            else:
+                return self.compressor.decompress(data) if self.compressor else data
+        return crypto.decrypt(request, self.__privkey)
 
     def _encrypt(self, request: Request) -> bytes:
-
-        cipher = Fernet.generate_key()
-        cipher_key = Fernet(cipher)
-
-        encoded_data = cipher_key.encrypt(
-            request.json(exclude_none=True, ensure_ascii=False).encode(settings.DEFAULT_ENCODING)
-        )
-        encoded_key = rsa.encrypt(cipher, self.server_key)
-
-        return encoded_key + encoded_data
+        data = self.codec.encode(request)
+        if self.session:
+            if self.compressor:
+                data = self.compressor.compress(data)
+            return self.session.encrypt(data)
+        return crypto.encrypt(data, self.server_key)
 
     def send_request(self, request: Request):
-        self.connection.send(self._encrypt(request))
+        self.connection.sendall(pack_frame(self._encrypt(request)))
 
     def presence(self):
 
         request = Request(
             action=settings.Action.presence,
             time=datetime.now().strftime(settings.DATE_FORMAT),
+            features=[
+                *(['session', *crypto.AEADCipher.ALGORITHMS, *compression.offer()]
+                  if settings.SESSION['enabled'] else []),
+                *(x for x in codecs if x != JSON.name)
+            ],
             data=[self.__pubkey.n, self.__pubkey.e]
         )
         self.send_request(request)
 
     def _presence(self, request: Request):
         if request.status == settings.Status.ok:
+            features = request.features or ()
+            if 'session' in features:
+                cipher = next((x for x in features if x in crypto.AEADCipher.ALGORITHMS), None)
+                self.session = crypto.session_cipher(cipher, request.data.encode())
+                self.compressor = compression.negotiate(features)
+
+            codec = next((codecs[x] for x in features if x in codecs), None)
+            if codec:
+                self.codec = codec
+            elif self.session and self.session.encoding == 'utf-8':
+                self.codec = JSON_UTF8
             self.gui.connected.emit()
         else:
             self.quit()
             self.shutdown()
             self.is_connected = False
 
+    def _probe(self, request: Request):
+        """Server checks, if connection is alive - answer it"""
+        if request.type != 'request':
+            return
+
+        response = Request(
+            action=settings.Action.probe,
+            time=datetime.now().strftime(settings.DATE_FORMAT),
+            type='response'
+        )
+        self.send_request(response)
+
+    def _rekey(self, request: Request):
+        """Server changes session key - switch to it and confirm with message, encrypted with the new key"""
+        self.session.accept(request.data.encode())
+        response = Request(
+            action=settings.Action.rekey,
+            time=datetime.now().strftime(settings.DATE_FORMAT),
+            type='response'
+        )
+        self.send_request(response)
+
     def _register(self, request: Request):
         self.gui.user_register_error.emit(request.data)
 
@@ -196,16 +273,36 @@ class TCPSocketClient(BaseTCPSocket):
         self.contacts_fetch = True
 
     def get_history(self):
+        """History is received by pages, every page is acknowledged, so server marks it delivered"""
         request = Request(
             action=settings.Action.messages,
             time=datetime.now().strftime(settings.DATE_FORMAT),
-            user=self.user
+            user=self.user,
+            data=Page(limit=settings.HISTORY['page_size'])
         )
         self.send_request(request)
 
     def _get_history(self, request: Request):
-        self.db.save_messages(request)
-        self.messages_fetch = True
+        page = request.data
+        if not isinstance(page, Page):
+            self.db.save_messages(page)
+            self.messages_fetch = True
+            return
+
+        if page.messages:
+            self.db.save_messages(page.messages)
+            ack = Request(
+                action=settings.Action.messages,
+                time=datetime.now().strftime(settings.DATE_FORMAT),
+                type='response',
+                user=self.user,
+                data=Page(cursor=page.cursor, limit=page.limit)
+            )
+            self.send_request(ack)
+
+        # неполная страница - последняя, ответ на ее подтверждение (пустую страницу) ждать не нужно
+        if len(page.messages) < page.limit:
+            self.messages_fetch = True
 
     def get_server_data(self):
         if self.auth_error:
@@ -316,9 +413,53 @@ class TCPSocketClient(BaseTCPSocket):
         self.chat.get(recipient)['was_read'].append(request)
 
     def _message(self, request: Request):
+        if request.type == 'response':
+            # ответ сервера на свое сообщение приходит только при ошибке (например, отправитель не в комнате)
+            return
 
         self.save_message(request, 'inbox')
-        contact = self.chat.get(request.user.login, None)
+
+        # сообщения комнаты показываются в чате комнаты, а не отправителя
+        chat = request.data.to if request.data.to.startswith('#') else request.user.login
+        contact = self.chat.get(chat)
+        if contact is None:
+            # комнаты хранятся на сервере и после перезапуска клиента известны только по первому сообщению
+            contact = self.chat[chat] = {'new': deque(), 'was_read': deque()}
+            self.gui.add_contact.emit()
 
         contact['new'].append(request)
-        self.gui.new_message.emit(request.user.login)
+        self.gui.new_message.emit(chat)
+
+    def join(self, room: str):
+        """Join group room, room name starts with #. Room is created, if not exist"""
+        request = Request(
+            action=settings.Action.join,
+            time=datetime.now().strftime(settings.DATE_FORMAT),
+            user=self.user,
+            data=room
+        )
+        self.send_request(request)
+
+    def _join(self, request: Request):
+        if request.status != settings.Status.ok:
+            return
+
+        if request.data not in self.chat.keys():
+            self.chat[request.data] = {'new': deque(), 'was_read': deque()}
+        self.gui.add_contact.emit()
+
+    def leave(self, room: str):
+        request = Request(
+            action=settings.Action.leave,
+            time=datetime.now().strftime(settings.DATE_FORMAT),
+            user=self.user,
+            data=room
+        )
+        self.send_request(request)
+
+    def _leave(self, request: Request):
+        if request.status != settings.Status.ok:
+            return
+
+        self.chat.pop(request.data, None)
+        self.gui.add_contact.emit()
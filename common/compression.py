@@ -0,0 +1,219 @@
+import datetime
+import sys
+import threading
+import zlib
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from common.config import settings
+from common.framing import FrameBuffer, pack_frame
+from templates.templates import Request, Message, User, Page, JSON, BINARY, decode
+
+"""Сжатие полезной нагрузки. Истории сообщений и списки контактов - это сотни одинаковых объектов с одними и теми же
+ключами, и zlib с заранее обученным словарем сжимает их в разы даже в коротких кадрах. Сжатие согласуется при
+presence вместе с сессионным ключом: клиент предлагает словари, которые у него есть ('zlib:<id словаря>', 'zlib' -
+без словаря), сервер выбирает общий. Сжимается сериализованный запрос перед шифрованием, кадры меньше порога
+отправляются как есть. Сжатый кадр узнается по заголовку zlib (первый байт 'x'), JSON начинается с '{',
+бинарный формат - с номера версии, поэтому отдельный флаг не нужен.
+
+Словарь строится из записанного трафика: при заданном COMPRESSION.capture сервер пишет в файл сериализованные
+ответы с историей, контактами и результатами поиска (кадрами, до сжатия и шифрования), затем
+python -m common.compression train <файлы> собирает словарь. Файл записи содержит логины и тексты сообщений
+пользователей: его нельзя хранить вместе с кодом и нужно удалить после обучения. Перед обучением все значения
+в записанных ответах заменяются заглушками (scrub), поэтому в словарь попадает только структура ответов"""
+
+ROOT = Path(__file__).resolve().parent.parent
+NAME = 'zlib'
+PLACEHOLDER_DATE = datetime.datetime(2000, 1, 1).strftime(settings.DATE_FORMAT)
+
+
+class Compressor:
+
+    def __init__(self, dictionary: bytes = b'', threshold: int = None, level: int = None):
+        """
+        Args:
+            dictionary (bytes): preset dictionary, both sides must have the same one
+            threshold (int): payloads shorter than this are not compressed
+            level (int): zlib compression level
+        """
+        self.dictionary = dictionary
+        self.threshold = settings.COMPRESSION['threshold'] if threshold is None else threshold
+        self.level = settings.COMPRESSION['level'] if level is None else level
+        self.feature = f'{NAME}:{zlib.adler32(dictionary):08x}' if dictionary else NAME
+
+    def compress(self, data: bytes) -> bytes:
+        if len(data) < self.threshold:
+            return data
+
+        if self.dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(self.level)
+        compressed = compressor.compress(data) + compressor.flush()
+        return compressed if len(compressed) < len(data) else data
+
+    def decompress(self, data: bytes) -> bytes:
+        """Payload as it was before {compress}. Not compressed payload is returned as is"""
+        if data[:1] != b'x':
+            return data
+
+        decompressor = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+        try:
+            # размер распакованного кадра ограничен так же, как размер принятого
+            result = decompressor.decompress(data, settings.MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise AssertionError(f'Invalid compressed frame: {e}')
+        assert decompressor.eof and not decompressor.unconsumed_tail, 'Invalid compressed frame'
+        return result
+
+
+@lru_cache(maxsize=None)
+def load(path: str = None) -> Compressor:
+    """Compressor with dictionary from file. Without dictionary file payloads are compressed with plain zlib"""
+    path = ROOT / (path or settings.COMPRESSION['dictionary'])
+    return Compressor(path.read_bytes() if path.is_file() else b'')
+
+
+def offer() -> List[str]:
+    """Compression features of client"""
+    if not settings.COMPRESSION['enabled']:
+        return []
+    return list(dict.fromkeys((load().feature, NAME)))
+
+
+def negotiate(features: Iterable[str]) -> Optional[Compressor]:
+    """Compressor for client: own dictionary, if client has the same one, else plain zlib, if client supports it"""
+    if not settings.COMPRESSION['enabled']:
+        return None
+
+    compressor = load()
+    if compressor.feature in features:
+        return compressor
+    if NAME in features:
+        return Compressor()
+    return None
+
+
+class Capture:
+    """Writes serialized payloads into file for building of dictionary. Only responses from {ACTIONS} are written:
+    they are what is compressed, and they carry no session keys and tokens. Messages and logins are in them,
+    so capture file is sensitive data"""
+
+    ACTIONS = (settings.Action.messages, settings.Action.contacts, settings.Action.search)
+
+    def __init__(self, path: str):
+        self.path = ROOT / path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'ab')
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes):
+        with self._lock:
+            self._file.write(pack_frame(data))
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _blank(value):
+    if isinstance(value, Message):
+        return value.copy(update={
+            'to': '', 'from_': '', 'message': '', 'date': PLACEHOLDER_DATE if value.date is not None else None
+        })
+    if isinstance(value, User):
+        return value.copy(update={
+            'id': 0 if value.id is not None else None,
+            'login': '',
+            'verbose_name': '' if value.verbose_name is not None else None,
+            'password': None,
+            'token': None
+        })
+    if isinstance(value, Page):
+        return value.copy(update={
+            'cursor': '' if value.cursor is not None else None, 'messages': [_blank(x) for x in value.messages]
+        })
+    if isinstance(value, list):
+        return [_blank(x) for x in value]
+    if isinstance(value, str):
+        return ''
+    return value
+
+
+def scrub(payload: bytes) -> bytes:
+    """Payload with every user value replaced by placeholder: dictionary must keep structure of requests only,
+    not logins, tokens and messages"""
+    request: Request = decode(payload)
+    request = request.copy(update={
+        'time': PLACEHOLDER_DATE,
+        'user': _blank(request.user) if request.user else None,
+        'data': _blank(request.data)
+    })
+    return (JSON if payload[:1] == b'{' else BINARY).encode(request)
+
+
+def read_capture(path: str) -> List[bytes]:
+    frames = FrameBuffer()
+    with open(path, 'rb') as f:
+        return frames.feed(f.read())
+
+
+def train(samples: List[bytes], size: int = 8192, gram: int = 8) -> bytes:
+    """Build preset dictionary from samples
+
+    Substrings of {gram} bytes, met in several samples, are glued into the longest common runs. Runs are scored by
+    number of samples they occur in and by length, the best ones fill the dictionary. The most valuable run is put at
+    the end: zlib finds closer matches cheaper
+
+    Args:
+        samples (List[bytes]): captured payloads
+        size (int): max size of dictionary
+        gram (int): min length of substring to be counted
+
+    Returns:
+        bytes: dictionary
+    """
+    grams = Counter()
+    for sample in samples:
+        grams.update({sample[i:i + gram] for i in range(len(sample) - gram + 1)})
+    common = {x for x, count in grams.items() if count > 1}
+
+    runs = Counter()
+    for sample in samples:
+        found, start = set(), None
+        for i in range(len(sample) - gram + 2):
+            covered = sample[i:i + gram] in common
+            if covered and start is None:
+                start = i
+            elif not covered and start is not None:
+                found.add(sample[start:i - 1 + gram])
+                start = None
+        runs.update(found)
+
+    dictionary = b''
+    for run, _ in sorted(runs.items(), key=lambda x: x[1] * len(x[0]), reverse=True):
+        if len(dictionary) + len(run) > size:
+            continue
+        if run not in dictionary:
+            dictionary = run + dictionary
+    return dictionary
+
+
+if __name__ == '__main__':
+    # python -m common.compression train <capture> [<capture> ...]
+    if sys.argv[1:2] != ['train'] or not sys.argv[2:]:
+        print('usage: python -m common.compression train <capture> [<capture> ...]')
+        sys.exit(1)
+
+    payloads = [frame for capture in sys.argv[2:] for frame in read_capture(capture)]
+    result = train([scrub(x) for x in payloads])
+    target = ROOT / settings.COMPRESSION['dictionary']
+    target.write_bytes(result)
+
+    raw = sum(len(x) for x in payloads)
+    plain, trained = Compressor(threshold=0), Compressor(result, threshold=0)
+    print(f'{target}: {len(result)} bytes, {len(payloads)} samples, {raw} bytes')
+    print(f'zlib: {sum(len(plain.compress(x)) for x in payloads)} bytes, '
+          f'with dictionary: {sum(len(trained.compress(x)) for x in payloads)} bytes')
@@ -28,6 +28,7 @@ class Settings(BaseModel):
         add_chat = 'add_chat'
         del_chat = 'del_chat'
         messages = 'messages'
+        rekey = 'rekey'
 
     def __init__(self):
         super(Settings, self).__init__()
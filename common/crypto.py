@@ -0,0 +1,187 @@
+import base64
+import os
+import struct
+import time
+from typing import List, Optional, Union, Iterable
+
+import rsa
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+from common.config import settings
+
+"""Гибридное шифрование: сообщение шифруется одноразовым ключом Fernet, а сам ключ - публичным RSA ключом получателя.
+Используется и сервером, и клиентом"""
+
+
+def encrypt(data: bytes, public_key: rsa.PublicKey) -> bytes:
+    """Encrypt message for owner of public key
+
+    Args:
+        data (bytes): serialized message
+        public_key (rsa.PublicKey): recipient key
+
+    Returns:
+        bytes: rsa encrypted fernet key + fernet token
+    """
+    cipher = Fernet.generate_key()
+    encoded_key = rsa.encrypt(cipher, public_key)
+    return encoded_key + Fernet(cipher).encrypt(data)
+
+
+def encrypt_many(data: bytes, public_keys: List[rsa.PublicKey]) -> List[bytes]:
+    """Encrypt one message for several recipients. Message is encrypted with fernet once,
+    only fernet key is encrypted for every recipient
+
+    Args:
+        data (bytes): serialized message
+        public_keys (List[rsa.PublicKey]): recipients keys
+
+    Returns:
+        List[bytes]: messages in {encrypt} format, in order of keys
+    """
+    cipher = Fernet.generate_key()
+    token = Fernet(cipher).encrypt(data)
+    return [rsa.encrypt(cipher, key) + token for key in public_keys]
+
+
+class SessionCipher:
+    """Symmetric key of one connection, agreed at presence. After that messages are encrypted without rsa.
+    Messages are encrypted with current key and decrypted with current or previous one: while keys are changed,
+    frames encrypted with the old key may still be on the way"""
+
+    name = 'fernet'
+    encoding = settings.DEFAULT_ENCODING
+
+    def __init__(self, key: bytes = None):
+        self.key = key or Fernet.generate_key()
+        self.pending: Optional[bytes] = None
+        self.keyed_at = time.monotonic()
+        self._fernet = Fernet(self.key)
+        self._ring = MultiFernet([self._fernet])
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self._fernet.encrypt(data)
+
+    def decrypt(self, data: bytes) -> bytes:
+        """Raises cryptography.fernet.InvalidToken, if data is not encrypted with key of this session"""
+        return self._ring.decrypt(data)
+
+    def offer(self) -> bytes:
+        """New key, proposed by server. It is accepted for decryption at once,
+        and used for encryption only after client confirms it ({commit})"""
+        self.pending = Fernet.generate_key()
+        self._ring = MultiFernet([Fernet(self.pending), self._fernet])
+        return self.pending
+
+    def commit(self):
+        if self.pending:
+            self.accept(self.pending)
+
+    def accept(self, key: bytes):
+        """Switch to new key, previous key is still accepted for decryption"""
+        previous = self._fernet
+        self.key, self.pending = key, None
+        self.keyed_at = time.monotonic()
+        self._fernet = Fernet(key)
+        self._ring = MultiFernet([self._fernet, previous])
+
+    def age(self) -> float:
+        return time.monotonic() - self.keyed_at
+
+
+class AEADCipher:
+    """Session key with binary envelope instead of fernet token: no base64, no timestamp, payload in utf-8.
+
+    Envelope: version (1 byte), algorithm (1 byte), key id (1 byte), nonce (12 bytes), ciphertext with tag.
+    Header is authenticated together with ciphertext. Key id grows by one on every rekey, so frame is decrypted
+    with its own key without trying all of them. Interface is the same as of {SessionCipher}
+    """
+
+    VERSION = 1
+    ALGORITHMS = {'aes-gcm': (1, AESGCM), 'chacha20-poly1305': (2, ChaCha20Poly1305)}
+    HEADER = struct.Struct('!BBB')
+    NONCE_SIZE = 12
+
+    encoding = 'utf-8'
+
+    def __init__(self, name: str, key: bytes = None):
+        self.name = name
+        self.algorithm, self._aead = self.ALGORITHMS[name]
+        self.key = key or base64.urlsafe_b64encode(os.urandom(32))
+        self.key_id = 0
+        self.pending: Optional[bytes] = None
+        self.keyed_at = time.monotonic()
+        self._keys = {0: self._aead(base64.urlsafe_b64decode(self.key))}
+
+    def encrypt(self, data: bytes) -> bytes:
+        header = self.HEADER.pack(self.VERSION, self.algorithm, self.key_id)
+        nonce = os.urandom(self.NONCE_SIZE)
+        return header + nonce + self._keys[self.key_id].encrypt(nonce, data, header)
+
+    def decrypt(self, data: bytes) -> bytes:
+        """Raises cryptography.fernet.InvalidToken, as {SessionCipher}, if data is not encrypted with key of session"""
+        size = self.HEADER.size
+        if len(data) < size + self.NONCE_SIZE:
+            raise InvalidToken
+
+        version, algorithm, key_id = self.HEADER.unpack_from(data)
+        aead = self._keys.get(key_id)
+        if version != self.VERSION or algorithm != self.algorithm or aead is None:
+            raise InvalidToken
+
+        try:
+            return aead.decrypt(data[size:size + self.NONCE_SIZE], data[size + self.NONCE_SIZE:], data[:size])
+        except InvalidTag:
+            raise InvalidToken
+
+    def offer(self) -> bytes:
+        self.pending = base64.urlsafe_b64encode(os.urandom(32))
+        self._keys[(self.key_id + 1) % 256] = self._aead(base64.urlsafe_b64decode(self.pending))
+        return self.pending
+
+    def commit(self):
+        if self.pending:
+            self.accept(self.pending)
+
+    def accept(self, key: bytes):
+        previous, self.key_id = self.key_id, (self.key_id + 1) % 256
+        self.key, self.pending = key, None
+        self.keyed_at = time.monotonic()
+        self._keys = {previous: self._keys[previous], self.key_id: self._aead(base64.urlsafe_b64decode(key))}
+
+    def age(self) -> float:
+        return time.monotonic() - self.keyed_at
+
+
+def negotiate(features: Iterable[str]) -> str:
+    """Session cipher: first of configured ciphers, supported by client. Fernet is supported by every client,
+    that supports session key"""
+    for name in settings.SESSION['ciphers']:
+        if name == SessionCipher.name or name in features:
+            return name
+    return SessionCipher.name
+
+
+def session_cipher(name: str = None, key: bytes = None) -> Union[SessionCipher, AEADCipher]:
+    if name in AEADCipher.ALGORITHMS:
+        return AEADCipher(name, key)
+    return SessionCipher(key)
+
+
+def decrypt(data: bytes, private_key: rsa.PrivateKey) -> bytes:
+    """Decrypt message, encrypted with {encrypt}
+
+    Args:
+        data (bytes): rsa encrypted fernet key + fernet token
+        private_key (rsa.PrivateKey): own private key
+
+    Returns:
+        bytes: serialized message
+    """
+    length = rsa.common.byte_size(private_key.n)  # length of fernet key, encoded with rsa
+
+    decoded_key, payload = data[:length], data[length:]
+    cipher = rsa.decrypt(decoded_key, private_key)
+    return Fernet(cipher).decrypt(payload)
@@ -0,0 +1,68 @@
+import struct
+from typing import List
+
+from common.config import settings
+from exceptions import FrameError
+
+"""Протокол поверх TCP - поток байт, а не сообщений: один recv может вернуть половину сообщения или сразу несколько.
+Поэтому каждое сообщение передается кадром: 4 байта длины (big-endian) + полезная нагрузка"""
+
+HEADER = struct.Struct('!I')
+
+
+def pack_frame(payload: bytes) -> bytes:
+    """Prepend length header to payload
+
+    Args:
+        payload (bytes): encrypted message
+
+    Returns:
+        bytes: frame ready to be sent
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameBuffer:
+    """Per-connection reassembly buffer. Collects received chunks and splits them into complete frames"""
+
+    __slots__ = ('_buffer', 'max_size')
+
+    def __init__(self, max_size: int = None):
+        self._buffer = bytearray()
+        self.max_size = max_size or settings.MAX_FRAME_SIZE
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Append received chunk and return every frame, that is complete now
+
+        Args:
+            data (bytes): chunk returned by recv
+
+        Returns:
+            List[bytes]: payloads of complete frames in order of arrival, may be empty
+        """
+        buffer = self._buffer
+        buffer += data
+
+        frames = []
+        offset = 0
+        size = len(buffer)
+        header = HEADER.size
+
+        while size - offset >= header:
+            length, = HEADER.unpack_from(buffer, offset)
+            if length > self.max_size:
+                raise FrameError(f'Frame too large: {length} bytes')
+
+            end = offset + header + length
+            if end > size:
+                break
+
+            frames.append(bytes(buffer[offset + header:end]))
+            offset = end
+
+        if offset:
+            del buffer[:offset]
+        return frames
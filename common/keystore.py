@@ -0,0 +1,146 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Tuple, Optional
+
+import rsa
+
+from common.config import settings
+
+"""Хранилище ключей сервера. Раньше пара ключей генерировалась при каждом запуске: это долго (генерация на чистом
+Python в пуле процессов), и при каждом перезапуске у сервера менялся ключ. Теперь ключ создается один раз и хранится
+в PEM файле, новый генерируется только при смене размера ключа, по истечении срока или по команде rotate.
+
+Клиенту ключ тоже не нужно генерировать при каждом запуске: он берется из профиля (свой файл для каждого логина)
+или из пула заранее сгенерированных ключей. Пул пополняется только командой python -m common.keystore pool <count>:
+генерация на чистом Python держит GIL, и фоновое пополнение в процессе клиента замедляло бы сам клиент"""
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class KeyStore:
+
+    def __init__(self, path: str = None, size: int = None, max_age_days: float = None):
+        """
+        Args:
+            path (str): private key file, relative path is counted from project directory
+            size (int): key size, bits
+            max_age_days (float): key older than this is replaced on load, 0 - never
+        """
+        self.path = ROOT / (path or settings.KEYSTORE['path'])
+        self.size = size or settings.KEYSTORE['size']
+        self.max_age_days = settings.KEYSTORE['max_age_days'] if max_age_days is None else max_age_days
+
+    def load(self) -> Tuple[rsa.PublicKey, rsa.PrivateKey]:
+        """Keypair from keystore. Generated, if there is no key yet, or it does not match settings"""
+        if self.path.exists():
+            with open(self.path, 'rb') as f:
+                private = rsa.PrivateKey.load_pkcs1(f.read())
+            if rsa.common.bit_size(private.n) == self.size and not self.expired():
+                return rsa.PublicKey(private.n, private.e), private
+
+        return self.rotate()
+
+    def expired(self) -> bool:
+        if not self.max_age_days:
+            return False
+        return time.time() - self.path.stat().st_mtime > self.max_age_days * 86400
+
+    def rotate(self) -> Tuple[rsa.PublicKey, rsa.PrivateKey]:
+        """Generate new keypair. Previous key is kept in file with '.prev' suffix"""
+        public, private = rsa.newkeys(self.size, poolsize=16)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(private.save_pkcs1())
+
+        # файл подменяется атомарно: одновременно запущенные процессы не прочитают недописанный ключ
+        if self.path.exists():
+            os.replace(self.path, self.path.with_name(f'{self.path.name}.prev'))
+        os.replace(tmp, self.path)
+        return public, private
+
+
+class KeyPool:
+    """Directory of pre-generated client keypairs, one PEM file per pair.
+    Key is claimed by atomic rename, so every key is given to one client only, even if clients start simultaneously"""
+
+    def __init__(self, path: str = None, size: int = None, pool_size: int = None):
+        self.path = ROOT / (path or settings.CLIENT_KEYS['pool'])
+        self.size = size or settings.CLIENT_KEYS['size']
+        self.pool_size = pool_size or settings.CLIENT_KEYS['pool_size']
+
+    def __len__(self) -> int:
+        if not self.path.exists():
+            return 0
+        return sum(1 for x in os.scandir(self.path) if x.name.endswith('.pem'))
+
+    def take(self) -> Optional[Tuple[rsa.PublicKey, rsa.PrivateKey]]:
+        """Claim key from pool. None if pool is empty"""
+        if not self.path.exists():
+            return None
+
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.pem'):
+                continue
+
+            claimed = self.path / f'{entry.name}.{os.getpid()}.{threading.get_ident()}.taken'
+            try:
+                os.rename(entry.path, claimed)
+            except FileNotFoundError:
+                # ключ уже забрал другой клиент
+                continue
+
+            with open(claimed, 'rb') as f:
+                private = rsa.PrivateKey.load_pkcs1(f.read())
+            os.unlink(claimed)
+            if rsa.common.bit_size(private.n) == self.size:
+                return rsa.PublicKey(private.n, private.e), private
+        return None
+
+    def fill(self, count: int = None) -> int:
+        """Generate keys, until there are {count} keys in pool. Pool is counted before every key: fills, running at
+        the same time, generate at most one extra key each
+
+        Returns:
+            int: number of generated keys
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        generated = 0
+        while len(self) < (count or self.pool_size):
+            _, private = rsa.newkeys(self.size)
+            name = uuid.uuid4().hex
+            tmp = self.path / f'{name}.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(private.save_pkcs1())
+            os.replace(tmp, self.path / f'{name}.pem')
+            generated += 1
+        return generated
+
+
+def client_keys(profile: str = None) -> Tuple[rsa.PublicKey, rsa.PrivateKey]:
+    """Keypair of client: from profile, if it is given, otherwise from pool of pre-generated keys.
+    Key is generated on the spot only for new profile or if pool is empty"""
+    if profile:
+        return KeyStore(f"{settings.CLIENT_KEYS['profiles']}/{profile}.pem", settings.CLIENT_KEYS['size'], 0).load()
+
+    pool = KeyPool()
+    return pool.take() or rsa.newkeys(pool.size, poolsize=16)
+
+
+if __name__ == '__main__':
+    # python -m common.keystore [rotate | pool <count>]
+    if sys.argv[1:2] == ['pool']:
+        key_pool = KeyPool()
+        generated = key_pool.fill(int(sys.argv[2]) if sys.argv[2:] else None)
+        print(f'{key_pool.path}: {len(key_pool)} keys, {generated} generated')
+    else:
+        store = KeyStore()
+        key, _ = store.rotate() if sys.argv[1:] == ['rotate'] else store.load()
+        print(f'{store.path}: {store.size} bits, n={hex(key.n)[:18]}...')
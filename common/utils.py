@@ -1,3 +1,8 @@
+import base64
+import binascii
+import datetime
+from typing import Optional, Union
+
 from common.config import settings
 import hashlib
 
@@ -44,3 +49,32 @@ def get_cmd_arguments(cmd_line_args: list) -> tuple:
 
     bind_host, bind_port = arguments['-h'], int(arguments['-p'])
     return bind_host, bind_port
+
+
+def unix_address(path: str) -> Union[str, bytes]:
+    """Address of unix socket. Path, starting with '@', is a name in abstract namespace (Linux) - no file is created"""
+    if path.startswith('@'):
+        return '\0' + path[1:]
+    return path
+
+
+def encode_cursor(position: int) -> str:
+    """Opaque cursor of history page: client only returns it back"""
+    return base64.urlsafe_b64encode(position.to_bytes(8, 'big')).decode().rstrip('=')
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    """Date of message in DATE_FORMAT, None if it is missing or invalid"""
+    try:
+        return datetime.datetime.strptime(value, settings.DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    except (binascii.Error, ValueError):
+        raw = b''
+    assert len(raw) == 8, 'Invalid cursor'
+    return int.from_bytes(raw, 'big')
@@ -0,0 +1,214 @@
+import datetime
+import fcntl
+import gzip
+import json
+import os
+import sys
+from contextlib import contextmanager
+from itertools import groupby
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+from sqlalchemy import func, delete, or_
+from sqlalchemy.orm import Session
+
+from common.config import settings
+from database.server_models import MessageHistory, ArchiveChunk
+
+"""Архив сообщений. Доставленные сообщения старше ARCHIVE.max_age_days переносятся из таблицы messages в сжатые
+файлы по дням: <path>/<год>/<месяц>/<дата>.jsonl.gz, по строке JSON на сообщение. Таблица и ее индексы перестают
+расти вместе с историей, в них остаются только недоставленные и свежие сообщения.
+
+Каждая пачка архивации дописывает в файл дня по gzip-члену на переписку двух пользователей (файл целиком читается
+zcat), а в таблицу archive_chunks - позицию, длину и участников каждого. Запись в таблицу и удаление строк из messages
+выполняются одной транзакцией после записи файла, поэтому архив - это только части, перечисленные в archive_chunks:
+хвост файла, записанный перед падением, отрезается следующей записью. Чтение за период распаковывает только части
+за нужные дни, в которых пользователь - участник.
+
+Архивирует один процесс за раз (flock файла .lock в каталоге архива), остальные воркеры пропускают запуск"""
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class Archive:
+    """Files of archive"""
+
+    def __init__(self, path: str = None, level: int = None):
+        """
+        Args:
+            path (str): directory of archive, relative to project
+            level (int): gzip compression level
+        """
+        config = settings.ARCHIVE
+        self.path = ROOT / (path or config['path'])
+        self.level = config['level'] if level is None else level
+
+    @contextmanager
+    def locked(self) -> Iterator[bool]:
+        """Exclusive right to archive. False, if another process is archiving now"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / '.lock', 'a+b') as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def name(day: datetime.date) -> str:
+        return f'{day:%Y}/{day:%m}/{day:%Y-%m-%d}.jsonl.gz'
+
+    def write(self, name: str, end: int, members: List[List[dict]]) -> List[int]:
+        """Append rows to file, every list of rows as separate gzip member
+
+        Args:
+            name (str): file, relative to archive
+            end (int): end of the last member, that is in index - everything after it is cut off
+            members (List[List[dict]]): messages
+
+        Returns:
+            List[int]: lengths of written members, the first one starts at {end}
+        """
+        target = self.path / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        data = [gzip.compress(''.join(
+            json.dumps(x, ensure_ascii=False, separators=(',', ':')) + '\n' for x in rows
+        ).encode('utf-8'), self.level) for rows in members]
+
+        with open(target, 'ab') as f:
+            f.truncate(end)
+            f.write(b''.join(data))
+            f.flush()
+            os.fsync(f.fileno())
+        return [len(x) for x in data]
+
+    def read(self, name: str, offset: int, length: int) -> List[dict]:
+        with open(self.path / name, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return [json.loads(x) for x in gzip.decompress(data).decode('utf-8').splitlines()]
+
+
+def _members(row) -> Tuple[int, int]:
+    # id удаленного пользователя - NULL, такой участник записывается как 0
+    low, high = sorted((row.sender_id or 0, row.recipient_id or 0))
+    return low, high
+
+
+def archive_messages(db: Session, archive: Archive, before: datetime.datetime, batch: int = None) -> int:
+    """Move one batch of delivered messages older than {before} into archive
+
+    Returns:
+        int: number of archived messages, 0 - nothing to archive or another process is archiving
+    """
+    with archive.locked() as locked:
+        if not locked:
+            return 0
+
+        rows = db.query(
+            MessageHistory.id, MessageHistory.sender_id, MessageHistory.recipient_id,
+            MessageHistory.date, MessageHistory.content
+        ).filter(
+            MessageHistory.sent.is_(True),
+            MessageHistory.date < before
+        ).order_by(MessageHistory.id).limit(batch or settings.ARCHIVE['batch']).all()
+        if not rows:
+            return 0
+
+        try:
+            for day, items in groupby(sorted(rows, key=lambda x: (x.date.date(), _members(x), x.id)),
+                                      key=lambda x: x.date.date()):
+                chats = [(members, list(chat)) for members, chat in groupby(items, key=_members)]
+                name = archive.name(day)
+                end = db.query(func.max(ArchiveChunk.offset + ArchiveChunk.length)).filter(
+                    ArchiveChunk.path == name
+                ).scalar() or 0
+                lengths = archive.write(name, end, [[{
+                    'id': x.id,
+                    'from': x.sender_id,
+                    'to': x.recipient_id,
+                    'date': x.date.isoformat(sep=' '),
+                    'message': x.content
+                } for x in chat] for _, chat in chats])
+
+                for ((low, high), chat), length in zip(chats, lengths):
+                    db.add(ArchiveChunk(
+                        day=day,
+                        path=name,
+                        offset=end,
+                        length=length,
+                        first_id=chat[0].id,
+                        last_id=chat[-1].id,
+                        count=len(chat),
+                        created_at=datetime.datetime.now(),
+                        low_id=low,
+                        high_id=high
+                    ))
+                    end += length
+
+            db.execute(delete(MessageHistory).where(MessageHistory.id.in_([x.id for x in rows])))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return len(rows)
+
+
+def read_messages(
+        db: Session,
+        archive: Archive,
+        user_id: int,
+        start: datetime.datetime,
+        end: datetime.datetime
+) -> List[dict]:
+    """Archived messages, sent or received by user from {start} till {end}, oldest first"""
+    chunks = db.query(ArchiveChunk.path, ArchiveChunk.offset, ArchiveChunk.length).filter(
+        or_(ArchiveChunk.low_id == user_id, ArchiveChunk.high_id == user_id),
+        ArchiveChunk.day >= start.date(),
+        ArchiveChunk.day <= end.date()
+    ).order_by(ArchiveChunk.day, ArchiveChunk.first_id).all()
+
+    result = []
+    for chunk in chunks:
+        for row in archive.read(*chunk):
+            row['date'] = datetime.datetime.fromisoformat(row['date'])
+            if start <= row['date'] < end:
+                result.append(row)
+    return sorted(result, key=lambda x: (x['date'], x['id']))
+
+
+def live_messages(db: Session, user_id: int, start: datetime.datetime, end: datetime.datetime) -> List[dict]:
+    """Messages of user from {start} till {end}, that are still in table messages"""
+    rows = db.query(
+        MessageHistory.id, MessageHistory.sender_id, MessageHistory.recipient_id,
+        MessageHistory.date, MessageHistory.content
+    ).filter(
+        or_(MessageHistory.sender_id == user_id, MessageHistory.recipient_id == user_id),
+        MessageHistory.date >= start,
+        MessageHistory.date < end
+    ).all()
+    return [{'id': x.id, 'from': x.sender_id, 'to': x.recipient_id, 'date': x.date, 'message': x.content}
+            for x in rows]
+
+
+if __name__ == '__main__':
+    # python -m database.archive [status] - архивировать старые сообщения сейчас или показать размер архива
+    from databases import ServerDatabase
+
+    database = ServerDatabase()
+    if sys.argv[1:] == ['status']:
+        session = database._db
+        chunks, archived = session.query(func.count(ArchiveChunk.id), func.sum(ArchiveChunk.count)).one()
+        live = session.query(func.count(MessageHistory.id)).scalar()
+        print(f'messages: {live}, archived: {archived or 0} in {chunks} chunks, {database.archive.path}')
+    else:
+        moment = datetime.datetime.now() - datetime.timedelta(days=settings.ARCHIVE['max_age_days'])
+        total = count = database.archive_messages(moment)
+        while count:
+            count = database.archive_messages(moment)
+            total += count
+        print(f'{total} messages archived into {database.archive.path}')
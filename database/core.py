@@ -1,13 +1,51 @@
 import json
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Dict, Union
 
 from pydantic import BaseModel
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine import Engine
 
 from common.config import settings
 
+"""Профили хранения SQLite (SQLITE_PROFILES в config.json): режим журнала, синхронизация с диском, кэш страниц и т.д.
+Выставляются PRAGMA при каждом новом соединении. Профиль выбирается полем profile описания базы:
+durable - WAL и синхронизация на каждую транзакцию, throughput - WAL без fsync на каждый commit (последние транзакции
+могут потеряться при отключении питания, но не при падении процесса), bench - без гарантий, только для измерений"""
+
+PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store', 'busy_timeout')
+SYNCHRONOUS = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+TEMP_STORE = {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'}
+
+
+def apply_pragmas(profile: Dict[str, Union[str, int]], connection, _):
+    """connect event handler: configure new sqlite connection"""
+    cursor = connection.cursor()
+    for name in PRAGMAS:
+        if name in profile:
+            cursor.execute(f'PRAGMA {name} = {profile[name]}')
+    cursor.close()
+
+
+def sqlite_settings(engine: Engine) -> Dict[str, Union[str, int]]:
+    """Values, that are really active in connection of engine"""
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        result = {}
+        for name in PRAGMAS:
+            # у базы в памяти нет, например, mmap_size - такая PRAGMA ничего не возвращает
+            row = cursor.execute(f'PRAGMA {name}').fetchone()
+            result[name] = row[0] if row else None
+        cursor.close()
+    finally:
+        connection.close()
+
+    result['synchronous'] = SYNCHRONOUS.get(result['synchronous'], result['synchronous'])
+    result['temp_store'] = TEMP_STORE.get(result['temp_store'], result['temp_store'])
+    return result
+
 
 class DatabaseFactory:
 
@@ -19,6 +57,7 @@ class DatabaseFactory:
         host: Optional[str]
         port: Optional[str]
         name: str
+        profile: Optional[str]
 
         def get_src(self, client: str = None) -> str:
             if client:
@@ -47,6 +86,15 @@ class DatabaseFactory:
         with open(f'{path}/config.json', 'r', encoding='utf-8') as f:
             databases = json.load(f)
         self.__creds = self.Database.parse_obj(databases[self.kind][self.__name])
+        self.__profiles = databases.get('SQLITE_PROFILES', {})
+
+    @property
+    def dialect(self) -> str:
+        return self.__creds.dialect
+
+    @property
+    def profile(self) -> Optional[str]:
+        return self.__creds.profile if self.__creds.dialect == 'sqlite' else None
 
     def get_engine(self) -> Engine:
         """
@@ -54,5 +102,9 @@ class DatabaseFactory:
         :return: Engine
         """
         if self.__creds.dialect == 'sqlite':
-            return create_engine(self.__creds.get_src(self.__client), connect_args={"check_same_thread": False})
+            engine = create_engine(self.__creds.get_src(self.__client), connect_args={"check_same_thread": False})
+            if self.profile:
+                assert self.profile in self.__profiles, f'Unknown storage profile: {self.profile}'
+                event.listen(engine, 'connect', partial(apply_pragmas, self.__profiles[self.profile]))
+            return engine
         return create_engine(self.__creds.get_src())
@@ -0,0 +1,363 @@
+import fcntl
+import mmap
+import os
+import resource
+import struct
+import sys
+import threading
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from common.config import settings
+from templates.templates import Message
+
+"""Журнал сообщений. Вместо строки в таблице messages с полем sent каждое сообщение дописывается в конец файлов
+получателя, а вместо sent у получателя хранится номер последнего доставленного сообщения.
+
+У каждого получателя свой каталог <path>/<id пользователя>:
+    <номер первого сообщения>.log - сегмент: записи сообщений одна за другой;
+    <номер первого сообщения>.idx - индекс сегмента: позиция каждой записи, 4 байта на сообщение;
+    delivered - номер последнего доставленного сообщения, 8 байт.
+Номера сообщений у каждого получателя свои и идут подряд с 1, поэтому позиция сообщения n берется из индекса по
+адресу (n - начало сегмента) * 4, без поиска. Когда сегмент становится больше segment_size, начинается новый.
+
+Запись - одна операция дописывания в конец сегмента и одна в конец индекса на пачку сообщений получателя, чтение
+истории - последовательный участок сегмента, отображенного в память (mmap). Запись в индекс идет после записи
+сообщений, поэтому читатель видит только записанные целиком сообщения, а оборванную при падении запись
+дописывающий процесс отрезает. Воркеры пишут в общие файлы под flock каталога получателя.
+
+Сообщение, доставленное сразу при отправке, тоже пишется в журнал, но с флагом delivered: номер доставленного
+сдвигается только подряд, а такие сообщения при чтении истории пропускаются.
+
+Журнал - очередь доставки, а не история: доставленные сообщения из него не читаются. Поэтому сегмент, все сообщения
+которого доставлены, удаляется при подтверждении доставки, активный сегмент остается всегда.
+
+У каждого открытого получателя до Partition.FILES дескрипторов (delivered, сегмент и индекс для записи, отображения
+сегментов), поэтому открытых получателей не больше partitions: вытесненный закрывает свои файлы. По умолчанию
+(partitions = 0) предел считается от RLIMIT_NOFILE так, чтобы журнал занимал не больше половины дескрипторов"""
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# длина тела, crc32 тела, флаги, длина логина отправителя, длина даты; тело - логин, дата, текст
+HEADER = struct.Struct('>IIBHB')
+POSITION = struct.Struct('>I')
+OFFSET = struct.Struct('>Q')
+DELIVERED = 1
+
+
+def encode_record(data: Message, sent: bool) -> bytes:
+    sender, date = data.from_.encode('utf-8'), data.date.encode('utf-8')
+    body = sender + date + data.message.encode('utf-8')
+    return HEADER.pack(len(body), zlib.crc32(body), DELIVERED if sent else 0, len(sender), len(date)) + body
+
+
+class Partition:
+    """Messages of one recipient"""
+
+    # отображенных в память сегментов, у каждого свой дескриптор
+    MAPS = 2
+    FILES = 3 + MAPS
+
+    def __init__(self, path: Path, segment_size: int, fsync: bool):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        path.mkdir(parents=True, exist_ok=True)
+
+        # файл delivered заодно служит блокировкой каталога между процессами. Открыт без O_APPEND: с ним pwrite
+        # пишет в конец файла
+        fd = os.open(path / 'delivered', os.O_RDWR | os.O_CREAT, 0o644)
+        self.delivered_file = os.fdopen(fd, 'r+b', buffering=0)
+        self.mutex = threading.Lock()
+        self.bases: List[int] = []
+
+        # сегмент, в который пишет этот процесс
+        self.base: Optional[int] = None
+        self.log_file = None
+        self.idx_file = None
+
+        self.maps: OrderedDict[int, mmap.mmap] = OrderedDict()
+        # число потоков, использующих получателя сейчас: занятый получатель не закрывается при вытеснении
+        self.users = 0
+
+    def _segment(self, base: int, suffix: str) -> Path:
+        return self.path / f'{base:020d}.{suffix}'
+
+    def _refresh(self) -> List[int]:
+        self.bases = sorted(int(x.stem) for x in self.path.glob('*.idx'))
+        return self.bases
+
+    @contextmanager
+    def _locked(self):
+        with self.mutex:
+            fcntl.flock(self.delivered_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.delivered_file.fileno(), fcntl.LOCK_UN)
+
+    def _open(self, base: int):
+        if self.base == base:
+            return
+        for file in (self.log_file, self.idx_file):
+            if file:
+                file.close()
+        # индекс создается последним: сегмент без индекса не виден читателям
+        self.log_file = open(self._segment(base, 'log'), 'a+b', buffering=0)
+        self.idx_file = open(self._segment(base, 'idx'), 'a+b', buffering=0)
+        self.base = base
+
+    def _end(self) -> Tuple[int, int, int]:
+        """Active segment, number of messages in it and its size. Cuts off records, written partly. Under lock"""
+        bases = self._refresh()
+        self._open(bases[-1] if bases else 1)
+
+        idx, log = self.idx_file.fileno(), self.log_file.fileno()
+        size = os.fstat(idx).st_size
+        count = size // POSITION.size
+        if size % POSITION.size:
+            os.ftruncate(idx, count * POSITION.size)
+
+        end = 0
+        if count:
+            position, = POSITION.unpack(os.pread(idx, POSITION.size, (count - 1) * POSITION.size))
+            length = HEADER.unpack(os.pread(log, HEADER.size, position))[0]
+            end = position + HEADER.size + length
+        if os.fstat(log).st_size > end:
+            os.ftruncate(log, end)
+        return self.base, count, end
+
+    def append(self, records: List[bytes]) -> int:
+        """Write encoded messages
+
+        Returns:
+            int: number of the last one
+        """
+        with self._locked():
+            base, count, end = self._end()
+            if count and end >= self.segment_size:
+                base, count, end = base + count, 0, 0
+                self._open(base)
+
+            positions = []
+            for record in records:
+                positions.append(POSITION.pack(end))
+                end += len(record)
+
+            os.write(self.log_file.fileno(), b''.join(records))
+            if self.fsync:
+                os.fsync(self.log_file.fileno())
+            os.write(self.idx_file.fileno(), b''.join(positions))
+            if self.fsync:
+                os.fsync(self.idx_file.fileno())
+        return base + count + len(records) - 1
+
+    def delivered(self) -> int:
+        data = os.pread(self.delivered_file.fileno(), OFFSET.size, 0)
+        return OFFSET.unpack(data)[0] if len(data) == OFFSET.size else 0
+
+    def ack(self, last: int) -> int:
+        """Move delivered cursor to message {last}
+
+        Returns:
+            int: number of messages, that became delivered
+        """
+        with self._locked():
+            base, count, _ = self._end()
+            last = min(last, base + count - 1)
+            delivered = self.delivered()
+            if last <= delivered:
+                return 0
+            os.pwrite(self.delivered_file.fileno(), OFFSET.pack(last), 0)
+            if self.fsync:
+                os.fsync(self.delivered_file.fileno())
+            self._trim(last)
+        return last - delivered
+
+    def _trim(self, delivered: int):
+        """Delete segments, all messages of which are delivered. Active segment is kept. Under lock"""
+        for base, following in zip(self.bases, self.bases[1:]):
+            if following - 1 > delivered:
+                break
+            mapped = self.maps.pop(base, None)
+            if mapped is not None:
+                mapped.close()
+            # индекс удаляется первым: сегмент без индекса не виден читателям
+            self._segment(base, 'idx').unlink(missing_ok=True)
+            self._segment(base, 'log').unlink(missing_ok=True)
+        self._refresh()
+
+    def close(self):
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps.clear()
+        for file in (self.log_file, self.idx_file, self.delivered_file):
+            if file:
+                file.close()
+        self.base = self.log_file = self.idx_file = None
+
+    def _map(self, base: int, size: int) -> mmap.mmap:
+        """Segment mapped into memory. Active segment grows, so it is mapped again, when it is longer than mapping"""
+        mapped = self.maps.get(base)
+        if mapped is None or len(mapped) < size:
+            if mapped is not None:
+                mapped.close()
+            with open(self._segment(base, 'log'), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[base] = mapped
+        self.maps.move_to_end(base)
+        while len(self.maps) > self.MAPS:
+            self.maps.popitem(last=False)[1].close()
+        return mapped
+
+    def read(self, after: int, limit: int = None) -> Tuple[List[Tuple[str, str, str]], int]:
+        """Not delivered messages after message {after}
+
+        Returns:
+            Tuple[List[Tuple[str, str, str]], int]: sender, date and text of messages, number of the last read one
+        """
+        with self.mutex:
+            while True:
+                try:
+                    return self._read(after, limit)
+                except FileNotFoundError:
+                    # сегмент удалил другой процесс после подтверждения доставки: все его сообщения уже доставлены,
+                    # чтение повторяется от нового номера доставленного по новому списку сегментов
+                    self._refresh()
+
+    def _read(self, after: int, limit: int = None) -> Tuple[List[Tuple[str, str, str]], int]:
+        """Body of {read}, under mutex"""
+        last = max(after, self.delivered())
+        result = []
+        # список сегментов перечитывается, только когда чтение дошло до конца последнего известного
+        bases = self.bases or self._refresh()
+        i = max(bisect_right(bases, last + 1) - 1, 0)
+        while i < len(bases):
+            wanted = limit - len(result) if limit else None
+            positions = self._positions(bases[i], last + 1, wanted)
+            if not positions:
+                if i + 1 == len(bases) and len(self._refresh()) == len(bases):
+                    break
+                bases, i = self.bases, i + 1
+                continue
+
+            # последняя запись в индексе записана целиком, отображение должно ее покрывать
+            mapped = self._map(bases[i], positions[-1] + HEADER.size)
+            mapped = self._map(bases[i], positions[-1] + HEADER.size + HEADER.unpack_from(mapped, positions[-1])[0])
+            for position in positions:
+                length, crc, flags, sender, date = HEADER.unpack_from(mapped, position)
+                body = mapped[position + HEADER.size:position + HEADER.size + length]
+                assert zlib.crc32(body) == crc, f'Corrupted message {last + 1} in {self.path}'
+                last += 1
+                if not flags & DELIVERED:
+                    result.append((
+                        body[:sender].decode('utf-8'),
+                        body[sender:sender + date].decode('utf-8'),
+                        body[sender + date:].decode('utf-8')
+                    ))
+            if limit and len(result) >= limit:
+                break
+        return result, last
+
+    def _positions(self, base: int, start: int, count: int = None) -> List[int]:
+        """Positions of {count} messages from message {start} in segment {base}, all the rest, if {count} is None"""
+        with open(self._segment(base, 'idx'), 'rb') as f:
+            f.seek((start - base) * POSITION.size)
+            index = f.read(count * POSITION.size if count else -1)
+        return [x for x, in POSITION.iter_unpack(index[:len(index) - len(index) % POSITION.size])]
+
+
+def partitions_limit() -> int:
+    """Number of open recipients, whose files take at most half of RLIMIT_NOFILE"""
+    limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if limit == resource.RLIM_INFINITY:
+        limit = 65536
+    return max(limit // 2 // Partition.FILES, 1)
+
+
+class MessageLog:
+
+    def __init__(self, path: str = None, segment_size: int = None, fsync: bool = None, partitions: int = None):
+        """
+        Args:
+            path (str): directory of log, relative to project
+            segment_size (int): new segment is started, when active one is bigger
+            fsync (bool): sync files to disk after every write
+            partitions (int): max number of recipients with open files, 0 - counted from RLIMIT_NOFILE
+        """
+        config = settings.MESSAGE_LOG
+        self.path = ROOT / (path or config['path'])
+        self.segment_size = segment_size or config['segment_size']
+        self.fsync = config['fsync'] if fsync is None else fsync
+        self.size = partitions or config['partitions'] or partitions_limit()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.partitions: OrderedDict[int, Partition] = OrderedDict()
+        self.lock = threading.Lock()
+        self.appended = 0
+        self.read_count = 0
+
+    @contextmanager
+    def partition(self, user_id: int) -> Iterator[Partition]:
+        with self.lock:
+            partition = self.partitions.get(user_id)
+            if partition is None:
+                partition = self.partitions[user_id] = Partition(
+                    self.path / str(user_id), self.segment_size, self.fsync
+                )
+            self.partitions.move_to_end(user_id)
+            partition.users += 1
+            self._evict()
+        try:
+            yield partition
+        finally:
+            with self.lock:
+                partition.users -= 1
+                self._evict()
+
+    def _evict(self):
+        """Close least recently used recipients, that are not used now, while there are more than {size}. Under lock"""
+        for user_id in list(self.partitions):
+            if len(self.partitions) <= self.size:
+                break
+            if not self.partitions[user_id].users:
+                self.partitions.pop(user_id).close()
+
+    def append(self, user_id: int, messages: List[Tuple[Message, bool]]) -> int:
+        """Write messages of recipient in one append
+
+        Returns:
+            int: number of the last message
+        """
+        with self.partition(user_id) as partition:
+            last = partition.append([encode_record(data, sent) for data, sent in messages])
+        self.appended += len(messages)
+        return last
+
+    def read(self, user_id: int, after: int = 0, limit: int = None) -> Tuple[List[Tuple[str, str, str]], int]:
+        with self.partition(user_id) as partition:
+            messages, last = partition.read(after, limit)
+        self.read_count += len(messages)
+        return messages, last
+
+    def ack(self, user_id: int, last: int) -> int:
+        with self.partition(user_id) as partition:
+            return partition.ack(last)
+
+    def stats(self) -> dict:
+        return {'partitions': len(self.partitions), 'appended': self.appended, 'read': self.read_count}
+
+
+if __name__ == '__main__':
+    # python -m database.message_log import - перенести недоставленные сообщения из таблицы messages в журнал
+    if sys.argv[1:] != ['import']:
+        print('usage: python -m database.message_log import')
+        sys.exit(1)
+
+    from databases import LogDatabase
+
+    print(f'{LogDatabase().import_messages()} messages moved into {settings.MESSAGE_LOG["path"]}')
@@ -0,0 +1,117 @@
+import datetime
+import sys
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import Table, Column, MetaData, select, text, func
+from sqlalchemy.dialects.sqlite import INTEGER, VARCHAR, DATETIME
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+"""Миграции схемы сервера. create_all создает только отсутствующие таблицы, поэтому индексы и ограничения, добавленные
+позже, в существующие базы не попадают. Версия схемы хранится в таблице schema_version, при подключении выполняются
+все шаги с номером больше текущей версии, каждый шаг - в своей транзакции вместе с записью новой версии.
+
+Шаги должны быть идемпотентными (IF NOT EXISTS): воркеры, запущенные одновременно, могут выполнить один шаг дважды,
+тогда второй только не сможет записать ту же версию"""
+
+metadata = MetaData()
+
+schema_version = Table(
+    'schema_version',
+    metadata,
+    Column('version', INTEGER, primary_key=True),
+    Column('description', VARCHAR, nullable=False),
+    Column('applied_at', DATETIME, nullable=False),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection], None]
+
+
+def _messages_by_recipient(conn: Connection):
+    # история: recipient_id = ? AND sent = false AND id > ? ORDER BY id
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_messages_recipient_sent ON messages (recipient_id, sent, id)'))
+
+
+def _chats_by_member(conn: Connection):
+    # список контактов и поиск чата проверяют обе стороны: init_id = ? OR other_id = ?
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_chats_init_other ON chats (init_id, other_id)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_chats_other_init ON chats (other_id, init_id)'))
+
+
+def _chats_unordered_pair(conn: Connection):
+    """Chat of two users is one, whoever started it: unique index on (smaller id, bigger id)"""
+    if conn.dialect.name == 'sqlite':
+        low, high = 'min(init_id, other_id)', 'max(init_id, other_id)'
+    else:
+        low, high = 'LEAST(init_id, other_id)', 'GREATEST(init_id, other_id)'
+
+    # чаты, созданные одновременно с обеих сторон, до появления ограничения могли задвоиться - остается первый
+    conn.execute(text(
+        f'DELETE FROM chats WHERE id NOT IN (SELECT min(id) FROM chats GROUP BY {low}, {high})'
+    ))
+    conn.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS ux_chats_pair ON chats ({low}, {high})'))
+
+
+def _archive_lookups(conn: Connection):
+    # архивация: sent = true AND date < ? ORDER BY id; чтение архива - части за дни из диапазона, в которых
+    # пользователь - один из участников
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_messages_sent_date ON messages (sent, date)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_archive_chunks_low ON archive_chunks (low_id, day)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_archive_chunks_high ON archive_chunks (high_id, day)'))
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'index messages by recipient and delivery', _messages_by_recipient),
+    Migration(2, 'index chats by both members', _chats_by_member),
+    Migration(3, 'unique unordered pair of chat members', _chats_unordered_pair),
+    Migration(4, 'index delivered messages by date and archive by members and day', _archive_lookups),
+]
+
+
+def current_version(engine: Engine) -> int:
+    metadata.create_all(bind=engine, checkfirst=True)
+    with engine.connect() as conn:
+        return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def migrate(engine: Engine) -> int:
+    """Apply migrations, that are not applied yet
+
+    Returns:
+        int: schema version after migration
+    """
+    version = current_version(engine)
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        try:
+            with engine.begin() as conn:
+                migration.apply(conn)
+                conn.execute(schema_version.insert().values(
+                    version=migration.version,
+                    description=migration.description,
+                    applied_at=datetime.datetime.now()
+                ))
+        except IntegrityError:
+            # версию уже записал другой процесс, выполнивший этот шаг одновременно. Иначе это ошибка самого шага
+            if current_version(engine) < migration.version:
+                raise
+        version = migration.version
+    return version
+
+
+if __name__ == '__main__':
+    # python -m database.migrations [status]
+    from database.core import DatabaseFactory
+    from database.server_models import create_tables
+
+    server_engine = DatabaseFactory('ServerDatabase').get_engine()
+    if sys.argv[1:] == ['status']:
+        print(f'schema version: {current_version(server_engine)}, latest: {MIGRATIONS[-1].version}')
+    else:
+        create_tables(server_engine)
+        print(f'schema version: {current_version(server_engine)}')
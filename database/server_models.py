@@ -1,9 +1,11 @@
 import sqlalchemy.exc
-from sqlalchemy import Column, ForeignKey, Boolean
-from sqlalchemy.dialects.sqlite import INTEGER, VARCHAR, DATETIME, BOOLEAN
+from sqlalchemy import Column, ForeignKey, Boolean, UniqueConstraint
+from sqlalchemy.dialects.sqlite import INTEGER, VARCHAR, DATETIME, BOOLEAN, DATE
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship, declarative_base
 
+from database.migrations import migrate
+
 Base = declarative_base()
 
 
@@ -81,11 +83,65 @@ class MessageHistory(Base):
     )
 
 
+class ArchiveChunk(Base):
+    """Part of archive file: messages of two users for one day, moved out of table messages by one archival batch"""
+    __tablename__ = 'archive_chunks'
+
+    id = Column(INTEGER, primary_key=True)
+    day = Column(DATE, nullable=False)
+    path = Column(VARCHAR, nullable=False)
+    offset = Column(INTEGER, nullable=False)
+    length = Column(INTEGER, nullable=False)
+    first_id = Column(INTEGER, nullable=False)
+    last_id = Column(INTEGER, nullable=False)
+    count = Column(INTEGER, nullable=False)
+    created_at = Column(DATETIME, nullable=False)
+    # участники переписки: меньший и больший id
+    low_id = Column(INTEGER, nullable=False)
+    high_id = Column(INTEGER, nullable=False)
+
+
+class Room(Base):
+    __tablename__ = 'rooms'
+
+    id = Column(INTEGER, primary_key=True)
+    name = Column(VARCHAR, unique=True, nullable=False)
+    created_at = Column(DATETIME)
+
+    members = relationship(
+        'RoomMember',
+        back_populates='room',
+        uselist=True
+    )
+
+
+class RoomMember(Base):
+    __tablename__ = 'room_members'
+    __table_args__ = (UniqueConstraint('room_id', 'client_id'),)
+
+    id = Column(INTEGER, primary_key=True)
+    room_id = Column(INTEGER, ForeignKey('rooms.id', ondelete='CASCADE'), nullable=False)
+    client_id = Column(INTEGER, ForeignKey('clients.id', ondelete='CASCADE'), nullable=False)
+
+    room = relationship(
+        Room,
+        back_populates='members',
+        uselist=False
+    )
+
+    client = relationship(
+        Client,
+        uselist=False
+    )
+
+
 def create_tables(engine: Engine):
     result = True
     try:
         metadata = Base.metadata
         metadata.create_all(bind=engine, checkfirst=True)
+        # индексы и ограничения добавляются миграциями - и в новые базы, и в уже существующие
+        migrate(engine)
     except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError):
         result = False
     finally:
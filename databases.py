@@ -1,48 +1,282 @@
 import datetime
-from typing import List, Optional
-
-from sqlalchemy import or_, and_
+import itertools
+import re
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from collections import OrderedDict
+from threading import Lock, RLock
+from typing import List, Optional, Tuple, NamedTuple, Dict, Iterable
+
+from sqlalchemy import or_, and_, insert
 from sqlalchemy.engine import Engine
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 
 from common.config import settings
-from common.utils import get_hashed_password
+from common.utils import get_hashed_password, parse_date
 from database.client_models import Contact, History
-from database.core import DatabaseFactory
-from database.server_models import MessageHistory, Client, ClientHistory, create_tables, Chat
+from database import archive
+from database.core import DatabaseFactory, sqlite_settings
+from database.message_log import MessageLog
+from database.server_models import MessageHistory, Client, ClientHistory, create_tables, Chat, Room, RoomMember
 from database.client_models import create_tables as create_client_tables
 from exceptions import NotExist, AlreadyExist
 from templates.templates import Message, User, Request
 
 
 class Database:
+    # раздел database/config.json
+    kind: str = None
+
     def __init__(self, client: str = None):
-        self.__create_tables = create_tables if self.__class__.__name__ == 'ServerDatabase' else create_client_tables
+        self.__create_tables = create_tables if self.kind == 'ServerDatabase' else create_client_tables
+        self.profile: Optional[str] = None
+        self.engine: Optional[Engine] = None
         self._db = self._connect(client)
 
     def _get_database(self, client: str) -> Engine:
-        factory = DatabaseFactory(self.__class__.__name__, client)
+        factory = DatabaseFactory(self.kind, client)
+        self.profile = factory.profile
         return factory.get_engine()
 
     def _connect(self, client: str) -> Session:
-        engine = self._get_database(client)
+        engine = self.engine = self._get_database(client)
         db_init = self.__create_tables(engine)
         if db_init:
-            return Session(bind=engine)
+            # запросы сервера могут выполняться в пуле потоков, у каждого потока своя сессия
+            return scoped_session(sessionmaker(bind=engine))
         raise NotExist("Database creation error")
         
     def __del__(self):
-        self._db.close()
+        self._db.remove()
+
+    def storage(self) -> dict:
+        """Storage settings, that are really active"""
+        if self.engine.dialect.name != 'sqlite':
+            return {'dialect': self.engine.dialect.name}
+        return {'profile': self.profile, **sqlite_settings(self.engine)}
+
+
+class Identity(NamedTuple):
+    """Fields of user, that do not change after registration"""
+    id: int
+    login: str
+    verbose_name: str
+    password: str
+
+
+class IdentityCache:
+    """Bounded LRU cache of users by login and by id. Logins are resolved to ids on every message, and user
+    never changes after registration, so database is asked only once for every active user.
+    Every change of user in database must call {invalidate}"""
+
+    def __init__(self, size: int = None):
+        self.size = settings.USER_CACHE['size'] if size is None else size
+        self.by_login: OrderedDict[str, Identity] = OrderedDict()
+        self.by_id: Dict[int, Identity] = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.by_login)
+
+    def get(self, login: str) -> Optional[Identity]:
+        with self.lock:
+            identity = self.by_login.get(login)
+            if identity is None:
+                self.misses += 1
+                return None
+            self.by_login.move_to_end(login)
+            self.hits += 1
+            return identity
+
+    def get_by_id(self, user_id: int) -> Optional[Identity]:
+        with self.lock:
+            identity = self.by_id.get(user_id)
+            if identity is None:
+                self.misses += 1
+                return None
+            self.by_login.move_to_end(identity.login)
+            self.hits += 1
+            return identity
+
+    def put(self, identity: Identity):
+        if not self.size:
+            return
+        with self.lock:
+            self.by_login[identity.login] = identity
+            self.by_login.move_to_end(identity.login)
+            self.by_id[identity.id] = identity
+            while len(self.by_login) > self.size:
+                _, old = self.by_login.popitem(last=False)
+                del self.by_id[old.id]
+
+    def invalidate(self, login: str = None, user_id: int = None):
+        with self.lock:
+            identity = self.by_login.get(login) or self.by_id.get(user_id)
+            if identity:
+                del self.by_login[identity.login]
+                del self.by_id[identity.id]
+
+    def stats(self) -> dict:
+        return {'size': len(self.by_login), 'hits': self.hits, 'misses': self.misses}
+
+
+class ServerStorage(ABC):
+    """Storage of server: everything request handlers ask database for. Users are returned as {Identity},
+    errors are the same for all engines: AlreadyExist, NotExist, AssertionError for invalid data"""
+
+    @abstractmethod
+    def get_user(self, username: str) -> Optional[Identity]:
+        ...
+
+    @abstractmethod
+    def get_user_by_id(self, user_id: int) -> Optional[Identity]:
+        ...
+
+    @abstractmethod
+    def get_users(self, logins: Iterable[str]) -> Dict[str, Identity]:
+        """Users by logins. Unknown logins are not in result"""
+
+    @abstractmethod
+    def get_users_by_id(self, ids: Iterable[int]) -> Dict[int, Identity]:
+        ...
+
+    @abstractmethod
+    def search(self, value: str) -> List[User]:
+        """Users, whose login matches LIKE pattern {value}"""
+
+    @abstractmethod
+    def auth_user(self, user: Identity, ip: str):
+        """Remember, that user has logged in from {ip}"""
+
+    @abstractmethod
+    def create_user(self, user: User) -> int:
+        ...
+
+    @abstractmethod
+    def get_user_contact_list(self, user: User) -> List[Identity]:
+        ...
 
+    @abstractmethod
+    def get_message_history(self, user: User) -> List[Message]:
+        """All not delivered messages of user at once, they are marked delivered"""
+
+    @abstractmethod
+    def get_message_page(self, user: User, after: int = 0, limit: int = None) -> Tuple[List[Message], int]:
+        """Not delivered messages of user after message {after}, oldest first, and id of the last one"""
 
-class ServerDatabase(Database):
+    @abstractmethod
+    def ack_messages(self, user: User, last: int) -> int:
+        """Mark delivered all messages of user up to {last}"""
+
+    @abstractmethod
+    def create_message(self, data: Message, sent: bool):
+        ...
+
+    @abstractmethod
+    def create_messages(self, messages: List[Tuple[Message, bool]]) -> int:
+        """Save several messages at once. Messages of unknown users or with invalid date are skipped"""
+
+    @abstractmethod
+    def create_chat(self, user: User, other: User) -> int:
+        ...
+
+    @abstractmethod
+    def delete_chat(self, user: User, other: User):
+        ...
+
+    @abstractmethod
+    def join_room(self, user: User, name: str):
+        ...
+
+    @abstractmethod
+    def leave_room(self, user: User, name: str):
+        ...
+
+    @abstractmethod
+    def get_room_members(self, name: str) -> List[str]:
+        ...
+
+    @abstractmethod
+    def get_messages_by_date(self, user: User, start: datetime.datetime, end: datetime.datetime) -> List[Message]:
+        """Messages, sent or received by user from {start} till {end}, delivered or not, archived too.
+        Storage level only: no request action reads history by date"""
+
+    @abstractmethod
+    def archive_messages(self, before: datetime.datetime) -> int:
+        """Move one batch of delivered messages older than {before} into archive
+
+        Returns:
+            int: number of archived messages, 0 - when there is nothing more to archive
+        """
+
+    @abstractmethod
+    def storage(self) -> dict:
+        """Storage settings, that are really active"""
+
+    @abstractmethod
+    def stats(self) -> dict:
+        ...
+
+
+class ServerDatabase(Database, ServerStorage):
+    kind = 'ServerDatabase'
 
     def __init__(self):
         super(ServerDatabase, self).__init__()
+        self.users = IdentityCache()
+        self.archive = archive.Archive()
+
+    def stats(self) -> dict:
+        return {'identity_cache': self.users.stats()}
 
-    def get_user(self, username: str) -> Optional[Client]:
-        user: Client = self._db.query(Client).filter(Client.login == username).one_or_none()
-        return user
+    def _identities(self, *condition) -> List[Identity]:
+        rows = self._db.query(Client.id, Client.login, Client.verbose_name, Client.password).filter(*condition).all()
+        result = [Identity(*x) for x in rows]
+        for identity in result:
+            self.users.put(identity)
+        return result
+
+    def get_user(self, username: str) -> Optional[Identity]:
+        identity = self.users.get(username)
+        if identity is None:
+            found = self._identities(Client.login == username)
+            identity = found[0] if found else None
+        return identity
+
+    def get_user_by_id(self, user_id: int) -> Optional[Identity]:
+        identity = self.users.get_by_id(user_id)
+        if identity is None:
+            found = self._identities(Client.id == user_id)
+            identity = found[0] if found else None
+        return identity
+
+    def get_users(self, logins: Iterable[str]) -> Dict[str, Identity]:
+        """Users by logins: from cache, not cached ones - with one query. Unknown logins are not in result"""
+        result, missed = {}, []
+        for login in set(logins):
+            identity = self.users.get(login)
+            if identity is None:
+                missed.append(login)
+            else:
+                result[login] = identity
+        if missed:
+            result.update((x.login, x) for x in self._identities(Client.login.in_(missed)))
+        return result
+
+    def get_users_by_id(self, ids: Iterable[int]) -> Dict[int, Identity]:
+        result, missed = {}, []
+        for user_id in set(ids):
+            identity = self.users.get_by_id(user_id)
+            if identity is None:
+                missed.append(user_id)
+            else:
+                result[user_id] = identity
+        if missed:
+            result.update((x.id, x) for x in self._identities(Client.id.in_(missed)))
+        return result
 
     def search(self, value: str) -> List[User]:
         users = self._db.query(Client).filter(Client.login.like(value)).all()
@@ -51,9 +285,9 @@ class ServerDatabase(Database):
             id=x.id, login=x.login, verbose_name=x.verbose_name
         ) for x in users]
 
-    def auth_user(self, user: Client, ip: str):
+    def auth_user(self, user: Identity, ip: str):
         connected = ClientHistory(
-            client=user,
+            client_id=user.id,
             date=datetime.datetime.now(),
             address=ip
         )
@@ -76,40 +310,79 @@ class ServerDatabase(Database):
 
         self._db.add(client)
         self._db.commit()
+        self.users.invalidate(login=user.login)
 
         return client.id
 
-    def get_user_contact_list(self, user: User) -> List[Client]:
+    def get_user_contact_list(self, user: User) -> List[Identity]:
 
-        contacts: List[Chat] = self._db.query(Chat).filter(
+        contacts = self._db.query(Chat.init_id, Chat.other_id).filter(
             or_(
                 Chat.init_id == user.id,
                 Chat.other_id == user.id
             )
         ).all()
 
-        result = [x.other if x.init_id == user.id else x.init for x in contacts]
-        return result
+        # собеседники берутся из кэша по id, а не отдельным запросом для каждого чата
+        ids = [other if init == user.id else init for init, other in contacts]
+        users = self.get_users_by_id(ids)
+        return [users[x] for x in ids if x in users]
 
     def get_message_history(self, user: User) -> List[Message]:
+        """All not delivered messages of user at once, they are marked delivered. Old clients ask for history so"""
+        messages, last = self.get_message_page(user)
+        if messages:
+            self.ack_messages(user, last)
+        return messages
 
-        messages: List[MessageHistory] = self._db.query(MessageHistory).filter(
-                MessageHistory.recipient_id == user.id
-        ).filter(MessageHistory.sent.is_(False)).all()
-
-        for mess in messages:
-            mess.sent = True
-            self._db.add(mess)
+    def get_message_page(self, user: User, after: int = 0, limit: int = None) -> Tuple[List[Message], int]:
+        """Not delivered messages of user, oldest first
+
+        Args:
+            user (User): recipient
+            after (int): id of the last message of previous page
+            limit (int): max number of messages, None - all
+
+        Returns:
+            Tuple[List[Message], int]: messages, id of the last one (after, if page is empty)
+        """
+        # логин отправителя выбирается тем же запросом, а не отдельным запросом для каждой строки
+        query = self._db.query(
+            MessageHistory.id, MessageHistory.date, MessageHistory.content, Client.login
+        ).join(
+            Client, MessageHistory.sender_id == Client.id
+        ).filter(
+            MessageHistory.recipient_id == user.id,
+            MessageHistory.sent.is_(False),
+            MessageHistory.id > after
+        ).order_by(MessageHistory.id)
+        if limit:
+            query = query.limit(limit)
+
+        rows = query.all()
+        messages = [Message.construct(
+            to=user.login,
+            from_=sender,
+            encoding='utf-8',
+            message=content,
+            date=date.strftime(settings.DATE_FORMAT)
+        ) for _, date, content, sender in rows]
+
+        return messages, rows[-1].id if rows else after
+
+    def ack_messages(self, user: User, last: int) -> int:
+        """Mark delivered all messages of user up to {last} with one UPDATE
+
+        Returns:
+            int: number of marked messages
+        """
+        count = self._db.query(MessageHistory).filter(
+            MessageHistory.recipient_id == user.id,
+            MessageHistory.sent.is_(False),
+            MessageHistory.id <= last
+        ).update({MessageHistory.sent: True}, synchronize_session=False)
         self._db.commit()
-
-        result = [Message(
-            to=x.recipient.login,
-            from_=x.sender.login,
-            message=x.content,
-            date=x.date.strftime(settings.DATE_FORMAT)
-        ) for x in messages]
-
-        return result
+        return count
 
     def create_message(self, data: Message, sent: bool):
         sender = self.get_user(data.from_)
@@ -118,18 +391,68 @@ class ServerDatabase(Database):
 
         recipient = self.get_user(data.to)
         if not recipient:
-            raise NotExist(f"Пользователь {data.from_} не существует")
+            raise NotExist(f"Пользователь {data.to} не существует")
 
         message = MessageHistory(
             date=datetime.datetime.strptime(data.date, settings.DATE_FORMAT),
             content=data.message,
-            sender=sender,
-            recipient=recipient,
+            sender_id=sender.id,
+            recipient_id=recipient.id,
             sent=sent
         )
         self._db.add(message)
         self._db.commit()
 
+    def create_messages(self, messages: List[Tuple[Message, bool]]) -> int:
+        """Save several messages in one transaction: users are taken from cache, rows are inserted
+        with one statement. Messages of unknown users or with invalid date are skipped
+
+        Args:
+            messages (List[Tuple[Message, bool]]): message and flag, if it was delivered
+
+        Returns:
+            int: number of saved messages
+        """
+        users = self.get_users([x.from_ for x, _ in messages] + [x.to for x, _ in messages])
+
+        rows = []
+        for data, sent in messages:
+            date = parse_date(data.date)
+            if date and data.from_ in users and data.to in users:
+                rows.append({
+                    'sender_id': users[data.from_].id,
+                    'recipient_id': users[data.to].id,
+                    'date': date,
+                    'content': data.message,
+                    'sent': sent
+                })
+
+        if rows:
+            try:
+                self._db.execute(insert(MessageHistory), rows)
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+        return len(rows)
+
+    def get_messages_by_date(self, user: User, start: datetime.datetime, end: datetime.datetime) -> List[Message]:
+        rows = archive.read_messages(self._db, self.archive, user.id, start, end)
+        rows += archive.live_messages(self._db, user.id, start, end)
+        rows.sort(key=lambda x: (x['date'], x['id']))
+
+        users = self.get_users_by_id([x['from'] for x in rows] + [x['to'] for x in rows])
+        return [Message.construct(
+            to=users[x['to']].login,
+            from_=users[x['from']].login,
+            encoding='utf-8',
+            message=x['message'],
+            date=x['date'].strftime(settings.DATE_FORMAT)
+        ) for x in rows if x['from'] in users and x['to'] in users]
+
+    def archive_messages(self, before: datetime.datetime) -> int:
+        return archive.archive_messages(self._db, self.archive, before)
+
     def create_chat(self, user: User, other: User) -> int:
 
         exist = self._db.query(Chat).filter(
@@ -144,13 +467,20 @@ class ServerDatabase(Database):
 
         init = self.get_user(user.login)
         other = self.get_user(other.login)
+        if not init or not other:
+            raise NotExist("Пользователь не существует")
 
         obj = Chat(
-            init=init,
-            other=other
+            init_id=init.id,
+            other_id=other.id
         )
         self._db.add(obj)
-        self._db.commit()
+        try:
+            self._db.commit()
+        except IntegrityError:
+            # тот же чат одновременно создал собеседник
+            self._db.rollback()
+            raise AlreadyExist("Чат уже существует")
         return obj.id
 
     def delete_chat(self, user: User, other: User):
@@ -172,8 +502,338 @@ class ServerDatabase(Database):
         self._db.delete(chat)
         self._db.commit()
 
+    def join_room(self, user: User, name: str):
+        """Add user to room. Room is created by the first member"""
+        room = self._db.query(Room).filter(Room.name == name).one_or_none()
+        if not room:
+            room = Room(name=name, created_at=datetime.datetime.now())
+            self._db.add(room)
+            try:
+                self._db.flush()
+            except IntegrityError:
+                # комнату одновременно создал другой воркер
+                self._db.rollback()
+                room = self._db.query(Room).filter(Room.name == name).one()
+
+        if self._db.query(RoomMember).filter(
+                RoomMember.room_id == room.id,
+                RoomMember.client_id == user.id
+        ).one_or_none():
+            raise AlreadyExist(f"Пользователь {user.login} уже в комнате {name}")
+
+        self._db.add(RoomMember(room=room, client_id=user.id))
+        self._db.commit()
+
+    def leave_room(self, user: User, name: str):
+        member = self._db.query(RoomMember).join(Room).filter(
+            Room.name == name,
+            RoomMember.client_id == user.id
+        ).one_or_none()
+
+        if not member:
+            raise NotExist(f"Пользователь {user.login} не в комнате {name}")
+
+        self._db.delete(member)
+        self._db.commit()
+
+    def get_room_members(self, name: str) -> List[str]:
+        members = self._db.query(Client.login).join(RoomMember).join(Room).filter(Room.name == name).all()
+        return [x.login for x in members]
+
+
+class LogDatabase(ServerDatabase):
+    """Users, chats and rooms are in SQL database, messages - in {MessageLog}. Table messages is not used"""
+
+    def __init__(self):
+        super(LogDatabase, self).__init__()
+        self.log = MessageLog()
+
+    def get_message_page(self, user: User, after: int = 0, limit: int = None) -> Tuple[List[Message], int]:
+        rows, last = self.log.read(user.id, after, limit)
+        messages = [Message.construct(
+            to=user.login,
+            from_=sender,
+            encoding='utf-8',
+            message=content,
+            date=date
+        ) for sender, date, content in rows]
+        return messages, last
+
+    def ack_messages(self, user: User, last: int) -> int:
+        return self.log.ack(user.id, last)
+
+    def create_message(self, data: Message, sent: bool):
+        sender = self.get_user(data.from_)
+        if not sender:
+            raise NotExist(f"Пользователь {data.from_} не существует")
+
+        recipient = self.get_user(data.to)
+        if not recipient:
+            raise NotExist(f"Пользователь {data.to} не существует")
+
+        self.log.append(recipient.id, [(data, sent)])
+
+    def create_messages(self, messages: List[Tuple[Message, bool]]) -> int:
+        """Messages of every recipient are written with one append"""
+        users = self.get_users([x.from_ for x, _ in messages] + [x.to for x, _ in messages])
+
+        by_recipient: Dict[int, List[Tuple[Message, bool]]] = {}
+        for data, sent in messages:
+            if parse_date(data.date) and data.from_ in users and data.to in users:
+                by_recipient.setdefault(users[data.to].id, []).append((data, sent))
+
+        for recipient, items in by_recipient.items():
+            self.log.append(recipient, items)
+        return sum(len(x) for x in by_recipient.values())
+
+    def import_messages(self) -> int:
+        """Move not delivered messages from table messages into log
+
+        Returns:
+            int: number of moved messages
+        """
+        count = 0
+        for recipient, in self._db.query(MessageHistory.recipient_id).filter(
+                MessageHistory.sent.is_(False)
+        ).distinct().all():
+            user = self.get_user_by_id(recipient)
+            page, last = super(LogDatabase, self).get_message_page(user)
+            if page:
+                self.log.append(user.id, [(x, False) for x in page])
+                super(LogDatabase, self).ack_messages(user, last)
+                count += len(page)
+        return count
+
+    def get_messages_by_date(self, user: User, start: datetime.datetime, end: datetime.datetime) -> List[Message]:
+        # журнал хранит сообщения получателя только до доставки, истории за период в нем нет
+        raise NotImplementedError('Message log keeps messages only until they are delivered')
+
+    def archive_messages(self, before: datetime.datetime) -> int:
+        # доставленные сегменты журнал удаляет сам, таблица messages не используется - архивировать нечего
+        return 0
+
+    def storage(self) -> dict:
+        return {**super(LogDatabase, self).storage(), 'messages': str(self.log.path)}
+
+    def stats(self) -> dict:
+        return {**super(LogDatabase, self).stats(), 'message_log': self.log.stats()}
+
+
+class MemoryDatabase(ServerStorage):
+    """Server storage in process memory: dicts indexed the same way, as tables of ServerDatabase. Nothing is saved
+    between runs and every process has its own data, so it is for load tests and for measuring overhead of SQL
+    backend, not for multi-worker mode"""
+
+    def __init__(self):
+        self.lock = RLock()
+        self._ids = itertools.count(1)
+
+        self.users: Dict[str, Identity] = {}
+        self.users_by_id: Dict[int, Identity] = {}
+        self.connections: List[Tuple[int, datetime.datetime, str]] = []
+
+        # id -> (отправитель, получатель, дата, текст); у каждого получателя - id недоставленных по возрастанию
+        self.messages: Dict[int, Tuple[int, int, datetime.datetime, str]] = {}
+        self.inbox: Dict[int, List[int]] = {}
+
+        # чат двух пользователей ищется по неупорядоченной паре, контакты - по каждому участнику
+        self.chats: Dict[frozenset, int] = {}
+        self.contacts: Dict[int, Dict[int, int]] = {}
+        self.rooms: Dict[str, Dict[int, None]] = {}
+
+    def get_user(self, username: str) -> Optional[Identity]:
+        return self.users.get(username)
+
+    def get_user_by_id(self, user_id: int) -> Optional[Identity]:
+        return self.users_by_id.get(user_id)
+
+    def get_users(self, logins: Iterable[str]) -> Dict[str, Identity]:
+        return {x: self.users[x] for x in set(logins) if x in self.users}
+
+    def get_users_by_id(self, ids: Iterable[int]) -> Dict[int, Identity]:
+        return {x: self.users_by_id[x] for x in set(ids) if x in self.users_by_id}
+
+    def search(self, value: str) -> List[User]:
+        # LIKE: % - любая строка, _ - любой символ, без учета регистра, как в sqlite
+        pattern = re.compile(
+            ''.join('.*' if x == '%' else '.' if x == '_' else re.escape(x) for x in value),
+            re.IGNORECASE | re.DOTALL
+        )
+        with self.lock:
+            users = [x for x in self.users.values() if pattern.fullmatch(x.login)]
+        return [User(id=x.id, login=x.login, verbose_name=x.verbose_name) for x in users]
+
+    def auth_user(self, user: Identity, ip: str):
+        with self.lock:
+            self.connections.append((user.id, datetime.datetime.now(), ip))
+
+    def create_user(self, user: User) -> int:
+        with self.lock:
+            if user.login in self.users:
+                raise AlreadyExist(f'Пользователь <{user.login}> уже существует')
+
+            assert user.password, "Необходимо задать пароль"
+
+            identity = Identity(
+                id=next(self._ids),
+                login=user.login,
+                verbose_name=user.verbose_name if user.verbose_name else f"@{user.login}",
+                password=get_hashed_password(user.password)
+            )
+            self.users[identity.login] = identity
+            self.users_by_id[identity.id] = identity
+            return identity.id
+
+    def get_user_contact_list(self, user: User) -> List[Identity]:
+        with self.lock:
+            return [self.users_by_id[x] for x in self.contacts.get(user.id, ())]
+
+    def get_message_history(self, user: User) -> List[Message]:
+        with self.lock:
+            messages, last = self.get_message_page(user)
+            if messages:
+                self.ack_messages(user, last)
+            return messages
+
+    def get_message_page(self, user: User, after: int = 0, limit: int = None) -> Tuple[List[Message], int]:
+        with self.lock:
+            inbox = self.inbox.get(user.id, [])
+            start = bisect_right(inbox, after)
+            ids = inbox[start:start + limit] if limit else inbox[start:]
+            rows = [self.messages[x] for x in ids]
+
+        messages = [Message.construct(
+            to=user.login,
+            from_=self.users_by_id[sender].login,
+            encoding='utf-8',
+            message=content,
+            date=date.strftime(settings.DATE_FORMAT)
+        ) for sender, _, date, content in rows]
+        return messages, ids[-1] if ids else after
+
+    def ack_messages(self, user: User, last: int) -> int:
+        with self.lock:
+            inbox = self.inbox.get(user.id)
+            if not inbox:
+                return 0
+            count = bisect_right(inbox, last)
+            del inbox[:count]
+            return count
+
+    def _add_message(self, sender: int, recipient: int, date: datetime.datetime, data: Message, sent: bool):
+        message_id = next(self._ids)
+        self.messages[message_id] = (sender, recipient, date, data.message)
+        if not sent:
+            self.inbox.setdefault(recipient, []).append(message_id)
+
+    def create_message(self, data: Message, sent: bool):
+        with self.lock:
+            sender = self.users.get(data.from_)
+            if not sender:
+                raise NotExist(f"Пользователь {data.from_} не существует")
+
+            recipient = self.users.get(data.to)
+            if not recipient:
+                raise NotExist(f"Пользователь {data.to} не существует")
+
+            self._add_message(sender.id, recipient.id, datetime.datetime.strptime(data.date, settings.DATE_FORMAT),
+                              data, sent)
+
+    def create_messages(self, messages: List[Tuple[Message, bool]]) -> int:
+        count = 0
+        with self.lock:
+            for data, sent in messages:
+                sender, recipient, date = self.users.get(data.from_), self.users.get(data.to), parse_date(data.date)
+                if sender and recipient and date:
+                    self._add_message(sender.id, recipient.id, date, data, sent)
+                    count += 1
+        return count
+
+    def get_messages_by_date(self, user: User, start: datetime.datetime, end: datetime.datetime) -> List[Message]:
+        with self.lock:
+            rows = [x for x in self.messages.values() if user.id in x[:2] and start <= x[2] < end]
+        return [Message.construct(
+            to=self.users_by_id[recipient].login,
+            from_=self.users_by_id[sender].login,
+            encoding='utf-8',
+            message=content,
+            date=date.strftime(settings.DATE_FORMAT)
+        ) for sender, recipient, date, content in sorted(rows, key=lambda x: x[2])]
+
+    def archive_messages(self, before: datetime.datetime) -> int:
+        # сообщения живут не дольше процесса, архивировать нечего
+        return 0
+
+    def create_chat(self, user: User, other: User) -> int:
+        with self.lock:
+            if frozenset((user.id, other.id)) in self.chats:
+                raise AlreadyExist("Чат уже существует")
+
+            init = self.users.get(user.login)
+            other = self.users.get(other.login)
+            if not init or not other:
+                raise NotExist("Пользователь не существует")
+
+            pair = frozenset((init.id, other.id))
+            if pair in self.chats:
+                raise AlreadyExist("Чат уже существует")
+
+            chat_id = self.chats[pair] = next(self._ids)
+            self.contacts.setdefault(init.id, {})[other.id] = chat_id
+            self.contacts.setdefault(other.id, {})[init.id] = chat_id
+            return chat_id
+
+    def delete_chat(self, user: User, other: User):
+        with self.lock:
+            if self.chats.pop(frozenset((user.id, other.id)), None) is None:
+                raise NotExist('Chat not exist')
+            self.contacts[user.id].pop(other.id, None)
+            self.contacts[other.id].pop(user.id, None)
+
+    def join_room(self, user: User, name: str):
+        with self.lock:
+            members = self.rooms.setdefault(name, {})
+            if user.id in members:
+                raise AlreadyExist(f"Пользователь {user.login} уже в комнате {name}")
+            members[user.id] = None
+
+    def leave_room(self, user: User, name: str):
+        with self.lock:
+            members = self.rooms.get(name, {})
+            if user.id not in members:
+                raise NotExist(f"Пользователь {user.login} не в комнате {name}")
+            del members[user.id]
+
+    def get_room_members(self, name: str) -> List[str]:
+        with self.lock:
+            return [self.users_by_id[x].login for x in self.rooms.get(name, ())]
+
+    def storage(self) -> dict:
+        return {'engine': 'memory'}
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'users': len(self.users),
+                'messages': len(self.messages),
+                'undelivered': sum(len(x) for x in self.inbox.values()),
+                'chats': len(self.chats),
+                'rooms': len(self.rooms),
+            }
+
+
+def get_database() -> ServerStorage:
+    """Storage engine of server, chosen by settings.DATABASE: entry with dialect "memory" - {MemoryDatabase}.
+    With MESSAGE_LOG enabled messages of SQL database are kept in log"""
+    if DatabaseFactory('ServerDatabase').dialect == 'memory':
+        return MemoryDatabase()
+    if settings.MESSAGE_LOG['enabled']:
+        return LogDatabase()
+    return ServerDatabase()
+
 
 class ClientDatabase(Database):
+    kind = 'ClientDatabase'
 
     def __init__(self, login: str):
         super(ClientDatabase, self).__init__(login)
@@ -230,10 +890,10 @@ class ClientDatabase(Database):
             self._db.add(msg)
             self._db.commit()
 
-    def save_messages(self, request: Request):
+    def save_messages(self, messages: List[Message]):
 
         to_db = []
-        for message in request.data:
+        for message in messages:
             contact = self.get_contact(message.from_)
             to_db.append(
                 History(
@@ -43,29 +43,11 @@ def log(func):
 
 
 def login_required(f: Callable) -> Callable:
+    """Session is authenticated once, by auth action - after that it is enough to check the field"""
 
-    def wrapper(*args, **kwargs):
-
-        self = args[0]
-
-        print(self.message.user.login)
-
-        user = self.server.connected_users.get(self.message.user.login)
-        if user:
-            token = user.token
-
-            user_token = self.message.user.token
-            print(token, user_token)
-            if token != user_token:
-                raise NotAuthorised
-
-            try:
-                result = f(*args, **kwargs)
-            except Exception as e:
-                raise e
-            else:
-                return result
-        else:
+    def wrapper(self, *args, **kwargs):
+        if self.user is None:
             raise NotAuthorised
+        return f(self, *args, **kwargs)
 
     return wrapper
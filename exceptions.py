@@ -24,3 +24,7 @@ class NotKeyError(Exception):
 
 class NotAuthorised(Exception):
     pass
+
+
+class FrameError(ConnectionError):
+    pass
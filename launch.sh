@@ -1,5 +1,8 @@
 #! /bin/bash
 
+# ключи клиентов генерируются заранее, клиенты берут их из пула и не тратят время на генерацию при запуске
+python3 -m common.keystore pool 10
+
 # shellcheck disable=SC2034
 for i in {1..10}
 do
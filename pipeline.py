@@ -0,0 +1,96 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, Deque, Tuple, Hashable, Optional
+
+import rsa
+
+from common import crypto
+from common.config import settings
+from log.server_log import logger
+from templates.templates import Request
+from templates.templates import decode as parse
+
+"""Обработка запросов в пуле. Цикл ввода-вывода только читает кадры и отдает их сюда, расшифровка, разбор и работа
+с базой выполняются в потоках (расшифровка с разбором - в отдельных процессах, если задан kind "process").
+Запросы одного соединения выполняются строго по очереди, поэтому порядок ответов клиенту сохраняется"""
+
+
+def decode(data: bytes, private_key: rsa.PrivateKey, binary: bool = True) -> Request:
+    """Decrypt and parse request. Module level function, so it can be executed in process pool"""
+    return parse(crypto.decrypt(data, private_key), binary)
+
+
+class Pipeline:
+
+    def __init__(self, kind: str = None, size: int = None):
+        """
+        Args:
+            kind (str): "inline" - handle in I/O loop, "thread" - thread pool,
+                "process" - thread pool + process pool for decryption and parsing
+            size (int): number of workers
+        """
+        self.kind = kind or settings.HANDLER_POOL['kind']
+        self.size = size or settings.HANDLER_POOL['size']
+        assert self.kind in ('inline', 'thread', 'process'), f"Unknown handler pool: {self.kind}"
+
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.decoder: Optional[ProcessPoolExecutor] = None
+        if self.kind != 'inline':
+            self.executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='handler')
+        if self.kind == 'process':
+            self.decoder = ProcessPoolExecutor(max_workers=self.size)
+
+        # очереди задач соединений, у которых сейчас выполняется задача
+        self.queues: Dict[Hashable, Deque[Tuple[Callable, tuple]]] = {}
+        self.lock = Lock()
+
+    def decode(self, data: bytes, private_key: rsa.PrivateKey, binary: bool = True) -> Request:
+        if self.decoder:
+            return self.decoder.submit(decode, data, private_key, binary).result()
+        return decode(data, private_key, binary)
+
+    def submit(self, key: Hashable, func: Callable, *args):
+        """Run task in pool after all tasks, submitted earlier with the same key
+
+        Args:
+            key: connection, which task belongs to
+            func (Callable): task
+        """
+        if not self.executor:
+            self._call(func, args)
+            return
+
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append((func, args))
+                return
+            self.queues[key] = deque()
+
+        self.executor.submit(self._run, key, func, args)
+
+    @staticmethod
+    def _call(func: Callable, args: tuple):
+        # ошибка задачи не должна останавливать ни цикл ввода-вывода, ни очередь соединения
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(f'<pipeline> {func.__name__}: {e}')
+
+    def _run(self, key: Hashable, func: Callable, args: tuple):
+        while True:
+            self._call(func, args)
+
+            with self.lock:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    return
+                func, args = queue.popleft()
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        if self.decoder:
+            self.decoder.shutdown(wait=False)
@@ -0,0 +1,198 @@
+import heapq
+import itertools
+import time
+from typing import Dict, Optional, Tuple, Any, Iterator, List
+
+from common.config import settings
+
+"""Реестр соединений сервера. Раньше соединения хранились в списке и словарях - атрибутах класса, общих для всех
+экземпляров сервера, а удаление из списка стоило O(n). Теперь у каждого сервера свой реестр с индексами по дескриптору,
+логину и адресу, все операции O(1)"""
+
+
+class Connection:
+    """Everything server knows about one connection"""
+
+    __slots__ = ('sock', 'fd', 'address', 'session', 'login', 'outbox', 'closing', 'eof', 'connected_at',
+                 'last_activity', 'probed', 'close_by', 'bytes_in', 'bytes_out', 'frames_in', 'frames_out')
+
+    def __init__(self, sock: Any, fd: int, address: Tuple):
+        self.sock = sock
+        self.fd = fd
+        self.address = address
+        self.session = None
+        self.login: Optional[str] = None
+        self.outbox = bytearray()
+        self.closing = False
+        self.eof = False
+        self.connected_at = self.last_activity = time.monotonic()
+        self.probed = False
+        self.close_by: Optional[float] = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def touch(self):
+        """Data received from client - connection is alive"""
+        self.last_activity = time.monotonic()
+        self.probed = False
+
+    def memory(self) -> int:
+        """Bytes held in buffers of connection: not sent data and not complete received frames"""
+        received = len(self.session.frames) if self.session else 0
+        return len(self.outbox) + received
+
+    def stats(self) -> dict:
+        return {
+            'address': self.address,
+            'login': self.login,
+            'uptime': round(time.monotonic() - self.connected_at, 3),
+            'idle': round(time.monotonic() - self.last_activity, 3),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'memory': self.memory(),
+        }
+
+
+class ConnectionRegistry:
+
+    def __init__(self, probe_interval: float = None, timeout: float = None):
+        """
+        Args:
+            probe_interval (float): seconds of silence, after which client is probed. 0 disables keepalive
+            timeout (float): seconds of silence, after which connection is considered dead
+        """
+        self.by_fd: Dict[int, Connection] = {}
+        self.by_login: Dict[str, Connection] = {}
+        self.by_address: Dict[Tuple, Connection] = {}
+
+        self.probe_interval = settings.KEEPALIVE['probe_interval'] if probe_interval is None else probe_interval
+        self.timeout = settings.KEEPALIVE['timeout'] if timeout is None else timeout
+
+        # куча сроков проверки: у каждого соединения не больше одной записи, активность только обновляет
+        # last_activity, а запись переносится, когда срок наступил. Поэтому проверка стоит O(истекших), а не O(всех)
+        self._timers: List[Tuple[float, int, Connection]] = []
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.by_fd)
+
+    def __iter__(self) -> Iterator[Connection]:
+        return iter(list(self.by_fd.values()))
+
+    def add(self, sock: Any, address: Tuple) -> Connection:
+        conn = Connection(sock, sock.fileno(), address)
+        self.by_fd[conn.fd] = conn
+        self.by_address[address] = conn
+        if self.probe_interval:
+            self._schedule(conn, conn.last_activity + self.probe_interval)
+        return conn
+
+    def remove(self, conn: Connection):
+        if self.by_fd.get(conn.fd) is conn:
+            del self.by_fd[conn.fd]
+        if self.by_address.get(conn.address) is conn:
+            del self.by_address[conn.address]
+        self.unbind(conn)
+
+    def close_later(self, conn: Connection):
+        """Connection is closed after pending data is sent, but not later than in {timeout}"""
+        conn.closing = True
+        conn.close_by = time.monotonic() + self.timeout
+        self._schedule(conn, conn.close_by)
+
+    def get(self, sock: Any) -> Optional[Connection]:
+        """Connection of socket. Closed socket has fileno -1, so nothing is found for it"""
+        conn = self.by_fd.get(sock.fileno())
+        if conn and conn.sock is sock:
+            return conn
+        return None
+
+    def find(self, address: Tuple) -> Optional[Connection]:
+        return self.by_address.get(address)
+
+    def bind(self, conn: Connection, login: str) -> bool:
+        """Attach authenticated login to connection
+
+        Returns:
+            bool: False if login is already bound to another connection
+        """
+        other = self.by_login.get(login)
+        if other is not None and other is not conn:
+            return False
+        conn.login = login
+        self.by_login[login] = conn
+        return True
+
+    def unbind(self, conn: Connection) -> bool:
+        if conn.login is None:
+            return False
+        login, conn.login = conn.login, None
+        if self.by_login.get(login) is conn:
+            del self.by_login[login]
+            return True
+        return False
+
+    def user(self, login: str) -> Optional[Connection]:
+        return self.by_login.get(login)
+
+    def logins(self) -> Iterator[str]:
+        return iter(list(self.by_login))
+
+    def memory(self) -> int:
+        return sum(conn.memory() for conn in self.by_fd.values())
+
+    def _schedule(self, conn: Connection, deadline: float):
+        heapq.heappush(self._timers, (deadline, next(self._counter), conn))
+
+    def next_deadline(self) -> Optional[float]:
+        """Time (monotonic) of the nearest idle check, None if nothing to check"""
+        return self._timers[0][0] if self._timers else None
+
+    def check_idle(self, now: float = None) -> Tuple[List[Connection], List[Connection]]:
+        """Pop expired timers
+
+        Returns:
+            Tuple[List[Connection], List[Connection]]: connections to probe, dead connections to close
+        """
+        now = now or time.monotonic()
+        to_probe, to_reap = [], []
+
+        while self._timers and self._timers[0][0] <= now:
+            _, _, conn = heapq.heappop(self._timers)
+            if self.by_fd.get(conn.fd) is not conn:
+                continue
+
+            if conn.closing:
+                # закрывающееся соединение ждет, пока клиент вычитает исходящие данные. Клиент, который не читает,
+                # держал бы их вечно, поэтому по сроку соединение закрывается без отправки остатка
+                if conn.close_by is not None and now >= conn.close_by:
+                    to_reap.append(conn)
+                continue
+
+            idle = now - conn.last_activity
+            if idle >= self.timeout:
+                to_reap.append(conn)
+            elif idle >= self.probe_interval:
+                if not conn.probed:
+                    conn.probed = True
+                    to_probe.append(conn)
+                # ответ на проверку переносит срок, поэтому следующая проверка не позже чем через probe_interval
+                self._schedule(conn, min(now + self.probe_interval, conn.last_activity + self.timeout))
+            else:
+                self._schedule(conn, conn.last_activity + self.probe_interval)
+
+        return to_probe, to_reap
+
+    def stats(self) -> dict:
+        connections = list(self.by_fd.values())
+        return {
+            'connections': len(connections),
+            'users': len(self.by_login),
+            'bytes_in': sum(x.bytes_in for x in connections),
+            'bytes_out': sum(x.bytes_out for x in connections),
+            'memory': sum(x.memory() for x in connections),
+        }
@@ -0,0 +1,36 @@
+from threading import Lock
+from typing import Dict, FrozenSet
+
+from databases import ServerStorage
+
+"""Участники групповых комнат. Состав комнаты хранится в базе, а для рассылки берется из памяти: база читается один раз
+при первом сообщении в комнату и после каждого изменения состава"""
+
+
+class RoomIndex:
+
+    def __init__(self, database: ServerStorage):
+        self.db = database
+        self.rooms: Dict[str, FrozenSet[str]] = {}
+        self.versions: Dict[str, int] = {}
+        self.lock = Lock()
+
+    def members(self, name: str) -> FrozenSet[str]:
+        """Logins of room members"""
+        members = self.rooms.get(name)
+        if members is not None:
+            return members
+
+        version = self.versions.get(name, 0)
+        members = frozenset(self.db.get_room_members(name))
+        with self.lock:
+            # пока читали базу, состав мог измениться - тогда прочитанное в кэш не кладем
+            if self.versions.get(name, 0) == version:
+                self.rooms[name] = members
+        return members
+
+    def forget(self, name: str):
+        """Room membership changed - it is loaded from database on next access"""
+        with self.lock:
+            self.rooms.pop(name, None)
+            self.versions[name] = self.versions.get(name, 0) + 1
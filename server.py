@@ -1,72 +1,83 @@
 import json
-from collections import deque
 from datetime import datetime
 from socket import socket
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Tuple, Callable, Dict
 
 import rsa
-from cryptography.fernet import Fernet
+from cryptography.fernet import InvalidToken
 from pydantic import ValidationError
 
 from base import TCPSocketServer
 from common.config import settings
-from common.utils import generate_session_token, get_hashed_password
-from databases import ServerDatabase
+from common import crypto, compression
+from common.framing import FrameBuffer
+from common.utils import generate_session_token, get_hashed_password, encode_cursor, decode_cursor
+from databases import ServerStorage
 from decorators import log, login_required
 from exceptions import AlreadyExist, NotExist, NotAuthorised
-from templates.templates import Request, ConnectedUser, User, Message
+from pipeline import parse
+from templates.templates import Request, User, Message, MessageFrame, Page
+from templates.templates import JsonCodec, BinaryCodec, JSON, negotiate, peek
 
 
 class RequestHandler:
+    """Session of one connection. Lives as long as connection and keeps everything known about client:
+    address, public key, authenticated user and his token"""
+
+    __slots__ = ('request', 'server', 'db', 'frames', 'message', 'closed', 'address', 'public_key', 'cipher', 'codec',
+                 'compressor', 'user', 'token', '__private_key')
 
-    @log
     def __init__(
             self,
             request: socket,
             server: TCPSocketServer,
-            clients: List[socket],
-            database: ServerDatabase,
-            public_key: rsa.PublicKey,
-            private_key: rsa.PrivateKey
+            database: ServerStorage,
+            private_key: rsa.PrivateKey,
+            address: Tuple[str, int] = None
     ):
         self.__private_key = private_key
-        self.__public_key = public_key
-        self.message: Optional[Request] = None
         self.request = request
         self.server = server
-        self.clients = clients
         self.db = database
-
-    @log
-    def get_method(self):
-
-        methods = {
-            settings.Action.presence: self.__handle_presence,
-            settings.Action.msg: self.__handle_message,
-            settings.Action.quit: self.__handle_quit,
-            settings.Action.register: self.__handle_register,
-            settings.Action.auth: self.__handle_auth,
-            settings.Action.contacts: self.__handle_contacts,
-            settings.Action.search: self.__search,
-            settings.Action.add_chat: self.__add_contact,
-            settings.Action.del_chat: self.__del_contact,
-            settings.Action.messages: self.__handle_messages
-        }
-        return methods.get(self.message.action)
+        self.frames = FrameBuffer()
+        self.message: Optional[Union[Request, MessageFrame]] = None
+        self.closed = False
+        self.address: Tuple[str, int] = address or request.getpeername()
+        self.public_key: Optional[rsa.PublicKey] = None
+        self.cipher: Optional[Union[crypto.SessionCipher, crypto.AEADCipher]] = None
+        self.codec: Union[JsonCodec, BinaryCodec] = JSON
+        self.compressor: Optional[compression.Compressor] = None
+        self.user: Optional[User] = None
+        self.token: Optional[str] = None
+
+    def get_method(self) -> Optional[Callable]:
+        return self.methods.get(self.message.action)
 
     @login_required
     def __handle_messages(self):
-        messages = self.db.get_message_history(self.message.user)
-        status = settings.Status.ok
-        action = settings.Action.messages
-        alert = messages
-        self.__send_response(status, alert, action)
+        page = self.message.data
+        if not isinstance(page, Page):
+            # старые клиенты получают всю историю одним ответом
+            messages = self.db.get_message_history(self.user)
+            self.__send_response(settings.Status.ok, messages, settings.Action.messages)
+            return
+
+        # история отдается страницами: следующая страница отправляется, когда клиент подтвердил предыдущую,
+        # подтвержденная страница отмечается доставленной одним UPDATE. Курсор - позиция после последнего сообщения
+        assert page.limit is None or page.limit > 0, 'Invalid parameter: limit'
+        after = decode_cursor(page.cursor) if page.cursor else 0
+        if self.message.type == 'response':
+            self.db.ack_messages(self.user, after)
+
+        limit = min(page.limit or settings.HISTORY['page_size'], settings.HISTORY['max_page_size'])
+        messages, last = self.db.get_message_page(self.user, after, limit)
+        alert = Page(cursor=encode_cursor(last), limit=limit, messages=messages)
+        self.__send_response(settings.Status.ok, alert, settings.Action.messages)
 
     @login_required
     def __handle_contacts(self):
-        user = self.message.user
         contacts = [User(id=x.id, login=x.login, verbose_name=x.verbose_name)
-                    for x in self.db.get_user_contact_list(user)]
+                    for x in self.db.get_user_contact_list(self.user)]
         status = settings.Status.ok
         action = settings.Action.contacts
         alert = contacts
@@ -93,8 +104,9 @@ class RequestHandler:
     def __send_response(
             self,
             status: settings.Status,
-            alert: Union[Message, User, str, List[User], List[Message]],
-            action: settings.Action
+            alert: Union[Message, User, str, List[User], List[Message], Page],
+            action: settings.Action,
+            features: List[str] = None
     ):
 
         response = Request(
@@ -102,13 +114,14 @@ class RequestHandler:
             action=action,
             time=datetime.now().strftime(settings.DATE_FORMAT),
             type='response',
+            features=features,
             data=alert
         )
 
         data = self.__encrypt(response)
 
-        self.request.send(data)
-        self.server.gui.console_log.emit(f"Response {self.request.getpeername()[0]} - {response.status}")
+        self.server.send(self.request, data)
+        self.server.gui.console_log.emit(f"Response {self.address[0]} - {response.status}")
 
     @login_required
     def __search(self):
@@ -119,23 +132,18 @@ class RequestHandler:
     def __add_contact(self):
 
         try:
-            self.db.create_chat(self.message.user, self.message.data)
+            self.db.create_chat(self.user, self.message.data)
         except AlreadyExist:
             ...
 
-        to_send = self.server.connected_users.get(self.message.data.login, None)
-        if to_send:
-            request = Request(
-                status=settings.Status.ok,
-                action=settings.Action.add_chat,
-                time=datetime.now().strftime(settings.DATE_FORMAT),
-                type='request',
-                data=self.message.user
-            )
-
-            to_send.sock.send(
-                self.__encrypt(request, to_send.sock)
-            )
+        request = Request(
+            status=settings.Status.ok,
+            action=settings.Action.add_chat,
+            time=datetime.now().strftime(settings.DATE_FORMAT),
+            type='request',
+            data=self.user
+        )
+        self.server.deliver(self.message.data.login, request)
 
         status = settings.Status.ok
         action = settings.Action.add_chat
@@ -145,7 +153,7 @@ class RequestHandler:
     @login_required
     def __del_contact(self):
         try:
-            self.db.delete_chat(self.message.user, self.message.data)
+            self.db.delete_chat(self.user, self.message.data)
             status = settings.Status.ok
             alert = 'Success'
         except NotExist as e:
@@ -157,13 +165,50 @@ class RequestHandler:
 
     def __handle_presence(self):
 
-        key = rsa.PublicKey(*self.message.data)
-        self.server.public_keys[self.request] = key
+        self.public_key = rsa.PublicKey(*self.message.data)
 
-        ip = self.request.getpeername()
+        ip = self.address
         date = datetime.now().strftime(settings.DATE_FORMAT)
         self.server.gui.user_connected.emit({'ip': ip[0], 'port': str(ip[1]), 'date': date})
-        self.__send_response(settings.Status.ok, 'Success', settings.Action.presence)
+
+        # клиент, поддерживающий сессионный ключ, получает его в ответе (ответ еще зашифрован rsa),
+        # дальше обе стороны шифруют только симметрично. Алгоритм, кодек и сжатие выбираются из поддерживаемых
+        # клиентом. Ответ на presence еще отправляется в прежнем формате, новые ключ, кодек и сжатие действуют
+        # со следующего кадра. Сжатие - только вместе с сессионным ключом
+        features = self.message.features or ()
+        cipher = compressor = None
+        alert, agreed = 'Success', []
+        if settings.SESSION['enabled'] and 'session' in features:
+            cipher = crypto.session_cipher(crypto.negotiate(features))
+            alert, agreed = cipher.key.decode(), ['session', cipher.name]
+            compressor = compression.negotiate(features)
+            if compressor:
+                agreed.append(compressor.feature)
+
+        codec = negotiate(features, cipher.encoding if cipher else None)
+        if codec.name != JSON.name:
+            agreed.append(codec.name)
+
+        self.__send_response(settings.Status.ok, alert, settings.Action.presence, agreed or None)
+        self.cipher = cipher
+        self.codec = codec
+        self.compressor = compressor
+
+    def __rekey(self):
+        """Offer new session key. Server switches to it, when client confirms"""
+        key = self.cipher.offer()
+        request = Request(
+            action=settings.Action.rekey,
+            time=datetime.now().strftime(settings.DATE_FORMAT),
+            type='request',
+            data=key.decode()
+        )
+        self.server.send(self.request, self.__encrypt(request))
+
+    def __handle_rekey(self):
+        # подтверждение клиента зашифровано уже новым ключом
+        if self.cipher and self.message.type == 'response':
+            self.cipher.commit()
 
     def __handle_auth(self):
         """Presense присылает логопасс. Функция проверяет существование пользователя и его пароль"""
@@ -173,20 +218,18 @@ class RequestHandler:
             status = settings.Status.unauthorized
             alert = f'Wrong login and/or password'
 
+        elif not self.server.add_user(self.request, user.login):
+            # сообщения доставляются одному соединению пользователя, второму они бы не приходили
+            status = settings.Status.unauthorized
+            alert = f'User {user.login} is already connected'
+
         else:
-            self.db.auth_user(user, self.request.getpeername()[0])
+            self.db.auth_user(user, self.address[0])
 
             token = generate_session_token(self.message.user.login)
+            self.user = User(id=user.id, login=user.login, verbose_name=user.verbose_name)
+            self.token = token
 
-            self.server.connected_users.setdefault(
-                self.message.user.login,
-                ConnectedUser(
-                    user=self.message.user,
-                    sock=self.request,
-                    data=deque(),
-                    token=token
-                )
-            )
             status = settings.Status.ok
             alert = User(id=user.id, login=user.login, verbose_name=user.verbose_name, token=token)
 
@@ -194,17 +237,67 @@ class RequestHandler:
 
     @login_required
     def __handle_message(self):
+        # сообщение пересылается без разбора, поэтому конверт сверяется с сессией: чужой логин или токен не пройдут
+        user = self.message.user
+        if user is None or user.login != self.user.login or user.token != self.token:
+            raise NotAuthorised
+        assert self.message.data.from_ == self.user.login, 'Invalid parameter: from_'
+
         recipient = self.message.data.to
-        to_send = self.server.connected_users.get(recipient, None)
-
-        if to_send:
-            self.db.create_message(self.message.data, True)
-            to_send.sock.send(
-                self.__encrypt(self.message, to_send.sock)
-            )
-                    
-        else:
-            self.db.create_message(self.message.data, False)
+        if recipient.startswith('#'):
+            self.__handle_room_message()
+            return
+
+        sent = self.server.deliver(recipient, self.message)
+        self.server.writer.put(self.message.data, sent)
+
+    def __handle_room_message(self):
+        """Сообщение в комнату получают все ее участники, кроме отправителя"""
+        message = self.message.data
+        room = message.to
+        members = self.server.rooms.members(room)
+        assert self.user.login in members, f'Not a member of room {room}'
+
+        request = Request(
+            action=settings.Action.msg,
+            time=self.message.time,
+            type='request',
+            user=self.user,
+            data=message if isinstance(message, Message) else message.model()
+        )
+        self.server.deliver_many(members.difference((self.user.login,)), request)
+
+    @login_required
+    def __handle_join(self):
+        room = self.message.data
+        assert isinstance(room, str) and room.startswith('#'), 'Room name must start with #'
+
+        try:
+            self.db.join_room(self.user, room)
+        except AlreadyExist:
+            ...
+        self.server.update_room(room)
+        self.__send_response(settings.Status.ok, room, settings.Action.join)
+
+    @login_required
+    def __handle_leave(self):
+        room = self.message.data
+        assert isinstance(room, str) and room.startswith('#'), 'Room name must start with #'
+
+        try:
+            self.db.leave_room(self.user, room)
+        except NotExist as e:
+            self.__send_response(settings.Status.bad_request, str(e), settings.Action.leave)
+            return
+
+        self.server.update_room(room)
+        self.__send_response(settings.Status.ok, room, settings.Action.leave)
+
+    def __handle_probe(self):
+        # ответ клиента на проверку ничего не требует - активность соединения уже отмечена при чтении.
+        # Проверку, присланную клиентом, подтверждаем
+        if self.message.type != 'response':
+            self.__send_response(settings.Status.ok, 'Alive', settings.Action.probe)
 
     def __handle_error(self, error: Union[ValidationError, AssertionError, ConnectionError]):
         msg = ''
@@ -218,49 +311,84 @@ class RequestHandler:
             self.__close_request()
             
         else:
-            self.__send_response(settings.Status.bad_request, msg, self.message.action)
-
-    def __encrypt(self, data: Request, sock: socket = None) -> bytes:
-        cipher = Fernet.generate_key()
-        cipher_key = Fernet(cipher)
-
-        user = sock or self.request
+            action = self.message.action if self.message else settings.Action.presence
+            self.__send_response(settings.Status.bad_request, msg, action)
+
+    def __encrypt(self, data: Request) -> bytes:
+        return self.server.encrypt(self, data)
+
+    methods: Dict[settings.Action, Callable] = {
+        settings.Action.presence: __handle_presence,
+        settings.Action.msg: __handle_message,
+        settings.Action.quit: __handle_quit,
+        settings.Action.register: __handle_register,
+        settings.Action.auth: __handle_auth,
+        settings.Action.contacts: __handle_contacts,
+        settings.Action.search: __search,
+        settings.Action.add_chat: __add_contact,
+        settings.Action.del_chat: __del_contact,
+        settings.Action.messages: __handle_messages,
+        settings.Action.probe: __handle_probe,
+        settings.Action.join: __handle_join,
+        settings.Action.leave: __handle_leave,
+        settings.Action.rekey: __handle_rekey
+    }
+
+    def probe(self):
+        """Keepalive request, sent by server to silent connection. Client, that is alive, answers it"""
+        if self.closed or self.public_key is None:
+            return
+
+        request = Request(
+            action=settings.Action.probe,
+            time=datetime.now().strftime(settings.DATE_FORMAT),
+            type='request'
+        )
+        self.server.send(self.request, self.__encrypt(request))
 
-        user_key = self.server.public_keys.get(user)
-        encoded_key = rsa.encrypt(cipher, user_key)
+    def handle_data(self, data: bytes) -> int:
+        """Feed received chunk into connection buffer and pass complete frames to server pipeline.
+        Client can send several requests without waiting for responses - all of them are handled in one pass.
+        Empty chunk means disconnect
 
-        encrypted_data = cipher_key.encrypt(
-            data.json(exclude_none=True, ensure_ascii=False).encode(settings.DEFAULT_ENCODING)
-        )
-        result = encoded_key + encrypted_data
-        return result
+        Returns:
+            int: number of complete frames
+        """
+        try:
+            assert data, 'No data received'
 
-    def __decrypt(self, data: bytes) -> bytes:
+            frames = self.frames.feed(data)
 
-        length = 64  # length of fernet key, encoded with rsa
+        except (AssertionError, ConnectionError) as e:
+            self.server.stop_reading(self.request)
+            self.server.dispatch(self.request, self.__handle_error, e)
+            return 0
 
-        decoded_key, payload = data[:length], data[length:]
-        cipher = rsa.decrypt(decoded_key, self.__private_key)
+        for frame in frames:
+            self.server.dispatch(self.request, self.handle_frame, frame)
+        return len(frames)
 
-        cipher_key = Fernet(cipher)
-        return cipher_key.decrypt(payload)
+    def handle_frame(self, data: bytes):
+        if self.closed:
+            return
 
-    def handle_request(self):
         try:
-            data = self.request.recv(self.server.buffer_size)
-            
-            assert data, 'No data received'
-
+            # кадр, который не удалось разобрать, не должен получить ответ с действием предыдущего запроса
+            self.message = None
             try:
-                data = self.__decrypt(data)
+                self.message = self.__decode(data)
             except rsa.pkcs1.DecryptionError:
                 return
 
-            self.message = Request.parse_raw(data)
             handler = self.get_method()
 
             assert handler, 'Action not allowed'
-            handler()
+            handler(self)
+
+            interval = settings.SESSION['rekey_interval']
+            if self.cipher and interval and not self.closed and not self.cipher.pending \
+                    and self.cipher.age() > interval:
+                self.__rekey()
 
         except NotAuthorised:
             self.__send_response(settings.Status.unauthorized, 'Incorrect token', action=self.message.action)
@@ -276,14 +404,31 @@ class RequestHandler:
         except ConnectionError as e:
             self.__handle_error(e)
 
+    def __decode(self, data: bytes) -> Union[Request, MessageFrame]:
+        """Frame is encrypted with session key, or with server public key, if it was sent before key was agreed.
+        Messages of session are not parsed into models - only envelope is read ({peek})"""
+        binary = self.codec.name == BinaryCodec.name
+        if self.cipher:
+            try:
+                data = self.cipher.decrypt(data)
+            except InvalidToken:
+                ...
+            else:
+                if self.compressor:
+                    data = self.compressor.decompress(data)
+                return peek(data, binary) or parse(data, binary)
+        return self.server.pipeline.decode(data, self.__private_key, binary)
+
     @log
     def __close_request(self):
-        address, port = self.request.getpeername()
+        if self.closed:
+            return
+
+        address, port = self.address
         self.server.gui.console_log.emit(f"User {address}:{port} disconnected")
         self.server.gui.user_disconnected.emit((address, str(port)))
 
-        self.request.close()
-        if self.message and self.message.user:
-            self.server.connected_users.pop(self.message.user.login, None)
-        self.server.public_keys.pop(self.request, None)
-        self.server.connected.remove(self.request)
+        self.closed = True
+        if self.user:
+            self.server.remove_user(self.request)
+        self.server.close_connection(self.request)
@@ -6,7 +6,7 @@ from typing import Dict
 from PyQt5 import QtCore
 from PyQt5.QtWidgets import QMainWindow, QTableWidgetItem, QApplication, QPushButton, QListWidgetItem
 
-from base import TCPSocketServer
+from base import TCPSocketServer, get_server_class
 from common.config import settings
 from server import RequestHandler
 from server_ui import Ui_MainWindow
@@ -100,7 +100,7 @@ class UI(Ui_MainWindow):
 
 
 if __name__ == '__main__':
-    srv = TCPSocketServer(
+    srv = get_server_class()(
         handler=RequestHandler,
         host=settings.HOST,
         port=settings.PORT,
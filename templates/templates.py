@@ -1,9 +1,10 @@
-from socket import socket
-from typing import Optional, Union, List, Deque
+import json
+from typing import Optional, Union, List
 
 from pydantic import BaseModel
 
 from common.config import settings
+from common.utils import parse_date
 
 
 class Base(BaseModel):
@@ -31,13 +32,23 @@ class Message(Base):
     date: Optional[str]
 
 
+class Page(Base):
+    """Page of message history. Client asks for page with {limit} and {cursor} (None - from the beginning),
+    server answers with {messages} and {cursor} of position after them. Client acknowledges page with this cursor,
+    and server sends the next one"""
+    cursor: Optional[str]
+    limit: Optional[int]
+    messages: List[Message] = []
+
+
 class Request(Base):
     status: Optional[settings.Status]
     action: settings.Action
     time: str
     type: Optional[str]
+    features: Optional[List[str]]
     user: Optional[User]
-    data: Optional[Union[Message, User, str, List[User], List[Message], List[int]]]
+    data: Optional[Union[Message, User, str, List[User], List[Message], List[int], Page]]
 
 
 class Encrypted(Base):
@@ -45,9 +56,421 @@ class Encrypted(Base):
     key: bytes
 
 
-class ConnectedUser(Base):
-    user: User
-    sock: socket
-    data: Deque[Union[str, Request]]
-    token: str
-    
\ No newline at end of file
+"""Кодеки запросов. JSON (pydantic) понимают все клиенты, компактный бинарный формат согласуется при presence.
+Тип поля data в бинарном формате записан явно, поэтому Union не перебирается, а модели создаются без повторной
+валидации (construct). Формат кадра определяется по первому байту: JSON всегда начинается с '{'"""
+
+
+class JsonCodec:
+    name = 'json'
+
+    def __init__(self, encoding: str = None):
+        self.encoding = encoding or settings.DEFAULT_ENCODING
+
+    def encode(self, request: Union[Request, 'MessageFrame']) -> bytes:
+        if isinstance(request, MessageFrame):
+            return request.encode(self)
+        return request.json(exclude_none=True, ensure_ascii=False).encode(self.encoding)
+
+    @staticmethod
+    def decode(data: bytes) -> Request:
+        return Request.parse_raw(data)
+
+    @staticmethod
+    def peek(data: bytes) -> Optional['MessageFrame']:
+        # pydantic пишет action в начале объекта, поэтому остальные запросы отсеиваются без разбора
+        if data.find(b'"action": "msg"', 0, 64) < 0:
+            return None
+
+        try:
+            request = json.loads(data)
+        except ValueError:
+            # в том числе UnicodeDecodeError
+            raise AssertionError('Invalid request')
+        if request.get('action') != settings.Action.msg:
+            return None
+
+        user, message = request.get('user'), request.get('data')
+        assert isinstance(message, dict), 'Invalid parameter: data'
+        return MessageFrame(
+            time=_checked(request.get('time'), 'time'),
+            user=Sender(
+                _checked(user.get('login'), 'login'),
+                _checked(user.get('token'), 'token', True)
+            ) if isinstance(user, dict) else None,
+            data=MessageData(
+                _checked(message.get('to'), 'to'),
+                _checked(message.get('from_'), 'from_'),
+                _checked(message.get('encoding', 'utf-8'), 'encoding'),
+                _checked(message.get('message'), 'message'),
+                _checked_date(message.get('date'))
+            )
+        )
+
+
+class BinaryCodec:
+    """Tagged binary encoding: version byte, action/status/type tags, then fields in fixed order.
+    Unsigned integers are varints, strings are varint length + utf-8. Optional values are shifted by one,
+    so 0 means None"""
+
+    name = 'binary'
+    VERSION = 1
+
+    ACTIONS = list(settings.Action)
+    STATUSES = list(settings.Status)
+    TYPES = ['request', 'response']
+
+    DATA_NONE, DATA_MESSAGE, DATA_USER, DATA_STR, DATA_USERS, DATA_MESSAGES, DATA_INTS, DATA_PAGE = range(8)
+    MSG = ACTIONS.index(settings.Action.msg)
+
+    def encode(self, request: Union[Request, 'MessageFrame']) -> bytes:
+        if isinstance(request, MessageFrame):
+            return request.encode(self)
+
+        buf = bytearray((
+            self.VERSION,
+            self.ACTIONS.index(request.action),
+            self.STATUSES.index(request.status) + 1 if request.status else 0,
+            self.TYPES.index(request.type) + 1 if request.type else 0,
+        ))
+        self._str(buf, request.time)
+
+        features = request.features
+        self._uint(buf, len(features) + 1 if features is not None else 0)
+        for feature in features or ():
+            self._str(buf, feature)
+
+        if request.user is None:
+            buf.append(0)
+        else:
+            buf.append(1)
+            self._user(buf, request.user)
+
+        data = request.data
+        if data is None:
+            buf.append(self.DATA_NONE)
+        elif isinstance(data, Message):
+            buf.append(self.DATA_MESSAGE)
+            self._message(buf, data)
+        elif isinstance(data, User):
+            buf.append(self.DATA_USER)
+            self._user(buf, data)
+        elif isinstance(data, str):
+            buf.append(self.DATA_STR)
+            self._str(buf, data)
+        elif isinstance(data, Page):
+            buf.append(self.DATA_PAGE)
+            self._opt_str(buf, data.cursor)
+            self._uint(buf, data.limit + 1 if data.limit is not None else 0)
+            self._uint(buf, len(data.messages))
+            for x in data.messages:
+                self._message(buf, x)
+        else:
+            # пустой список при разборе JSON становится List[User] - первым подходящим вариантом Union
+            first = data[0] if data else None
+            if first is None or isinstance(first, User):
+                buf.append(self.DATA_USERS)
+                item = self._user
+            elif isinstance(first, Message):
+                buf.append(self.DATA_MESSAGES)
+                item = self._message
+            else:
+                buf.append(self.DATA_INTS)
+                item = self._uint
+            self._uint(buf, len(data))
+            for x in data:
+                item(buf, x)
+
+        return bytes(buf)
+
+    def decode(self, data: bytes) -> Request:
+        reader = _Reader(data)
+        version, action, status, kind = reader.bytes(4)
+        assert version == self.VERSION, f'Unsupported binary format version: {version}'
+        # номера приходят от клиента: вне диапазона - это ошибка запроса, а не IndexError
+        assert action < len(self.ACTIONS), 'Invalid parameter: action'
+        assert status <= len(self.STATUSES), 'Invalid parameter: status'
+        assert kind <= len(self.TYPES), 'Invalid parameter: type'
+
+        request = {
+            'action': self.ACTIONS[action],
+            'status': self.STATUSES[status - 1] if status else None,
+            'type': self.TYPES[kind - 1] if kind else None,
+            'time': reader.str(),
+        }
+
+        count = reader.uint()
+        request['features'] = [reader.str() for _ in range(count - 1)] if count else None
+        request['user'] = self._read_user(reader) if reader.byte() else None
+
+        tag = reader.byte()
+        if tag == self.DATA_MESSAGE:
+            request['data'] = self._read_message(reader)
+        elif tag == self.DATA_USER:
+            request['data'] = self._read_user(reader)
+        elif tag == self.DATA_STR:
+            request['data'] = reader.str()
+        elif tag == self.DATA_USERS:
+            request['data'] = [self._read_user(reader) for _ in range(reader.uint())]
+        elif tag == self.DATA_MESSAGES:
+            request['data'] = [self._read_message(reader) for _ in range(reader.uint())]
+        elif tag == self.DATA_INTS:
+            request['data'] = [reader.uint() for _ in range(reader.uint())]
+        elif tag == self.DATA_PAGE:
+            cursor, limit = reader.opt_str(), reader.uint()
+            request['data'] = Page.construct(
+                cursor=cursor,
+                limit=limit - 1 if limit else None,
+                messages=[self._read_message(reader) for _ in range(reader.uint())]
+            )
+        else:
+            assert tag == self.DATA_NONE, 'Invalid parameter: data'
+            request['data'] = None
+
+        return Request.construct(**request)
+
+    def peek(self, data: bytes) -> Optional['MessageFrame']:
+        if len(data) < 2 or data[1] != self.MSG:
+            return None
+
+        reader = _Reader(data)
+        version = reader.bytes(4)[0]
+        assert version == self.VERSION, f'Unsupported binary format version: {version}'
+
+        time = reader.str()
+        for _ in range(reader.uint() - 1):
+            reader.skip()
+
+        user = None
+        if reader.byte():
+            reader.uint()
+            login = reader.str()
+            reader.skip(optional=True)
+            reader.skip(optional=True)
+            user = Sender(login, reader.opt_str())
+
+        assert reader.byte() == self.DATA_MESSAGE, 'Invalid parameter: data'
+        message = MessageData(reader.str(), reader.str(), reader.str(), reader.str(), _checked_date(reader.opt_str()))
+        return MessageFrame(time=time, user=user, data=message)
+
+    @staticmethod
+    def _uint(buf: bytearray, value: int):
+        assert value >= 0, 'Negative integers are not supported'
+        while value >= 0x80:
+            buf.append(value & 0x7F | 0x80)
+            value >>= 7
+        buf.append(value)
+
+    def _str(self, buf: bytearray, value: str):
+        raw = value.encode('utf-8')
+        self._uint(buf, len(raw))
+        buf += raw
+
+    def _opt_str(self, buf: bytearray, value: Optional[str]):
+        if value is None:
+            buf.append(0)
+        else:
+            raw = value.encode('utf-8')
+            self._uint(buf, len(raw) + 1)
+            buf += raw
+
+    def _user(self, buf: bytearray, user: User):
+        self._uint(buf, user.id + 1 if user.id is not None else 0)
+        self._str(buf, user.login)
+        self._opt_str(buf, user.password)
+        self._opt_str(buf, user.verbose_name)
+        self._opt_str(buf, user.token)
+
+    def _message(self, buf: bytearray, message: Message):
+        self._str(buf, message.to)
+        self._str(buf, message.from_)
+        self._str(buf, message.encoding)
+        self._str(buf, message.message)
+        self._opt_str(buf, message.date)
+
+    @staticmethod
+    def _read_user(reader: '_Reader') -> User:
+        user_id = reader.uint()
+        return User.construct(
+            id=user_id - 1 if user_id else None,
+            login=reader.str(),
+            password=reader.opt_str(),
+            verbose_name=reader.opt_str(),
+            token=reader.opt_str(),
+        )
+
+    @staticmethod
+    def _read_message(reader: '_Reader') -> Message:
+        return Message.construct(
+            to=reader.str(),
+            from_=reader.str(),
+            encoding=reader.str(),
+            message=reader.str(),
+            date=reader.opt_str(),
+        )
+
+
+class _Reader:
+    __slots__ = ('data', 'pos')
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def bytes(self, size: int) -> bytes:
+        end = self.pos + size
+        assert end <= len(self.data), 'Truncated request'
+        value, self.pos = self.data[self.pos:end], end
+        return value
+
+    def byte(self) -> int:
+        return self.bytes(1)[0]
+
+    def uint(self) -> int:
+        value = shift = 0
+        while True:
+            byte = self.byte()
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def str(self) -> str:
+        return self._text(self.uint())
+
+    def opt_str(self) -> Optional[str]:
+        size = self.uint()
+        return self._text(size - 1) if size else None
+
+    def skip(self, optional: bool = False):
+        """Skip string, which is not needed"""
+        size = self.uint()
+        self.bytes(size - 1 if optional and size else size)
+
+    def _text(self, size: int) -> str:
+        try:
+            value = self.bytes(size).decode('utf-8')
+        except UnicodeDecodeError:
+            raise AssertionError('Invalid request: not utf-8 string')
+        # модели создаются без валидации, поэтому ограничение длины строк проверяется здесь
+        assert len(value) <= Base.Config.max_anystr_length, f'max length: {Base.Config.max_anystr_length}'
+        return value
+
+
+JSON = JsonCodec()
+JSON_UTF8 = JsonCodec('utf-8')
+BINARY = BinaryCodec()
+codecs = {JSON.name: JSON, BINARY.name: BINARY}
+
+
+def negotiate(features: List[str], encoding: str = None) -> Union[JsonCodec, BinaryCodec]:
+    """Codec of connection: first of configured codecs, supported by client. JSON is supported by every client
+
+    Args:
+        features (List[str]): features of client
+        encoding (str): text encoding for JSON, depends on session cipher
+    """
+    for name in settings.CODECS:
+        if name in features and name in codecs:
+            return codecs[name]
+        if name == JSON.name:
+            break
+    return JSON_UTF8 if encoding == 'utf-8' else JSON
+
+
+def decode(data: bytes, binary: bool = True) -> Request:
+    """Request in any codec format
+
+    Args:
+        data (bytes): payload
+        binary (bool): binary codec is agreed with connection, else only JSON is accepted
+    """
+    if data[:1] == b'{':
+        return JsonCodec.decode(data)
+    assert binary, 'Binary codec is not agreed'
+    return BINARY.decode(data)
+
+
+"""Быстрый путь для сообщений. Сервер пересылает msg получателю, не заглядывая в текст, поэтому кадр не разбирается
+в модели: читаются и проверяются только поля конверта в легкие структуры со __slots__. Получателю кадр собирается
+заново из этих полей, а не пересылается как есть: остальное содержимое кадра отправителя не проверено, и клиент
+получателя не смог бы его разобрать. Остальные действия разбираются как обычно"""
+
+
+class Sender:
+    __slots__ = ('login', 'token')
+
+    def __init__(self, login: str, token: Optional[str]):
+        self.login = login
+        self.token = token
+
+
+class MessageData:
+    """Same fields as {Message}, so it is saved to database the same way"""
+
+    __slots__ = ('to', 'from_', 'encoding', 'message', 'date')
+
+    def __init__(self, to: str, from_: str, encoding: str, message: str, date: Optional[str]):
+        self.to = to
+        self.from_ = from_
+        self.encoding = encoding
+        self.message = message
+        self.date = date
+
+    def model(self) -> Message:
+        return Message.construct(
+            to=self.to, from_=self.from_, encoding=self.encoding, message=self.message, date=self.date
+        )
+
+
+class MessageFrame:
+    """msg request, of which only envelope is read"""
+
+    __slots__ = ('time', 'user', 'data')
+
+    action = settings.Action.msg
+    status = None
+    type = None
+    features = None
+
+    def __init__(self, time: str, user: Optional[Sender], data: MessageData):
+        self.time = time
+        self.user = user
+        self.data = data
+
+    def encode(self, codec: Union[JsonCodec, BinaryCodec]) -> bytes:
+        """Payload for connection with {codec}, built from checked fields only. Token of sender is not forwarded"""
+        return codec.encode(self.request())
+
+    def request(self) -> Request:
+        return Request.construct(
+            action=self.action,
+            time=self.time,
+            user=User.construct(login=self.user.login) if self.user else None,
+            data=self.data.model()
+        )
+
+    def json(self, **kwargs) -> str:
+        return self.request().json(**kwargs)
+
+
+def peek(data: bytes, binary: bool = True) -> Optional[MessageFrame]:
+    """Envelope of msg request, None for other actions"""
+    if data[:1] == b'{':
+        return JsonCodec.peek(data)
+    assert binary, 'Binary codec is not agreed'
+    return BINARY.peek(data)
+
+
+def _checked(value, name: str, optional: bool = False) -> Optional[str]:
+    if value is None and optional:
+        return None
+    assert isinstance(value, str), f'Invalid parameter: {name}'
+    assert len(value) <= Base.Config.max_anystr_length, f'max length: {Base.Config.max_anystr_length}'
+    return value
+
+
+def _checked_date(value) -> str:
+    # дата сохраняется в базу, поэтому сообщение без даты или с неверной датой не принимается
+    assert isinstance(value, str) and parse_date(value), 'Invalid parameter: date'
+    return value
@@ -1,10 +1,40 @@
+import asyncio
+import datetime
 import json
+import os
+import selectors
+import socket
+import tempfile
+import time
+from functools import partial
 from unittest import TestCase, main
 
+import rsa
+from cryptography.fernet import InvalidToken
+from sqlalchemy import create_engine, text, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from base import TCPSocketServer, StreamConnection, listen_unix, remove_unix
 from client import TCPSocketClient
-from templates.templates import Request
+from common import crypto, compression
+from common.keystore import KeyPool, KeyStore
+from common.framing import FrameBuffer, pack_frame
+from templates.templates import Request, User, Message, Page, BINARY, JSON, decode, peek
 from common.config import settings
-from common.utils import get_cmd_arguments
+from database import archive
+from database.core import apply_pragmas, sqlite_settings
+from database.message_log import MessageLog
+from database.migrations import MIGRATIONS, Migration, current_version, migrate
+from database.server_models import create_tables, MessageHistory, ArchiveChunk
+from databases import Identity, IdentityCache, MemoryDatabase
+from exceptions import AlreadyExist, NotExist
+from common.utils import get_cmd_arguments, encode_cursor, decode_cursor, unix_address
+from pipeline import Pipeline
+from registry import ConnectionRegistry
+from server import RequestHandler
+from workers import Router
+from writer import MessageWriter
 
 """
 Перед запуском тестов необходимо запустить сервер.
@@ -137,7 +167,906 @@ class TestUtils(TestCase):
             get_cmd_arguments,
             self.invalid_args
         )
-        
-    
+
+    def test_cursor(self):
+        self.assertEqual(decode_cursor(encode_cursor(12345)), 12345)
+        self.assertRaises(AssertionError, decode_cursor, 'not a cursor')
+
+
+class TestFraming(TestCase):
+    def setUp(self) -> None:
+        self.buffer = FrameBuffer(max_size=1024)
+
+    def test_split_frame(self):
+        frame = pack_frame(b'payload')
+        self.assertListEqual(self.buffer.feed(frame[:3]), [])
+        self.assertListEqual(self.buffer.feed(frame[3:6]), [])
+        self.assertListEqual(self.buffer.feed(frame[6:]), [b'payload'])
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_pipelined_frames(self):
+        data = pack_frame(b'first') + pack_frame(b'') + pack_frame(b'second') + pack_frame(b'third')[:5]
+        self.assertListEqual(self.buffer.feed(data), [b'first', b'', b'second'])
+        self.assertListEqual(self.buffer.feed(b'hird'), [b'third'])
+
+    def test_frame_too_large(self):
+        self.assertRaises(
+            ConnectionError,
+            self.buffer.feed, pack_frame(b'x' * 1025)
+        )
+
+
+class TestCrypto(TestCase):
+    def test_encrypt_many(self):
+        keys = [rsa.newkeys(512) for _ in range(3)]
+        encrypted = crypto.encrypt_many(b'room message', [public for public, _ in keys])
+        self.assertEqual(len(encrypted), 3)
+        for data, (_, private) in zip(encrypted, keys):
+            self.assertEqual(crypto.decrypt(data, private), b'room message')
+
+    def test_session_rekey(self):
+        server = crypto.SessionCipher()
+        client = crypto.SessionCipher(server.key)
+        old = client.encrypt(b'old key')
+
+        client.accept(server.offer())
+        self.assertEqual(server.decrypt(old), b'old key')
+        self.assertEqual(server.decrypt(client.encrypt(b'new key')), b'new key')
+
+        server.commit()
+        self.assertEqual(client.decrypt(server.encrypt(b'response')), b'response')
+
+    def test_aead_envelope(self):
+        for name in crypto.AEADCipher.ALGORITHMS:
+            server = crypto.session_cipher(name)
+            client = crypto.session_cipher(name, server.key)
+            data = server.encrypt('сообщение'.encode('utf-8'))
+            self.assertEqual(client.decrypt(data).decode('utf-8'), 'сообщение')
+
+            client.accept(server.offer())
+            self.assertEqual(server.decrypt(client.encrypt(b'new key')), b'new key')
+            self.assertRaises(InvalidToken, crypto.session_cipher(name).decrypt, data)
+
+
+class TestPipeline(TestCase):
+    def test_order(self):
+        pipeline = Pipeline('thread', 4)
+        handled = {'a': [], 'b': []}
+
+        def handle(key: str, number: int):
+            time.sleep(0.001 * (number % 3))
+            handled[key].append(number)
+
+        for i in range(30):
+            pipeline.submit('a', handle, 'a', i)
+            pipeline.submit('b', handle, 'b', i)
+        pipeline.executor.shutdown(wait=True)
+        self.assertEqual(handled, {'a': list(range(30)), 'b': list(range(30))})
+
+    def test_errors(self):
+        for kind in ('inline', 'thread'):
+            pipeline = Pipeline(kind, 2)
+            handled = []
+            pipeline.submit('a', lambda: 1 / 0)
+            pipeline.submit('a', handled.append, 'next')
+            if pipeline.executor:
+                pipeline.executor.shutdown(wait=True)
+            self.assertEqual(handled, ['next'], kind)
+
+
+class TestKeyStore(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'keys', 'server.pem')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_load(self):
+        public, private = KeyStore(self.path, 512, 0).load()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertEqual(KeyStore(self.path, 512, 0).load(), (public, private))
+        # размер ключа изменился в настройках - ключ заменяется
+        public, _ = KeyStore(self.path, 768, 0).load()
+        self.assertEqual(rsa.common.bit_size(public.n), 768)
+
+    def test_rotate(self):
+        store = KeyStore(self.path, 512, 0)
+        _, old = store.load()
+        _, new = store.rotate()
+        self.assertNotEqual(old, new)
+        self.assertEqual(store.load()[1], new)
+        with open(f'{self.path}.prev', 'rb') as f:
+            self.assertEqual(rsa.PrivateKey.load_pkcs1(f.read()), old)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.path))), ['server.pem', 'server.pem.prev'])
+
+    def test_max_age(self):
+        store = KeyStore(self.path, 512, 1)
+        _, private = store.load()
+        self.assertFalse(store.expired())
+        self.assertEqual(store.load()[1], private)
+
+        moment = time.time() - 2 * 86400
+        os.utime(self.path, (moment, moment))
+        self.assertTrue(store.expired())
+        self.assertNotEqual(store.load()[1], private)
+        self.assertFalse(store.expired())
+
+
+class TestKeyPool(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.pool = KeyPool(self.dir.name, 512, 2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_fill(self):
+        self.assertEqual(self.pool.fill(), 2)
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(self.pool.fill(), 0)
+        self.assertEqual(self.pool.fill(3), 1)
+        self.assertEqual(len(self.pool), 3)
+
+    def test_take(self):
+        self.assertIsNone(self.pool.take())
+        self.pool.fill()
+        public, private = self.pool.take()
+        self.assertEqual(rsa.decrypt(rsa.encrypt(b'key', public), private), b'key')
+        self.assertEqual(len(self.pool), 1)
+        self.assertIsNotNone(self.pool.take())
+        self.assertIsNone(self.pool.take())
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_take_other_size(self):
+        KeyPool(self.dir.name, 1024, 1).fill()
+        self.assertIsNone(self.pool.take())
+
+
+class TestCodec(TestCase):
+    def setUp(self) -> None:
+        self.request = Request(
+            action=settings.Action.msg,
+            time='18-10-2026 12:00:00',
+            user=User(id=1, login='test', verbose_name='@test'),
+            data=Message(to='other', from_='test', message='привет', date='18-10-2026 12:00:00')
+        )
+
+    def test_binary_round_trip(self):
+        history = Request(
+            status=settings.Status.ok,
+            action=settings.Action.messages,
+            time='18-10-2026 12:00:00',
+            type='response',
+            data=[self.request.data] * 3
+        )
+        page = history.copy(update={'data': Page(cursor=encode_cursor(3), limit=3, messages=history.data)})
+        for request in (self.request, history, page):
+            self.assertEqual(decode(BINARY.encode(request)), request)
+        self.assertEqual(decode(JSON.encode(page)), page)
+
+    def test_binary_is_smaller(self):
+        self.assertLess(len(BINARY.encode(self.request)), len(JSON.encode(self.request)))
+
+    def test_json_detected(self):
+        self.assertEqual(decode(JSON.encode(self.request)), self.request)
+
+    def test_peek_message(self):
+        for codec in (JSON, BINARY):
+            payload = codec.encode(self.request)
+            frame = peek(payload)
+            self.assertEqual((frame.user.login, frame.data.to, frame.data.message), ('test', 'other', 'привет'))
+            self.assertEqual(frame.data.model(), self.request.data)
+            # получателю уходят только проверенные поля конверта
+            self.assertEqual(codec.encode(frame), codec.encode(self.request.copy(update={'user': User(login='test')})))
+
+        self.assertEqual(decode(JSON.encode(peek(BINARY.encode(self.request)))).user, User(login='test'))
+        self.assertIsNone(peek(BINARY.encode(Request(action=settings.Action.contacts, time='18-10-2026 12:00:00'))))
+
+    def test_invalid_binary(self):
+        payload = BINARY.encode(self.request)
+        for data in (b'\x01\x40\x00\x00', b'\x01\x00\x09\x00', b'\x01\x00\x00\x03', payload[:-3],
+                     payload.replace('привет'.encode('utf-8'), b'\xff' * 12)):
+            with self.assertRaises(AssertionError):
+                decode(data)
+        with self.assertRaises(AssertionError):
+            peek(payload.replace('привет'.encode('utf-8'), b'\xff' * 12))
+        with self.assertRaises(AssertionError):
+            decode(payload, binary=False)
+
+    def test_invalid_json_message(self):
+        for data in (b'{"action": "msg", oops', b'{"action": "msg", "time": "\xff"}'):
+            with self.assertRaises(AssertionError):
+                peek(data)
+
+    def test_peek_invalid_date(self):
+        for date in ('garbage', None):
+            request = self.request.copy(update={'data': self.request.data.copy(update={'date': date})})
+            for codec in (JSON, BINARY):
+                with self.assertRaises(AssertionError):
+                    peek(codec.encode(request))
+
+    def test_peek_forwards_checked_fields(self):
+        request = json.loads(self.request.json(exclude_none=True))
+        request.update(status='oops', type=1, features=[None])
+        request['user'].update(id='abc', token='secret')
+        frame = peek(json.dumps(request).encode('utf-8'))
+        for codec in (JSON, BINARY):
+            forwarded = decode(codec.encode(frame))
+            self.assertEqual(forwarded.user, User(login='test'))
+            self.assertEqual(forwarded.data, self.request.data)
+            self.assertIsNone(forwarded.status)
+
+
+class TestCompression(TestCase):
+    def setUp(self) -> None:
+        message = Message(to='other', from_='test', message='привет', date='18-10-2026 12:00:00')
+        self.history = JSON.encode(Request(
+            status=settings.Status.ok,
+            action=settings.Action.messages,
+            time='18-10-2026 12:00:00',
+            type='response',
+            data=[message] * 20
+        ))
+
+    def test_round_trip(self):
+        compressor = compression.Compressor(b'"from_": "encoding": "utf-8"', threshold=256)
+        compressed = compressor.compress(self.history)
+        self.assertLess(len(compressed), len(self.history))
+        self.assertEqual(compressor.decompress(compressed), self.history)
+
+        small = JSON.encode(Request(action=settings.Action.contacts, time='18-10-2026 12:00:00'))
+        self.assertEqual(compressor.compress(small), small)
+        self.assertEqual(compressor.decompress(small), small)
+
+    def test_dictionary_mismatch(self):
+        compressed = compression.Compressor(b'"from_": "encoding": "utf-8"', threshold=0).compress(self.history)
+        with self.assertRaises(AssertionError):
+            compression.Compressor(b'other dictionary', threshold=0).decompress(compressed)
+
+    def test_negotiate(self):
+        own = compression.load()
+        self.assertIs(compression.negotiate(compression.offer()), own)
+        self.assertEqual(compression.negotiate(['zlib:00000000', 'zlib']).feature, 'zlib')
+        self.assertIsNone(compression.negotiate(['zlib:00000000']))
+
+    def test_scrub(self):
+        presence = Request(
+            action=settings.Action.msg,
+            time='18-10-2026 12:00:00',
+            user=User(id=1, login='test', token='9ea07917' * 8),
+            data=Message(to='other', from_='test', message='привет', date='18-10-2026 12:00:00')
+        )
+        for payload in (self.history, JSON.encode(presence), BINARY.encode(presence)):
+            scrubbed = compression.scrub(payload)
+            for value in (b'test', b'other', b'9ea07917', 'привет'.encode('utf-8'), b'18-10-2026'):
+                self.assertNotIn(value, scrubbed)
+            self.assertEqual(decode(scrubbed).action, decode(payload).action)
+
+
+class TestIdentityCache(TestCase):
+    def test_lru(self):
+        cache = IdentityCache(size=2)
+        for i in range(3):
+            cache.put(Identity(i, f'user{i}', f'@user{i}', 'hash'))
+
+        self.assertIsNone(cache.get('user0'))
+        self.assertEqual(cache.get_by_id(1).login, 'user1')
+        cache.put(Identity(3, 'user3', '@user3', 'hash'))
+        self.assertIsNone(cache.get_by_id(2))
+        self.assertEqual(cache.get('user1').id, 1)
+
+        cache.invalidate(login='user1')
+        self.assertIsNone(cache.get_by_id(1))
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 2, 'misses': 3})
+
+
+class TestMigrations(TestCase):
+    def test_migrate(self):
+        engine = create_engine('sqlite://')
+        self.assertTrue(create_tables(engine))
+        self.assertEqual(current_version(engine), MIGRATIONS[-1].version)
+        self.assertEqual(migrate(engine), MIGRATIONS[-1].version)
+
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO clients (id, login, password, verbose_name) VALUES (1, 'a', '', ''), "
+                              "(2, 'b', '', '')"))
+            conn.execute(text('INSERT INTO chats (init_id, other_id) VALUES (1, 2)'))
+        with self.assertRaises(IntegrityError), engine.begin() as conn:
+            conn.execute(text('INSERT INTO chats (init_id, other_id) VALUES (2, 1)'))
+
+    def test_failed_step(self):
+        engine = create_engine('sqlite://')
+        create_tables(engine)
+        version = MIGRATIONS[-1].version + 1
+        # ошибка ограничения в самом шаге - не гонка с другим процессом
+        MIGRATIONS.append(Migration(version, 'broken', lambda conn: conn.execute(text(
+            "INSERT INTO schema_version (version, description, applied_at) VALUES (1, 'copy', '2026-10-18')"
+        ))))
+        try:
+            with self.assertRaises(IntegrityError):
+                migrate(engine)
+        finally:
+            MIGRATIONS.pop()
+        self.assertEqual(current_version(engine), version - 1)
+
+
+class TestStorageProfile(TestCase):
+    def test_pragmas(self):
+        engine = create_engine('sqlite://')
+        profile = {'synchronous': 'OFF', 'cache_size': -1024, 'temp_store': 'MEMORY', 'busy_timeout': 100}
+        event.listen(engine, 'connect', partial(apply_pragmas, profile))
+
+        active = sqlite_settings(engine)
+        self.assertEqual(
+            (active['synchronous'], active['cache_size'], active['temp_store'], active['busy_timeout']),
+            ('OFF', -1024, 'MEMORY', 100)
+        )
+
+
+class TestMemoryDatabase(TestCase):
+    def setUp(self) -> None:
+        self.db = MemoryDatabase()
+        self.users = [
+            User(id=self.db.create_user(User(login=x, password='123')), login=x) for x in ('test', 'other', 'third')
+        ]
+
+    def test_users(self):
+        with self.assertRaises(AlreadyExist):
+            self.db.create_user(User(login='test', password='123'))
+        self.assertEqual(self.db.get_user('other').verbose_name, '@other')
+        self.assertEqual([x.login for x in self.db.search('T%')], ['test', 'third'])
+
+    def test_messages(self):
+        test, other, _ = self.users
+        for i in range(5):
+            self.db.create_message(Message(to='other', from_='test', message=str(i), date='18-10-2026 12:00:00'), False)
+        with self.assertRaises(NotExist):
+            self.db.create_message(Message(to='nobody', from_='test', message='', date='18-10-2026 12:00:00'), False)
+
+        page, last = self.db.get_message_page(other, limit=3)
+        self.assertEqual([x.message for x in page], ['0', '1', '2'])
+        self.assertEqual(self.db.ack_messages(other, last), 3)
+        self.assertEqual([x.message for x in self.db.get_message_history(other)], ['3', '4'])
+        self.assertEqual(self.db.get_message_history(other), [])
+
+    def test_invalid_date_skipped(self):
+        messages = [(Message(to='other', from_='test', message=str(i), date='18-10-2026 12:00:00'), False)
+                    for i in range(3)]
+        messages[1][0].date = 'garbage'
+        self.assertEqual(self.db.create_messages(messages), 2)
+        self.assertEqual([x.message for x in self.db.get_message_history(self.users[1])], ['0', '2'])
+
+    def test_chats(self):
+        test, other, third = self.users
+        self.db.create_chat(test, other)
+        self.db.create_chat(third, test)
+        with self.assertRaises(AlreadyExist):
+            self.db.create_chat(other, test)
+        self.assertEqual([x.login for x in self.db.get_user_contact_list(test)], ['other', 'third'])
+
+        self.db.delete_chat(other, test)
+        self.assertEqual([x.login for x in self.db.get_user_contact_list(other)], [])
+        with self.assertRaises(NotExist):
+            self.db.delete_chat(test, other)
+
+
+class TestMessageLog(TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.log = MessageLog(self.dir.name, segment_size=200, fsync=False)
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def message(self, text: str) -> Message:
+        return Message(to='other', from_='test', message=text, date='18-10-2026 12:00:00')
+
+    def test_read_ack(self):
+        self.assertEqual(self.log.append(1, [(self.message(str(i)), i == 2) for i in range(5)]), 5)
+        for i in range(5, 10):
+            self.log.append(1, [(self.message(str(i)), False)])
+        self.assertGreater(len(os.listdir(os.path.join(self.dir.name, '1'))), 3)
+
+        page, last = self.log.read(1, limit=4)
+        self.assertEqual([x[2] for x in page], ['0', '1', '3', '4'])
+        self.assertEqual(page[0][:2], ('test', '18-10-2026 12:00:00'))
+        self.assertEqual(self.log.ack(1, last), 5)
+        self.assertEqual([x[2] for x in self.log.read(1)[0]], ['5', '6', '7', '8', '9'])
+        self.assertEqual(self.log.read(1, after=9), ([('test', '18-10-2026 12:00:00', '9')], 10))
+
+    def test_partial_write(self):
+        self.log.append(1, [(self.message('first'), False)])
+        segment = os.path.join(self.dir.name, '1', f'{1:020d}.log')
+        with open(segment, 'ab') as f:
+            f.write(b'\x00\x00\x01')
+
+        self.assertEqual(self.log.append(1, [(self.message('second'), False)]), 2)
+        self.assertEqual([x[2] for x in self.log.read(1)[0]], ['first', 'second'])
+
+    def test_trim_delivered(self):
+        for i in range(10):
+            self.log.append(1, [(self.message(str(i)), False)])
+        path = os.path.join(self.dir.name, '1')
+        self.assertIn(f'{1:020d}.log', os.listdir(path))
+
+        self.log.ack(1, 10)
+        self.assertEqual(len([x for x in os.listdir(path) if x.endswith('.log')]), 1)
+        self.assertEqual(self.log.read(1), ([], 10))
+        self.log.append(1, [(self.message('next'), False)])
+        self.assertEqual([x[2] for x in self.log.read(1)[0]], ['next'])
+
+    def test_read_while_trimmed(self):
+        for i in range(10):
+            self.log.append(1, [(self.message(str(i)), False)])
+        other = MessageLog(self.dir.name, segment_size=200, fsync=False)
+
+        with self.log.partition(1) as partition:
+            delivered = partition.delivered
+
+            def stale() -> int:
+                # другой процесс подтверждает доставку и удаляет сегменты после того, как номер уже прочитан
+                value = delivered()
+                if not value:
+                    other.ack(1, 8)
+                return value
+
+            partition.delivered = stale
+            partition._refresh()
+        self.assertEqual([x[2] for x in self.log.read(1)[0]], ['8', '9'])
+
+    def test_evict_closes_files(self):
+        log = MessageLog(self.dir.name, segment_size=200, fsync=False, partitions=1)
+        log.append(1, [(self.message('first'), False)])
+        log.read(1)
+        first = log.partitions[1]
+        log.append(2, [(self.message('second'), False)])
+
+        self.assertEqual(list(log.partitions), [2])
+        self.assertTrue(first.delivered_file.closed)
+        self.assertEqual(first.maps, {})
+        self.assertEqual([x[2] for x in log.read(1)[0]], ['first'])
+
+
+class TestArchive(TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.archive = archive.Archive(self.dir.name)
+        engine = create_engine('sqlite://')
+        create_tables(engine)
+        self.db = Session(engine)
+
+        old = datetime.datetime(2026, 1, 1, 12)
+        self.db.add_all([
+            MessageHistory(sender_id=1, recipient_id=2, date=old, content='старое', sent=True),
+            MessageHistory(sender_id=2, recipient_id=3, date=old, content='чужое', sent=True),
+            MessageHistory(sender_id=1, recipient_id=2, date=old + datetime.timedelta(days=1), content='второе',
+                           sent=True),
+            MessageHistory(sender_id=1, recipient_id=2, date=old, content='не доставлено', sent=False),
+            MessageHistory(sender_id=1, recipient_id=2, date=datetime.datetime(2026, 10, 1), content='новое',
+                           sent=True),
+        ])
+        self.db.commit()
+
+    def tearDown(self) -> None:
+        self.db.close()
+        self.dir.cleanup()
+
+    def test_archive(self):
+        before = datetime.datetime(2026, 6, 1)
+        self.assertEqual(archive.archive_messages(self.db, self.archive, before, batch=1), 1)
+        self.assertEqual(archive.archive_messages(self.db, self.archive, before), 2)
+        self.assertEqual(archive.archive_messages(self.db, self.archive, before), 0)
+
+        self.assertEqual(self.db.query(MessageHistory).count(), 2)
+        self.assertEqual(self.db.query(ArchiveChunk).count(), 3)
+        self.assertTrue(os.path.isfile(os.path.join(self.dir.name, '2026', '01', '2026-01-01.jsonl.gz')))
+
+        rows = archive.read_messages(self.db, self.archive, 1, datetime.datetime(2026, 1, 1), before)
+        self.assertEqual([x['message'] for x in rows], ['старое', 'второе'])
+
+    def test_chunk_members(self):
+        before = datetime.datetime(2026, 6, 1)
+        archive.archive_messages(self.db, self.archive, before)
+        chunks = self.db.query(ArchiveChunk).order_by(ArchiveChunk.id).all()
+        self.assertEqual([(x.day.day, x.low_id, x.high_id, x.count) for x in chunks],
+                         [(1, 1, 2, 1), (1, 2, 3, 1), (2, 1, 2, 1)])
+
+        rows = archive.read_messages(self.db, self.archive, 3, datetime.datetime(2026, 1, 1), before)
+        self.assertEqual([x['message'] for x in rows], ['чужое'])
+
+
+class FakeWorker:
+    def __init__(self):
+        self.port = 7777
+        self.delivered = []
+
+    def deliver_local(self, login, request):
+        self.delivered.append((login, request))
+        return True
+
+    def deliver_local_many(self, logins, request):
+        self.delivered += [(x, request) for x in logins]
+        return logins
+
+
+class TestRouter(TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, 'router')
+        self.servers = [FakeWorker(), FakeWorker()]
+        self.routers = [Router(x, i, 2, path) for i, x in enumerate(self.servers)]
+        self.request = Request(
+            action=settings.Action.msg,
+            time='18-10-2026 12:00:00',
+            data=Message(to='other', from_='test', message='привет', date='18-10-2026 12:00:00')
+        )
+
+    def tearDown(self) -> None:
+        for router in self.routers:
+            router.close()
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        first, second = self.routers
+        first.bind('test')
+        second.receive()
+        self.assertEqual(second.directory, {'test': 0})
+
+        second.directory['other'] = 1
+        self.assertTrue(second.forward('test', self.request))
+        self.assertEqual(second.forward_many(['test', 'other'], self.request), ['test'])
+        first.receive()
+        self.assertEqual(self.servers[0].delivered, [('test', self.request)] * 2)
+
+    def test_invalid_datagrams(self):
+        first, second = self.routers
+        second.directory['other'] = 1
+        big = self.request.copy(update={'data': self.request.data.copy(update={'message': 'x' * first.max_datagram})})
+        self.assertFalse(first.forward('other', big))
+
+        first.connection.sendto(b'{"op": "deliver", "login"', first.peers[1])
+        first.connection.sendto(b'{"op": "deliver", "login": "other", "request": "{}"}', first.peers[1])
+        first.bind('test')
+        second.receive()
+        self.assertEqual((second.directory['test'], self.servers[1].delivered), (0, []))
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.batches = []
+
+    def create_messages(self, messages):
+        self.batches.append(len(messages))
+        return len(messages)
+
+
+class TestMessageWriter(TestCase):
+    def setUp(self) -> None:
+        self.message = Message(to='other', from_='test', message='привет', date='18-10-2026 12:00:00')
+        self.db = FakeDatabase()
+
+    def test_batches(self):
+        writer = MessageWriter(self.db, durability='memory', batch=10, interval_ms=1000)
+        for _ in range(25):
+            writer.put(self.message, True)
+        writer.close()
+        self.assertEqual(self.db.batches, [10, 10, 5])
+        self.assertEqual(writer.stats()['written'], 25)
+
+    def test_invalid_date(self):
+        writer = MessageWriter(self.db, durability='memory', interval_ms=1000)
+        with self.assertRaises(AssertionError):
+            writer.put(self.message.copy(update={'date': 'garbage'}), False)
+
+        bad = self.message.copy(update={'date': None})
+        writer._flush([(self.message, False, None)] * 4 + [(bad, False, None)] + [(self.message, False, None)] * 4)
+        writer.close()
+        self.assertEqual((writer.stats()['written'], writer.stats()['failed']), (8, 1))
+
+    def test_commit_waits(self):
+        writer = MessageWriter(self.db, durability='commit')
+        writer.put(self.message, False)
+        self.assertEqual(writer.stats()['written'], 1)
+        writer.close()
+
+
+class FakeSocket:
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
+class TestConnectionRegistry(TestCase):
+    def setUp(self) -> None:
+        self.registry = ConnectionRegistry()
+        self.sock = FakeSocket(10)
+        self.conn = self.registry.add(self.sock, ('127.0.0.1', 50000))
+
+    def test_lookup(self):
+        self.assertIs(self.registry.get(self.sock), self.conn)
+        self.assertIs(self.registry.find(('127.0.0.1', 50000)), self.conn)
+        self.assertIsNone(self.registry.get(FakeSocket(11)))
+
+    def test_bind_login(self):
+        self.assertTrue(self.registry.bind(self.conn, 'test'))
+        other = self.registry.add(FakeSocket(11), ('127.0.0.1', 50001))
+        self.assertFalse(self.registry.bind(other, 'test'))
+        self.assertIs(self.registry.user('test'), self.conn)
+
+    def test_remove(self):
+        self.registry.bind(self.conn, 'test')
+        self.registry.remove(self.conn)
+        self.assertEqual(len(self.registry), 0)
+        self.assertIsNone(self.registry.user('test'))
+        self.assertIsNone(self.registry.get(self.sock))
+
+    def test_idle(self):
+        registry = ConnectionRegistry(probe_interval=30, timeout=90)
+        conn = registry.add(FakeSocket(12), ('127.0.0.1', 50002))
+        start = conn.last_activity
+
+        self.assertEqual(registry.check_idle(start + 10), ([], []))
+        self.assertEqual(registry.check_idle(start + 31), ([conn], []))
+        self.assertEqual(registry.check_idle(start + 62), ([], []))
+        self.assertEqual(registry.check_idle(start + 91), ([], [conn]))
+
+    def test_closing_deadline(self):
+        registry = ConnectionRegistry(probe_interval=0, timeout=90)
+        conn = registry.add(FakeSocket(12), ('127.0.0.1', 50002))
+        registry.close_later(conn)
+
+        self.assertEqual(registry.check_idle(conn.close_by - 1), ([], []))
+        self.assertEqual(registry.check_idle(conn.close_by), ([], [conn]))
+
+
+class SelectServer:
+    max_outbox_size = 1 << 20
+    _queue = TCPSocketServer._queue
+    _abort = TCPSocketServer._abort
+    _update_events = TCPSocketServer._update_events
+    flush = TCPSocketServer.flush
+
+    def __init__(self):
+        self.registry = ConnectionRegistry()
+        self.selector = selectors.DefaultSelector()
+
+
+class TestOutbox(TestCase):
+    def setUp(self) -> None:
+        self.server = SelectServer()
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.peer.setblocking(False)
+        self.conn = self.server.registry.add(self.sock, ('local', self.sock.fileno()))
+        self.server._update_events(self.conn)
+
+    def tearDown(self) -> None:
+        self.server.selector.close()
+        self.sock.close()
+        self.peer.close()
+
+    def events(self) -> int:
+        return self.server.selector.get_key(self.sock).events
+
+    def receive(self) -> bytes:
+        data = bytearray()
+        while True:
+            try:
+                chunk = self.peer.recv(1 << 16)
+            except BlockingIOError:
+                return bytes(data)
+            if not chunk:
+                return bytes(data)
+            data += chunk
+
+    def test_sent_at_once(self):
+        self.server._queue(self.conn, b'frame')
+        self.assertEqual(self.conn.outbox, b'')
+        self.assertEqual(self.events(), selectors.EVENT_READ)
+        self.assertEqual(self.receive(), b'frame')
+
+    def test_write_interest(self):
+        # клиент не читает: остаток ждет в буфере соединения, и сокет проверяется на запись
+        frame = b'x' * (1 << 16)
+        while not self.conn.outbox:
+            self.server._queue(self.conn, frame)
+        self.assertEqual(self.events(), selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+        received = b''
+        while self.conn.outbox:
+            received += self.receive()
+            self.server.flush(self.conn)
+        received += self.receive()
+        self.assertEqual(self.events(), selectors.EVENT_READ)
+        self.assertEqual(len(received), self.conn.bytes_out)
+
+    def test_abort_over_limit(self):
+        frame = b'x' * (1 << 16)
+        for _ in range(64):
+            self.server._queue(self.conn, frame)
+        self.assertEqual(self.conn.outbox, b'')
+        self.assertEqual(self.events(), selectors.EVENT_READ)
+        # чтение разорванного соединения возвращает b'', и обработчик закрывает его
+        self.assertEqual(self.sock.recv(1), b'')
+
+
+class UnixServer(SelectServer):
+    attach_listener = TCPSocketServer.attach_listener
+    peer_address = TCPSocketServer.peer_address
+    accept_connection = TCPSocketServer.accept_connection
+    _key_frame = TCPSocketServer._key_frame
+    database = None
+    _private = None
+
+    def __init__(self, path: str):
+        super(UnixServer, self).__init__()
+        self.unix_path = path
+        self.gui = FakeGUI()
+        self._public = rsa.PublicKey(3233, 17)
+        self.request_handler = lambda *args: None
+
+
+class TestUnixSocket(TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def serve(self, path: str):
+        server = UnixServer(path)
+        server.attach_listener(listen_unix(path, 5))
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(unix_address(path))
+            server.accept_connection(server.unix_connection)
+
+            conn, = server.registry
+            self.assertEqual(conn.address, (path, conn.fd))
+            self.assertEqual(client.recv(1024)[4:], b'[3233, 17]')
+        for conn in server.registry:
+            conn.sock.close()
+        server.unix_connection.close()
+
+    def test_path(self):
+        path = os.path.join(self.dir.name, 'chat.sock')
+        # файл, оставшийся от прошлого запуска, заменяется
+        open(path, 'w').close()
+        self.serve(path)
+        self.assertTrue(os.path.exists(path))
+        remove_unix(path)
+        self.assertFalse(os.path.exists(path))
+        remove_unix(path)
+
+    def test_abstract(self):
+        name = f'@chat-test-{os.getpid()}'
+        self.serve(name)
+        # у сокета в абстрактном пространстве имен нет файла, удалять нечего
+        self.assertFalse(os.path.exists(name))
+        remove_unix(name)
+
+
+class TestStreamConnection(TestCase):
+    def test_abort_over_limit(self):
+        async def run():
+            sock, peer = socket.socketpair()
+            _, writer = await asyncio.open_connection(sock=sock)
+            client = StreamConnection(writer, asyncio.get_running_loop())
+
+            client.sendall(b'x' * 1024, 1 << 20)
+            await asyncio.sleep(0)
+            self.assertFalse(writer.transport.is_closing())
+
+            # получатель ничего не читает, и буфер записи растет сверх предела
+            client.sendall(b'x' * (16 << 20), 1 << 20)
+            await asyncio.sleep(0)
+            self.assertTrue(writer.transport.is_closing())
+            peer.close()
+
+        asyncio.run(run())
+
+
+class FakeGUI:
+    def __getattr__(self, item):
+        return self
+
+    def emit(self, *args):
+        ...
+
+
+class FakeServer:
+    def __init__(self):
+        self.gui = FakeGUI()
+        self.pipeline = Pipeline('inline')
+        self.sent = []
+        self.users = {}
+
+    def encrypt(self, client, request: Request) -> Request:
+        return request
+
+    def add_user(self, client, login: str) -> bool:
+        return self.users.setdefault(login, client) is client
+
+    def send(self, client, data: Request):
+        self.sent.append(data)
+
+
+class TestRequestHandler(TestCase):
+    def setUp(self) -> None:
+        self.public, self.private = rsa.newkeys(512)
+        self.server = FakeServer()
+        self.db = MemoryDatabase()
+        self.handler = self.connect(10)
+
+    def connect(self, fd: int) -> RequestHandler:
+        return RequestHandler(FakeSocket(fd), self.server, self.db, self.private, ('127.0.0.1', 50000 + fd))
+
+    def test_first_frame_invalid(self):
+        # бинарный кадр до согласования кодека
+        self.handler.handle_frame(crypto.encrypt(b'\x01\x00\x00\x00', self.public))
+        response, = self.server.sent
+        self.assertEqual((response.status, response.action), (settings.Status.bad_request, settings.Action.presence))
+
+    def test_second_login(self):
+        self.db.create_user(User(login='test', password='123'))
+        auth = crypto.encrypt(JSON.encode(Request(
+            action=settings.Action.auth, time='18-10-2026 12:00:00', user=User(login='test', password='123')
+        )), self.public)
+        other = self.connect(11)
+        self.handler.handle_frame(auth)
+        other.handle_frame(auth)
+
+        first, second = self.server.sent
+        self.assertEqual(first.status, settings.Status.ok)
+        self.assertEqual((second.status, second.data), (settings.Status.unauthorized, 'User test is already connected'))
+        self.assertIsNone(other.user)
+
+
+
+class FakeSession:
+    def __init__(self):
+        self.codec = JSON
+        self.compressor = None
+        self.cipher = crypto.session_cipher()
+
+
+class LocalServer:
+    capture = None
+    encode = TCPSocketServer.encode
+    encrypt = TCPSocketServer.encrypt
+    deliver_local = TCPSocketServer.deliver_local
+
+    def __init__(self):
+        self.registry = ConnectionRegistry()
+        self.sent = []
+
+    def send(self, client, data: bytes):
+        self.sent.append((client, data))
+
+
+class TestDelivery(TestCase):
+    def test_connection_removed_meanwhile(self):
+        server = LocalServer()
+        sock = FakeSocket(10)
+        conn = server.registry.add(sock, ('127.0.0.1', 50000))
+        conn.session = FakeSession()
+        server.registry.bind(conn, 'other')
+
+        # цикл ввода-вывода удаляет соединение между поиском получателя и шифрованием
+        def user(login: str):
+            found = ConnectionRegistry.user(server.registry, login)
+            server.registry.remove(found)
+            return found
+
+        server.registry.user = user
+        request = Request(action=settings.Action.msg, time='18-10-2026 12:00:00',
+                          data=Message(to='other', from_='test', message='привет', date='18-10-2026 12:00:00'))
+        self.assertTrue(server.deliver_local('other', request))
+        (client, data), = server.sent
+        self.assertEqual(decode(conn.session.cipher.decrypt(data)), request)
+
+
 if __name__ == '__main__':
     main()
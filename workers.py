@@ -0,0 +1,240 @@
+import json
+import os
+import selectors
+import sys
+from multiprocessing import Process
+from socket import socket, AF_UNIX, SOCK_DGRAM, SOL_SOCKET, SO_SNDBUF, MSG_TRUNC
+from collections import defaultdict
+from typing import Dict, Iterable, List
+
+from base import TCPSocketServer, get_server_class, listen_unix, remove_unix
+from common.config import settings
+from common.keystore import KeyStore
+from common.utils import get_cmd_arguments
+from databases import MemoryDatabase, get_database
+from log.server_log import logger
+from server import RequestHandler
+from templates.templates import Request
+
+"""Многопроцессный режим. Несколько процессов принимают соединения на одном порту (SO_REUSEPORT), ядро распределяет
+между ними клиентов. Сессии пользователей живут в памяти своего процесса, поэтому сообщения пользователю, подключенному
+к другому процессу, пересылаются через локальный канал маршрутизации (Unix datagram сокеты)"""
+
+
+class Signal:
+    """Stand-in for Qt signal, writes events into server log"""
+
+    def __init__(self, template: str):
+        self.template = template
+
+    def emit(self, *args):
+        logger.info(self.template.format(*args))
+
+
+class HeadlessGUI:
+    """Worker processes have no window, so GUI signals of server are written into log"""
+
+    def __init__(self, name: str):
+        self.console_log = Signal(f'<{name}> {{}}')
+        self.user_connected = Signal(f'<{name}> user connected: {{}}')
+        self.user_disconnected = Signal(f'<{name}> user disconnected: {{}}')
+
+
+class Router:
+    """Routing channel between worker processes.
+
+    Every worker keeps copy of directory {login: worker index}: on authentication and disconnect worker broadcasts
+    'bind'/'unbind', so lookup of recipient is a local dict access. Message to remote user is forwarded to the worker
+    holding the session as plain request - channel is local, and only that worker knows recipient public key
+    """
+
+    MAX_DATAGRAM = 4 * 1024 * 1024
+
+    def __init__(self, server: TCPSocketServer, index: int, count: int, path: str = None):
+        self.server = server
+        self.index = index
+        path = path or settings.ROUTER_PATH
+        self.peers = [f'{path}-{server.port}-{i}.sock' for i in range(count)]
+        self.directory: Dict[str, int] = {}
+
+        address = self.peers[index]
+        if os.path.exists(address):
+            os.unlink(address)
+
+        self.connection = socket(AF_UNIX, SOCK_DGRAM)
+        self.connection.bind(address)
+        self.connection.setblocking(False)
+
+        # датаграмма больше буфера отправки не уходит целиком (EMSGSIZE). Буфер просим побольше, но ядро
+        # ограничивает его net.core.wmem_max: запрос больше предела не пересылается, а остается недоставленным
+        # и приходит получателю с историей
+        self.connection.setsockopt(SOL_SOCKET, SO_SNDBUF, self.MAX_DATAGRAM)
+        self.max_datagram = min(self.connection.getsockopt(SOL_SOCKET, SO_SNDBUF) // 2, self.MAX_DATAGRAM)
+
+    def attach(self):
+        """Plug router into server loop and ask other workers for sessions they already hold"""
+        self.server.router = self
+        self.server.selector.register(self.connection, selectors.EVENT_READ, self.receive)
+        self.broadcast({'op': 'sync', 'worker': self.index})
+
+    def close(self):
+        self.connection.close()
+        if os.path.exists(self.peers[self.index]):
+            os.unlink(self.peers[self.index])
+
+    def bind(self, login: str):
+        self.broadcast({'op': 'bind', 'login': login, 'worker': self.index})
+
+    def unbind(self, login: str):
+        self.broadcast({'op': 'unbind', 'login': login, 'worker': self.index})
+
+    def forward(self, login: str, request: Request) -> bool:
+        """Send request to worker, holding session of user
+
+        Returns:
+            bool: False if user is not connected to any worker
+        """
+        worker = self.directory.get(login)
+        if worker is None or worker == self.index:
+            return False
+
+        sent = self._send(worker, {'op': 'deliver', 'login': login, 'request': request.json(exclude_none=True)})
+        if not sent:
+            logger.error(f'<worker-{self.index}> route to worker-{worker} failed, user {login}')
+        return sent
+
+    def forward_many(self, logins: Iterable[str], request: Request) -> List[str]:
+        """Send request to users of other workers: one datagram for every worker, not for every user
+
+        Returns:
+            List[str]: users, connected to other workers
+        """
+        workers = defaultdict(list)
+        for login in logins:
+            worker = self.directory.get(login)
+            if worker is not None and worker != self.index:
+                workers[worker].append(login)
+
+        forwarded = []
+        data = request.json(exclude_none=True)
+        for worker, users in workers.items():
+            if self._send(worker, {'op': 'fanout', 'logins': users, 'request': data}):
+                forwarded += users
+            else:
+                logger.error(f'<worker-{self.index}> route to worker-{worker} failed, {len(users)} users')
+        return forwarded
+
+    def broadcast(self, message: dict):
+        for worker in range(len(self.peers)):
+            if worker != self.index:
+                self._send(worker, message)
+
+    def _send(self, worker: int, message: dict) -> bool:
+        data = json.dumps(message).encode()
+        if len(data) > self.max_datagram:
+            logger.error(f'<worker-{self.index}> {message["op"]} of {len(data)} bytes exceeds datagram limit')
+            return False
+
+        # воркер может быть еще не запущен или уже остановлен - это не ошибка для рассылки bind/unbind/sync
+        try:
+            self.connection.sendto(data, self.peers[worker])
+        except (BlockingIOError, FileNotFoundError, ConnectionRefusedError):
+            return False
+        except OSError as e:
+            logger.error(f'<worker-{self.index}> send to worker-{worker} failed: {e}')
+            return False
+        return True
+
+    def receive(self):
+        """Handle every datagram, received from other workers"""
+        while True:
+            try:
+                data, _, flags, _ = self.connection.recvmsg(self.max_datagram + 1)
+            except BlockingIOError:
+                return
+
+            if flags & MSG_TRUNC:
+                logger.error(f'<worker-{self.index}> truncated datagram dropped')
+                continue
+            try:
+                self._handle(json.loads(data))
+            except (ValueError, KeyError, TypeError, AssertionError) as e:
+                logger.error(f'<worker-{self.index}> invalid datagram: {e}')
+
+    def _handle(self, message: dict):
+        op = message['op']
+
+        if op == 'deliver':
+            self.server.deliver_local(message['login'], Request.parse_raw(message['request']))
+        elif op == 'fanout':
+            self.server.deliver_local_many(message['logins'], Request.parse_raw(message['request']))
+        elif op == 'room':
+            self.server.rooms.forget(message['name'])
+        elif op == 'bind':
+            self.directory[message['login']] = message['worker']
+        elif op == 'unbind':
+            if self.directory.get(message['login']) == message['worker']:
+                del self.directory[message['login']]
+        elif op == 'sync':
+            for login in self.server.registry.logins():
+                self._send(message['worker'], {'op': 'bind', 'login': login, 'worker': self.index})
+
+
+def run_worker(index: int, count: int, host: str, port: int, unix_listener: socket = None):
+    server = get_server_class()(
+        handler=RequestHandler,
+        host=host,
+        port=port,
+        reuse_port=True,
+        unix_path=''
+    )
+    if unix_listener:
+        # unix сокет создан до запуска воркеров и общий для всех: ядро отдает клиента одному из них
+        server.unix_path = settings.UNIX_PATH
+        server.attach_listener(unix_listener)
+    server.gui = HeadlessGUI(f'worker-{index}')
+    router = Router(server, index, count)
+    router.attach()
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        ...
+    finally:
+        router.close()
+
+
+def run_workers(count: int, host: str, port: int):
+    """Start {count} worker processes, accepting on the same address, and wait for them"""
+
+    # схему базы и ключ сервера создаем заранее, иначе воркеры одновременно выполняют create_all и мешают друг
+    # другу, а ключи у них получаются разные
+    # у каждого процесса была бы своя база в памяти - пользователь одного воркера не существовал бы для другого
+    assert not isinstance(get_database(), MemoryDatabase), 'Memory storage can not be shared by workers'
+    KeyStore().load()
+
+    unix_listener = listen_unix(settings.UNIX_PATH, TCPSocketServer.pool_size) if settings.UNIX_PATH else None
+
+    processes = [
+        Process(target=run_worker, args=(i, count, host, port, unix_listener), name=f'worker-{i}')
+        for i in range(count)
+    ]
+    for process in processes:
+        process.start()
+
+    # CTRL + C получают все процессы группы, воркеры завершаются сами
+    try:
+        for process in processes:
+            try:
+                process.join()
+            except KeyboardInterrupt:
+                process.join()
+    finally:
+        # файл общего unix сокета удаляется, когда завершились все воркеры
+        if unix_listener:
+            unix_listener.close()
+            remove_unix(settings.UNIX_PATH)
+
+
+if __name__ == '__main__':
+    bind_host, bind_port = get_cmd_arguments(sys.argv[1:])
+    run_workers(settings.WORKERS or os.cpu_count(), bind_host, bind_port)
@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+from common.config import settings
+from common.utils import parse_date
+from databases import ServerStorage
+from log.server_log import logger
+from templates.templates import Message
+
+"""Отложенная запись сообщений. Раньше каждое сообщение сохранялось своей транзакцией: два запроса пользователей
+и commit, то есть fsync на каждое сообщение. Теперь сообщения складываются в очередь, а поток записи сохраняет их
+пачками - одна транзакция на {batch} сообщений или на {interval_ms} миллисекунд.
+
+Режимы (durability):
+    sync - без очереди, транзакция на каждое сообщение, как раньше. Режим по умолчанию;
+    commit - групповая запись: обработчик ждет, пока транзакция с его сообщением не завершится. Пачка собирается из
+        сообщений, пришедших, пока шла предыдущая запись, поэтому без ожидания интервала. Сохраненное не теряется.
+        Движок select с HANDLER_POOL "inline" в этом режиме не запускается: обработчик выполняется в цикле
+        ввода-вывода, и ожидание остановило бы весь сервер;
+    memory - обработчик не ждет записи. Самый быстрый режим, но при падении процесса сообщения из очереди теряются,
+        поэтому включается только явно.
+Получателю сообщение доставляется до сохранения во всех режимах - от сохранения зависит только история"""
+
+
+class MessageWriter:
+
+    MODES = ('sync', 'commit', 'memory')
+
+    def __init__(
+            self,
+            database: ServerStorage,
+            durability: str = None,
+            batch: int = None,
+            interval_ms: float = None,
+            max_queue: int = None
+    ):
+        """
+        Args:
+            database (ServerStorage): database to write into
+            durability (str): "sync", "commit" or "memory"
+            batch (int): max messages in one transaction
+            interval_ms (float): how long to collect messages for transaction in "memory" mode
+            max_queue (int): producers wait, while queue is full
+        """
+        config = settings.WRITE_BEHIND
+        self.db = database
+        self.durability = durability or config['durability']
+        self.batch = batch or config['batch']
+        self.interval = (config['interval_ms'] if interval_ms is None else interval_ms) / 1000
+        self.max_queue = max_queue or config['max_queue']
+        assert self.durability in self.MODES, f'Unknown durability: {self.durability}'
+
+        self.queue: Deque[Tuple[Message, bool, Optional[threading.Event]]] = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.flush_last = 0.0
+        self.flush_max = 0.0
+        self.flush_total = 0.0
+
+        self._thread: Optional[threading.Thread] = None
+        if self.durability != 'sync':
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+
+    def put(self, data: Message, sent: bool):
+        """Save message. Returns at once in "memory" mode, after it is written in other modes"""
+        assert parse_date(data.date), 'Invalid parameter: date'
+        if self._thread is None or self.closed:
+            self.db.create_message(data, sent)
+            return
+
+        done = threading.Event() if self.durability == 'commit' else None
+        with self.condition:
+            while len(self.queue) >= self.max_queue and not self.closed:
+                self.condition.wait()
+            self.queue.append((data, sent, done))
+            self.condition.notify_all()
+
+        if done:
+            done.wait()
+
+    def close(self):
+        """Write everything queued and stop writer thread"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+
+                # в режиме memory пачка копится до {batch} сообщений, но не дольше интервала
+                if self.durability == 'memory':
+                    deadline = time.monotonic() + self.interval
+                    while len(self.queue) < self.batch and not self.closed:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            break
+                        self.condition.wait(left)
+
+                items = [self.queue.popleft() for _ in range(min(self.batch, len(self.queue)))]
+                self.condition.notify_all()
+
+            self._flush(items)
+
+    def _flush(self, items: list):
+        start = time.monotonic()
+        messages = []
+        for data, sent, _ in items:
+            # сообщение с неверной датой пропускается само, а не вместе со всей пачкой
+            if parse_date(data.date):
+                messages.append((data, sent))
+            else:
+                self.failed += 1
+                logger.error(f'<writer> message from {data.from_} is not saved: invalid date {data.date!r}')
+        try:
+            self.written += self.db.create_messages(messages)
+        except Exception as e:
+            self.failed += len(messages)
+            logger.error(f'<writer> {len(messages)} messages are not saved: {e}')
+        finally:
+            elapsed = time.monotonic() - start
+            self.batches += 1
+            self.flush_last = elapsed
+            self.flush_max = max(self.flush_max, elapsed)
+            self.flush_total += elapsed
+            for _, _, done in items:
+                if done:
+                    done.set()
+
+    def stats(self) -> dict:
+        return {
+            'durability': self.durability,
+            'queue': len(self.queue),
+            'written': self.written,
+            'failed': self.failed,
+            'batches': self.batches,
+            'flush_last_ms': round(self.flush_last * 1000, 3),
+            'flush_max_ms': round(self.flush_max * 1000, 3),
+            'flush_avg_ms': round(self.flush_total / self.batches * 1000, 3) if self.batches else 0.0,
+        }